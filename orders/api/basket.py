@@ -0,0 +1,125 @@
+from django.db import transaction
+from django.db.models import Case, PositiveIntegerField, Value, When
+
+from api.models import Order, OrderItem, ProductInfo
+from api.shops import closed_shop_ids
+from api.totals import update_order_total
+
+
+def is_quantity(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def line_error(line, offers, closed):
+    """
+    Ошибка строки корзины {'product': ИД предложения, 'quantity': количество} или None.
+    Проверки те же, что в OrderItemSerializer, но по заранее загруженным предложениям
+    """
+    if not isinstance(line, dict) or not is_quantity(line.get('product')) or not is_quantity(line.get('quantity')):
+        return 'Некорректный формат данных'
+    offer = offers.get(line['product'])
+    if offer is None:
+        return 'Предложение не найдено'
+    shop_id, stock = offer
+    if shop_id in closed:
+        return 'Магазин сейчас не принимает заказы'
+    if line['quantity'] < 1:
+        return 'Нельзя заказать товар в количестве меньше 1'
+    if stock < line['quantity']:
+        return 'Такого количества нет в наличии'
+    return None
+
+
+def line_ids(lines):
+    return {line['product'] for line in lines if isinstance(line, dict) and is_quantity(line.get('product'))}
+
+
+def load_offers(ids):
+    """
+    Магазин и остаток предложений одним запросом: ИД предложения -> (ИД магазина, количество)
+    """
+    return {info_id: (shop_id, stock) for info_id, shop_id, stock in
+            ProductInfo.objects.filter(id__in=ids).values_list('id', 'shop_id', 'quantity')}
+
+
+def line_result(line, error):
+    product = line.get('product') if isinstance(line, dict) else None
+    if error:
+        return {'product': product, 'Status': False, 'Errors': error}
+    return {'product': product, 'Status': True}
+
+
+def add_items(user_id, lines):
+    """
+    Добавляет строки в корзину пользователя пакетом в одной транзакции: все предложения и уже лежащие
+    в корзине позиции загружаются двумя запросами, позиции записываются одним bulk_create.
+    Если хотя бы одна строка не прошла проверку, корзина не меняется.
+    Возвращает количество добавленных позиций (None при ошибках) и результаты по строкам
+    """
+    with transaction.atomic():
+        order, _ = Order.objects.get_or_create(user_id=user_id, status='basket')
+        ids = line_ids(lines)
+        offers = load_offers(ids)
+        taken = set(OrderItem.objects.filter(order_id=order.id, product_info_id__in=ids).values_list(
+            'product_info_id', flat=True))
+        closed = closed_shop_ids()
+
+        results, items = [], []
+        for line in lines:
+            error = line_error(line, offers, closed)
+            if not error and line['product'] in taken:
+                error = 'Товар уже находится в корзине'
+            if not error:
+                taken.add(line['product'])
+                items.append(OrderItem(order_id=order.id, product_info_id=line['product'], quantity=line['quantity']))
+            results.append(line_result(line, error))
+        if len(items) < len(results):
+            return None, results
+
+        OrderItem.objects.bulk_create(items)
+        update_order_total(order.id)
+    return len(items), results
+
+
+def update_items(user_id, lines):
+    """
+    Меняет количество товаров в корзине пользователя одним UPDATE с CASE по ИД предложения
+    после проверки всех строк по предложениям, загруженным одним запросом. Товары, которых нет
+    в корзине, пропускаются. Если хотя бы одна строка не прошла проверку, корзина не меняется.
+    Возвращает количество обновленных позиций (None при ошибках) и результаты по строкам
+    """
+    with transaction.atomic():
+        order, _ = Order.objects.get_or_create(user_id=user_id, status='basket')
+        offers = load_offers(line_ids(lines))
+        closed = closed_shop_ids()
+
+        results, quantities = [], {}
+        for line in lines:
+            error = line_error(line, offers, closed)
+            if not error and line['product'] in quantities:
+                error = 'Товар указан несколько раз'
+            if not error:
+                quantities[line['product']] = line['quantity']
+            results.append(line_result(line, error))
+        if len(quantities) < len(results):
+            return None, results
+
+        updated = OrderItem.objects.filter(order_id=order.id, product_info_id__in=quantities).update(
+            quantity=Case(*(When(product_info_id=info_id, then=Value(quantity))
+                            for info_id, quantity in quantities.items()), output_field=PositiveIntegerField()))
+        if updated:
+            update_order_total(order.id)
+    return updated, results
+
+
+def delete_items(user_id, ids):
+    """
+    Удаляет товары из корзины пользователя одним DELETE по списку ИД предложений.
+    Возвращает количество удаленных позиций
+    """
+    with transaction.atomic():
+        order, _ = Order.objects.get_or_create(user_id=user_id, status='basket')
+        deleted = OrderItem.objects.filter(order_id=order.id, product_info_id__in=ids).delete()[0]
+        if deleted:
+            update_order_total(order.id)
+    return deleted
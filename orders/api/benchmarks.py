@@ -0,0 +1,274 @@
+import csv
+import io
+import random
+import time
+import tracemalloc
+from contextlib import ExitStack
+
+import ujson
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import Prefetch
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from api.catalog import catalog_products, offer_rows
+from api.importer import IMPORTERS, autocommit_db
+from api.models import CatalogOffer, Category, Order, OrderItem, Parameter, Product, ProductInfo, ProductParameter, \
+    Shop, User
+from api.renderers import UJSONRenderer, UJSONParser
+from api.price_lists import read_price_list, detect_format, digest_stream, msgpack, CSV_COLUMNS, \
+    PriceListFormatError
+from api.representations import ORDER_FIELDS, order_representations
+from api.serializers import OrderSerializer, ProductSerializer
+from api.tasks import check_price_list
+from api.totals import update_order_totals
+from api.validation import PriceListValidationError
+
+# Синтетические категории получают ИД начиная с этого значения, чтобы не пересекаться с настоящими
+BENCH_CATEGORY_ID = 10 ** 9
+BENCH_SHOP_NAME = 'Бенчмарк'
+BENCH_PARAMETER_PREFIX = 'Бенчмарк параметр'
+BENCH_USER_EMAIL = 'bench@bench.invalid'
+
+COLORS = ['черный', 'белый', 'красный', 'синий', 'золотистый', 'серебристый']
+
+
+def synthetic_goods(goods, parameters, categories, seed):
+    rnd = random.Random(seed)
+    for index in range(goods):
+        price = rnd.randint(100, 200000)
+        yield {
+            'id': index + 1,
+            'category': BENCH_CATEGORY_ID + index % categories,
+            'model': f'bench/model-{index % 1000}',
+            'name': f'Товар {index}',
+            'price': price,
+            'price_rrc': price + rnd.randint(0, 10000),
+            'quantity': rnd.randint(0, 100),
+            'parameters': {f'{BENCH_PARAMETER_PREFIX} {parameter}':
+                           rnd.choice(COLORS) if parameter % 2 else rnd.randint(1, 1024)
+                           for parameter in range(parameters)},
+        }
+
+
+def generate_price_list(stream, goods, parameters=4, categories=10, seed=0, price_list_format='yaml'):
+    """
+    Пишет в бинарный поток синтетический прайс со схемой data/shop1.yaml в одном из
+    поддерживаемых форматов с заданным количеством товаров, параметров у товара и категорий
+    """
+    header = {'shop': BENCH_SHOP_NAME,
+              'categories': [{'id': BENCH_CATEGORY_ID + index, 'name': f'Категория {index}'}
+                             for index in range(categories)]}
+    items = synthetic_goods(goods, parameters, categories, seed)
+    if price_list_format == 'yaml':
+        text = io.TextIOWrapper(stream, encoding='utf-8')
+        text.write(f"shop: {header['shop']}\ncategories:\n")
+        for category in header['categories']:
+            text.write(f"  - id: {category['id']}\n    name: {category['name']}\n")
+        text.write('goods:\n')
+        for item in items:
+            text.write(''.join([f'  - id: {item["id"]}\n    category: {item["category"]}\n',
+                                f'    model: {item["model"]}\n    name: {item["name"]}\n',
+                                f'    price: {item["price"]}\n    price_rrc: {item["price_rrc"]}\n',
+                                f'    quantity: {item["quantity"]}\n    parameters:\n',
+                                *(f'      "{name}": {value}\n' for name, value in item['parameters'].items())]))
+        text.detach()
+    elif price_list_format == 'jsonl':
+        stream.write(ujson.dumps(header, ensure_ascii=False).encode() + b'\n')
+        for item in items:
+            stream.write(ujson.dumps(item, ensure_ascii=False).encode() + b'\n')
+    elif price_list_format == 'msgpack' and msgpack is not None:
+        packer = msgpack.Packer()
+        stream.write(packer.pack(header))
+        for item in items:
+            stream.write(packer.pack(item))
+    elif price_list_format == 'csv':
+        names = {category['id']: category['name'] for category in header['categories']}
+        text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        parameter_names = [f'{BENCH_PARAMETER_PREFIX} {parameter}' for parameter in range(parameters)]
+        writer.writerow([*CSV_COLUMNS, *parameter_names])
+        for item in items:
+            writer.writerow([header['shop'], item['category'], names[item['category']], item['id'], item['model'],
+                             item['name'], item['price'], item['price_rrc'], item['quantity'],
+                             *(item['parameters'][name] for name in parameter_names)])
+        text.detach()
+    else:
+        raise PriceListFormatError(f'Генератор не поддерживает формат {price_list_format}')
+
+
+class QueryCounter:
+    """
+    Обертка выполнения запросов, которая только считает их, не сохраняя текст SQL
+    """
+
+    def __init__(self):
+        self.queries = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+
+def benchmark_import(path, mode='full', trace_memory=True):
+    """
+    Импортирует прайс из файла тем же путем, что и задача импорта: хеш содержимого, проверка
+    прайса целиком, потоковое чтение и импортер. Возвращает общее время и время проверки,
+    количество запросов, скорость и пиковое потребление памяти. Проверка хеша не прерывает
+    повторный импорт того же прайса. Отслеживание памяти через tracemalloc заметно замедляет
+    импорт, его можно отключить
+    """
+    counter = QueryCounter()
+    price_list_format = detect_format(path)
+    with ExitStack() as stack:
+        for alias in {DEFAULT_DB_ALIAS, autocommit_db()}:
+            stack.enter_context(connections[alias].execute_wrapper(counter))
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        with open(path, 'rb') as stream:
+            digest_stream(stream)
+            stream.seek(0)
+            report = check_price_list(stream, price_list_format)
+            validated = time.perf_counter()
+            if not report['valid']:
+                raise PriceListValidationError(report)
+            data = read_price_list(stream, price_list_format)
+            shop, _ = Shop.objects.get_or_create(name=data['shop'], defaults={'url': 'https://bench.invalid/'})
+            stats = IMPORTERS[mode](shop).run(data)
+        elapsed = time.perf_counter() - started
+        peak = None
+        if trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    rows = sum(stats[key] for key in ('inserted', 'updated', 'unchanged') if key in stats)
+    return {
+        'mode': mode,
+        'format': price_list_format,
+        'seconds': round(elapsed, 3),
+        'validate_seconds': round(validated - started, 3),
+        'queries': counter.queries,
+        'rows': rows,
+        'rows_per_second': round(rows / elapsed, 1) if elapsed else 0,
+        'peak_memory_bytes': peak,
+        'stats': stats,
+    }
+
+
+def create_orders(orders, items, seed=0):
+    """
+    Создает пользователю бенчмарка заказы из случайных предложений магазина бенчмарка
+    """
+    rnd = random.Random(seed)
+    user, _ = User.objects.get_or_create(email=BENCH_USER_EMAIL, defaults={'username': BENCH_USER_EMAIL})
+    offers = list(ProductInfo.objects.filter(shop__name=BENCH_SHOP_NAME).values_list('id', flat=True))
+    created = Order.objects.bulk_create([Order(user=user, status='new') for _ in range(orders)])
+    OrderItem.objects.bulk_create([OrderItem(order_id=order.id, product_info_id=info_id, quantity=rnd.randint(1, 5))
+                                   for order in created
+                                   for info_id in rnd.sample(offers, min(items, len(offers)))])
+    update_order_totals(Order.objects.filter(user=user))
+    return user
+
+
+def legacy_products():
+    """
+    Продукты с предложениями через вложенные сериализаторы по нормализованным таблицам
+    """
+    products = Product.objects.filter(product_infos__isnull=False).distinct().order_by('id').prefetch_related(
+        Prefetch('product_infos', queryset=ProductInfo.objects.order_by('id').select_related('shop').prefetch_related(
+            Prefetch('product_parameters', queryset=ProductParameter.objects.order_by('id').select_related(
+                'parameter')))))
+    return ProductSerializer(products, many=True).data
+
+
+def fast_products():
+    return catalog_products(offer_rows(CatalogOffer.objects.order_by('product_id', 'product_info_id')))
+
+
+def user_orders(user):
+    return Order.objects.filter(user=user).order_by('-dt', '-id')
+
+
+def legacy_orders(user):
+    """
+    Заказы через OrderSerializer с предзагрузкой позиций, предложений и параметров
+    """
+    orders = user_orders(user).prefetch_related(
+        Prefetch('ordered_items', queryset=OrderItem.objects.order_by('id').select_related(
+            'product_info__shop').prefetch_related(
+            Prefetch('product_info__product_parameters', queryset=ProductParameter.objects.order_by('id')
+                     .select_related('parameter')))))
+    return OrderSerializer(orders, many=True).data
+
+
+def fast_orders(user):
+    return order_representations(list(user_orders(user).values(*ORDER_FIELDS)))
+
+
+def best_time(function, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = JSONRenderer().render(function())
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark_rendering(user, repeat=5):
+    """
+    Сравнивает построение и рендеринг JSON через сериализаторы и через быстрый путь по values()
+    для каталога и списка заказов: лучшее время из repeat запусков, размер ответа и совпадение байтов
+    """
+    cases = {
+        'catalog': (legacy_products, fast_products),
+        'orders': (lambda: legacy_orders(user), lambda: fast_orders(user)),
+    }
+    results = []
+    for name, (legacy, fast) in cases.items():
+        legacy_seconds, legacy_content = best_time(legacy, repeat)
+        fast_seconds, fast_content = best_time(fast, repeat)
+        results.append({
+            'case': name,
+            'serializer_seconds': round(legacy_seconds, 4),
+            'fast_seconds': round(fast_seconds, 4),
+            'speedup': round(legacy_seconds / fast_seconds, 2) if fast_seconds else None,
+            'bytes': len(fast_content),
+            'identical': legacy_content == fast_content,
+        })
+    return results
+
+
+def benchmark_json(repeat=5):
+    """
+    Сравнивает стандартные JSONRenderer/JSONParser DRF с ujson на ответе каталога:
+    лучшее время из repeat запусков, размер ответа и пропускная способность в МБ/с
+    """
+    data = fast_products()
+    results = {}
+    for name, renderer, parser in (('stdlib', JSONRenderer(), JSONParser()), ('ujson', UJSONRenderer(), UJSONParser())):
+        render_times, parse_times = [], []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            content = renderer.render(data)
+            rendered = time.perf_counter()
+            parser.parse(io.BytesIO(content))
+            render_times.append(rendered - started)
+            parse_times.append(time.perf_counter() - rendered)
+        render_seconds, parse_seconds = min(render_times), min(parse_times)
+        results[name] = {'render_seconds': round(render_seconds, 4), 'parse_seconds': round(parse_seconds, 4),
+                         'bytes': len(content),
+                         'render_mb_per_second': round(len(content) / render_seconds / 2 ** 20, 1)}
+    results['render_speedup'] = round(results['stdlib']['render_seconds'] / results['ujson']['render_seconds'], 2)
+    results['parse_speedup'] = round(results['stdlib']['parse_seconds'] / results['ujson']['parse_seconds'], 2)
+    return results
+
+
+def cleanup_benchmark():
+    """
+    Удаляет данные, созданные бенчмарком
+    """
+    User.objects.filter(email=BENCH_USER_EMAIL).delete()
+    Shop.objects.filter(name=BENCH_SHOP_NAME).delete()
+    Category.objects.filter(id__gte=BENCH_CATEGORY_ID).delete()
+    Parameter.objects.filter(name__startswith=BENCH_PARAMETER_PREFIX).delete()
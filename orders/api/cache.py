@@ -0,0 +1,81 @@
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Max, Sum
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from api.models import Shop
+from api.shops import closed_shop_ids
+
+
+def catalog_version():
+    """
+    Версия каталога целиком - один агрегирующий запрос по магазинам (количество, наибольший ИД,
+    сумма версий) и ИД магазинов, не принимающих заказы. Версия магазина только растет и
+    увеличивается в транзакции импорта, поэтому после его фиксации сумма меняется и ключи
+    прежних ответов больше не строятся
+    """
+    shops = Shop.objects.order_by().aggregate(count=Count('id'), last=Max('id'), versions=Sum('catalog_version'))
+    closed = ','.join(map(str, sorted(closed_shop_ids())))
+    return f'{shops["count"]}:{shops["last"]}:{shops["versions"]};closed:{closed}'
+
+
+def stock_period():
+    """
+    Номер текущего интервала длиной CATALOG_STOCK_TTL секунд. Оформление и отмена заказов меняют
+    количество в витрине, не увеличивая версию каталога, поэтому остатки в кешированных ответах
+    отстают от склада не больше чем на этот интервал
+    """
+    return int(time.time() // settings.CATALOG_STOCK_TTL)
+
+
+def catalog_digest(request, renderer_format):
+    """
+    Хеш версии каталога, интервала остатков, полного адреса запроса с упорядоченными параметрами
+    и формата ответа. Служит ключом кеша
+    """
+    query = sorted((key, sorted(values)) for key, values in request.GET.lists())
+    source = (f'{catalog_version()}|{stock_period()}|{request.build_absolute_uri(request.path)}|{query}|'
+              f'{renderer_format}')
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
+def content_etag(data, renderer_format):
+    """
+    ETag ответа - хеш его данных и формата. Интервал остатков в него не входит: если за интервал
+    остатки не изменились, клиент с прежним ETag по-прежнему получает 304
+    """
+    body = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True, ensure_ascii=False)
+    return quote_etag(hashlib.sha1(f'{renderer_format}|{body}'.encode()).hexdigest())
+
+
+class CatalogCacheMixin:
+    """
+    Кеширование ответов list каталога с версией каталога в ключе: импорт делает прежние записи
+    недостижимыми без явной очистки. Вместе с данными в кеше хранится их ETag, на совпавший
+    If-None-Match отвечает 304, не формируя ответ
+    """
+
+    def list(self, request, *args, **kwargs):
+        renderer_format = request.accepted_renderer.format
+        cache = caches[settings.CATALOG_CACHE_ALIAS]
+        key = f'catalog:{catalog_digest(request, renderer_format)}'
+        entry = cache.get(key)
+        if entry is None:
+            data = self.catalog_data(request, *args, **kwargs)
+            entry = (content_etag(data, renderer_format), data)
+            cache.set(key, entry, settings.CATALOG_CACHE_TIMEOUT)
+        etag, data = entry
+        if_none_match = parse_etags(request.headers.get('If-None-Match', ''))
+        if etag in if_none_match or '*' in if_none_match:
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        return Response(data, headers={'ETag': etag})
+
+    def catalog_data(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs).data
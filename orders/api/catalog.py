@@ -0,0 +1,151 @@
+from collections import defaultdict
+
+from django.db.models import F
+
+from api.facets import save_postings, update_postings
+from api.fields import selected, select_fields
+from api.models import CatalogOffer, ProductInfo, ProductParameter, Shop
+from api.search import search_text
+from api.shops import open_offers
+
+CATALOG_BATCH_SIZE = 1000
+
+# Порядок предложений в списке категорий: продукты по убыванию названия, как у Product, внутри продукта - по id
+CATEGORY_OFFERS_ORDERING = ('-product_name', 'product_id', 'product_info_id')
+
+# Поля ProductInfo, из которых строится строка витрины
+OFFER_SOURCE_FIELDS = ('id', 'product_id', 'product__category_id', 'product__name', 'model', 'quantity', 'price',
+                       'price_rrc')
+
+# Поля витрины, из которых строится представление предложения
+OFFER_FIELDS = ('product_id', 'product_name', 'price', 'price_rrc', 'shop_name', 'quantity', 'parameters')
+
+
+def rebuild_catalog(shop, batch_size=CATALOG_BATCH_SIZE, offer_ids=None, categories_renamed=False):
+    """
+    Пересобирает витрину каталога для одного магазина: удаляет его предложения и заново записывает
+    их пачками вместе с параметрами, строит индекс фильтров магазина и увеличивает версию его каталога.
+    Снятые с продажи предложения (retired) в витрину и индекс фильтров не попадают, как и удаленные
+    полным импортом. С offer_ids (добавленные, измененные и снятые с продажи при инкрементальном
+    импорте) пересобираются только строки этих предложений и затронутые ими значения фильтров, а если
+    ничего не изменилось, версия остается прежней. Переименование категорий (categories_renamed) тоже
+    увеличивает версию: их названия отдаются вместе с витриной. Вызывается в транзакции импорта,
+    поэтому читатели видят либо прежнюю витрину и версию, либо новые. Возвращает True, если витрина
+    или версия изменились
+    """
+    if offer_ids is None:
+        Shop.objects.filter(id=shop.id).update(catalog_version=F('catalog_version') + 1)
+        CatalogOffer.objects.filter(shop_id=shop.id).delete()
+        offers = ProductInfo.objects.filter(shop_id=shop.id, retired=False).order_by('id').values_list(
+            *OFFER_SOURCE_FIELDS)
+        postings = defaultdict(list)
+        last_id = 0
+        while True:
+            rows = list(offers.filter(id__gt=last_id)[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            write_offers(shop, rows, postings)
+        save_postings(shop, postings)
+        return True
+
+    offer_ids = sorted(set(offer_ids))
+    renamed = CatalogOffer.objects.filter(shop_id=shop.id).exclude(shop_name=shop.name).update(shop_name=shop.name)
+    if not offer_ids and not renamed and not categories_renamed:
+        return False
+    Shop.objects.filter(id=shop.id).update(catalog_version=F('catalog_version') + 1)
+    postings, previous = defaultdict(list), set()
+    for start in range(0, len(offer_ids), batch_size):
+        ids = offer_ids[start:start + batch_size]
+        stored = CatalogOffer.objects.filter(product_info_id__in=ids)
+        for parameters in stored.values_list('parameters', flat=True):
+            previous.update((name, value) for name, value in parameters)
+        stored.delete()
+        write_offers(shop, list(ProductInfo.objects.filter(id__in=ids, retired=False).order_by('id')
+                                .values_list(*OFFER_SOURCE_FIELDS)), postings)
+    update_postings(shop, offer_ids, postings, previous)
+    return True
+
+
+def write_offers(shop, rows, postings):
+    """
+    Записывает строки витрины для пачки предложений (кортежи OFFER_SOURCE_FIELDS)
+    и добавляет их значения параметров в postings
+    """
+    parameters = defaultdict(list)
+    for info_id, name, value in ProductParameter.objects.filter(
+            product_info_id__in=[row[0] for row in rows]).order_by('id').values_list(
+            'product_info_id', 'parameter__name', 'value'):
+        parameters[info_id].append([name, value])
+        postings[(name, value)].append(info_id)
+    CatalogOffer.objects.bulk_create([
+        CatalogOffer(product_info_id=info_id, shop_id=shop.id, category_id=category_id, product_id=product_id,
+                     product_name=product_name, shop_name=shop.name, quantity=quantity, price=price,
+                     price_rrc=price_rrc, parameters=parameters[info_id],
+                     search_text=search_text(product_name, model, [value for _, value in parameters[info_id]]))
+        for info_id, product_id, category_id, product_name, model, quantity, price, price_rrc in rows
+    ])
+
+
+def offer_rows(queryset, parameters=True):
+    """
+    Строки витрины с полями OFFER_FIELDS без создания экземпляров модели.
+    Без parameters столбец с параметрами не читается
+    """
+    return queryset.values_list(*offer_fields(parameters), named=True)
+
+
+def offer_fields(parameters=True):
+    return OFFER_FIELDS if parameters else tuple(field for field in OFFER_FIELDS if field != 'parameters')
+
+
+def offer_representation(offer):
+    """
+    Предложение витрины (экземпляр или строка offer_rows) в формате ProductInfoSerializer
+    """
+    return {
+        'price': offer.price,
+        'price_rrc': offer.price_rrc,
+        'shop': {'name': offer.shop_name},
+        'quantity': offer.quantity,
+        'product_parameters': [{'parameter': {'name': name}, 'value': value}
+                               for name, value in getattr(offer, 'parameters', ())],
+    }
+
+
+def catalog_products(offers):
+    """
+    Группирует предложения витрины в продукты в формате ProductSerializer.
+    Продукты идут в порядке первого появления их предложений
+    """
+    products = {}
+    for offer in offers:
+        if offer.product_id not in products:
+            products[offer.product_id] = {'id': offer.product_id, 'name': offer.product_name, 'products_info': []}
+        products[offer.product_id]['products_info'].append(offer_representation(offer))
+    return list(products.values())
+
+
+def product_representations(offers, selection=None):
+    """
+    Продукты из запроса к витрине в формате ProductSerializer с учетом выбора полей
+    """
+    rows = offer_rows(offers, selected(selection, 'products_info', 'product_parameters'))
+    return select_fields(catalog_products(rows), selection)
+
+
+def catalog_categories(categories, selection=None):
+    """
+    Категории (словари с id и name) с продуктами в формате ProductListSerializer с учетом выбора полей.
+    Предложения всех категорий загружаются одним запросом и только если продукты входят в ответ,
+    предложения магазинов, не принимающих заказы, в ответ не попадают
+    """
+    offers = defaultdict(list)
+    if selected(selection, 'products'):
+        fields = offer_fields(selected(selection, 'products', 'products_info', 'product_parameters'))
+        category_offers = open_offers(CatalogOffer.objects.filter(
+            category_id__in=[category['id'] for category in categories])).order_by(*CATEGORY_OFFERS_ORDERING)
+        for offer in category_offers.values_list('category_id', *fields, named=True):
+            offers[offer.category_id].append(offer)
+    return select_fields([{'category': category['name'], 'products': catalog_products(offers[category['id']])}
+                          for category in categories], selection)
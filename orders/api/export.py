@@ -0,0 +1,91 @@
+import csv
+import io
+import zlib
+
+from django.conf import settings
+
+from api.models import CatalogOffer
+from api.renderers import dumps
+from api.shops import open_offers
+
+EXPORT_FIELDS = ('product_info_id', 'product_id', 'product_name', 'category_id', 'shop_id', 'shop_name', 'price',
+                 'price_rrc', 'quantity', 'parameters')
+CSV_HEADER = ('id', 'product_id', 'product', 'category_id', 'shop_id', 'shop', 'price', 'price_rrc', 'quantity',
+              'parameters')
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+
+def export_rows(shop_id=None, category_id=None):
+    """
+    Строки витрины для выгрузки в порядке ИД предложения. Читаются курсором на стороне сервера
+    пачками по EXPORT_CHUNK_SIZE, поэтому в памяти не держится больше одной пачки
+    """
+    offers = open_offers(CatalogOffer.objects.order_by('product_info_id'))
+    if shop_id is not None:
+        offers = offers.filter(shop_id=shop_id)
+    if category_id is not None:
+        offers = offers.filter(category_id=category_id)
+    return offers.values_list(*EXPORT_FIELDS).iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+
+
+def ndjson_lines(rows):
+    for info_id, product_id, product_name, category_id, shop_id, shop_name, price, price_rrc, quantity, \
+            parameters in rows:
+        yield dumps({'id': info_id, 'product_id': product_id, 'product': product_name, 'category_id': category_id,
+                     'shop_id': shop_id, 'shop': shop_name, 'price': price, 'price_rrc': price_rrc,
+                     'quantity': quantity, 'parameters': dict(parameters)}) + '\n'
+
+
+def csv_lines(rows):
+    """
+    Строки CSV: параметры предложения записываются в последний столбец как JSON-объект
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([*row[:-1], dumps(dict(row[-1]))])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def csv_export_lines(rows):
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(CSV_HEADER)
+    yield buffer.getvalue()
+    yield from csv_lines(rows)
+
+
+def export_chunks(lines, compress=False, chunk_size=None):
+    """
+    Склеивает строки выгрузки в куски около EXPORT_BUFFER_SIZE байт и при compress сжимает их gzip на лету
+    """
+    chunk_size = chunk_size or settings.EXPORT_BUFFER_SIZE
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    buffer, size = [], 0
+    for line in lines:
+        data = line.encode()
+        buffer.append(data)
+        size += len(data)
+        if size >= chunk_size:
+            chunk = b''.join(buffer)
+            buffer, size = [], 0
+            yield compressor.compress(chunk) if compressor else chunk
+    chunk = b''.join(buffer)
+    if compressor:
+        yield compressor.compress(chunk) + compressor.flush()
+    elif chunk:
+        yield chunk
+
+
+def export_catalog(export_format, shop_id=None, category_id=None, compress=False):
+    """
+    Генератор байтов выгрузки каталога в формате ndjson или csv
+    """
+    rows = export_rows(shop_id, category_id)
+    lines = ndjson_lines(rows) if export_format == 'ndjson' else csv_export_lines(rows)
+    return export_chunks(lines, compress)
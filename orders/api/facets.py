@@ -0,0 +1,132 @@
+import threading
+from collections import defaultdict
+
+from api.models import FacetPosting, Shop
+from api.shops import closed_shop_ids
+
+
+def save_postings(shop, postings):
+    """
+    Заменяет индекс фильтров магазина: postings - словарь (параметр, значение) -> список ИД предложений
+    """
+    FacetPosting.objects.filter(shop_id=shop.id).delete()
+    FacetPosting.objects.bulk_create([FacetPosting(shop_id=shop.id, parameter=parameter, value=value, offers=offers)
+                                      for (parameter, value), offers in postings.items()])
+
+
+def update_postings(shop, offer_ids, postings, previous):
+    """
+    Обновляет индекс фильтров магазина только для предложений offer_ids: postings - их новые значения
+    (параметр, значение) -> список ИД предложений, previous - значения, которые были у них раньше.
+    Остальные значения фильтров не читаются и не перезаписываются
+    """
+    keys = set(postings) | set(previous)
+    if not keys:
+        return
+    offer_ids = set(offer_ids)
+    stored = {(posting.parameter, posting.value): posting for posting in FacetPosting.objects.filter(
+        shop_id=shop.id, parameter__in={parameter for parameter, _ in keys}, value__in={value for _, value in keys})}
+    to_create, to_update, to_delete = [], [], []
+    for parameter, value in keys:
+        posting = stored.get((parameter, value))
+        offers = {offer_id for offer_id in (posting.offers if posting else ()) if offer_id not in offer_ids}
+        offers = sorted(offers.union(postings.get((parameter, value), ())))
+        if posting is None:
+            if offers:
+                to_create.append(FacetPosting(shop_id=shop.id, parameter=parameter, value=value, offers=offers))
+        elif not offers:
+            to_delete.append(posting.id)
+        elif offers != posting.offers:
+            posting.offers = offers
+            to_update.append(posting)
+    FacetPosting.objects.filter(id__in=to_delete).delete()
+    FacetPosting.objects.bulk_update(to_update, ['offers'])
+    FacetPosting.objects.bulk_create(to_create)
+
+
+def parse_facets(values):
+    """
+    Разбирает параметры запроса вида 'параметр:значение' в словарь параметр -> множество значений
+    """
+    facets = defaultdict(set)
+    for item in values:
+        parameter, separator, value = item.partition(':')
+        if separator and parameter.strip():
+            facets[parameter.strip()].add(value.strip())
+    return facets
+
+
+class FacetIndex:
+    """
+    Инвертированный индекс (параметр, значение) -> множество ИД предложений в памяти процесса.
+
+    Индекс хранится по магазинам вместе с версией каталога магазина. Перед каждым запросом версии
+    сверяются с БД одним запросом, и заново загружаются только магазины, прошедшие импорт.
+    Магазины, не принимающие заказы, остаются в индексе, но не участвуют в поиске и подсчете
+    """
+
+    def __init__(self):
+        self.shops = {}
+        self.closed = frozenset()
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        versions = dict(Shop.objects.values_list('id', 'catalog_version'))
+        with self.lock:
+            shops = {shop_id: shop for shop_id, shop in self.shops.items() if shop_id in versions}
+            changed = [shop_id for shop_id, version in versions.items()
+                       if shop_id not in shops or shops[shop_id][0] != version]
+            if changed:
+                # версии прочитаны до индекса, поэтому индекс может быть только новее версии
+                loaded = {shop_id: (versions[shop_id], {}) for shop_id in changed}
+                for shop_id, parameter, value, offers in FacetPosting.objects.filter(shop_id__in=changed).values_list(
+                        'shop_id', 'parameter', 'value', 'offers'):
+                    loaded[shop_id][1][(parameter, value)] = frozenset(offers)
+                shops.update(loaded)
+            self.shops = shops
+            self.closed = closed_shop_ids()
+
+    def open_shops(self):
+        return (postings for shop_id, (_, postings) in self.shops.items() if shop_id not in self.closed)
+
+    def postings(self):
+        for postings in self.open_shops():
+            yield from postings.items()
+
+    def offers(self, parameter, values):
+        result = set()
+        for postings in self.open_shops():
+            for value in values:
+                result.update(postings.get((parameter, value), ()))
+        return result
+
+    def search(self, facets, mode='and'):
+        """
+        Множество ИД предложений, подходящих под фильтры: значения одного параметра объединяются по ИЛИ,
+        разные параметры - по И (mode='and') или по ИЛИ (mode='or').
+        Без фильтров возвращает None - подходят все предложения
+        """
+        result = None
+        for parameter, values in facets.items():
+            offers = self.offers(parameter, values)
+            if result is None:
+                result = offers
+            elif mode == 'or':
+                result |= offers
+            else:
+                result &= offers
+        return result
+
+    def counts(self, result=None):
+        """
+        Количество предложений из result для каждого значения каждого параметра
+        """
+        counts = defaultdict(lambda: defaultdict(int))
+        for (parameter, value), offers in self.postings():
+            count = len(offers) if result is None else len(offers & result)
+            if count:
+                counts[parameter][value] += count
+        return {parameter: dict(values) for parameter, values in sorted(counts.items())}
+
+
+facet_index = FacetIndex()
@@ -0,0 +1,74 @@
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from requests import Session
+from requests.adapters import HTTPAdapter
+
+from api.price_lists import DigestReader, COPY_CHUNK_SIZE
+
+
+class FetchError(Exception):
+    """
+    Ошибка загрузки прайса по ссылке
+    """
+
+
+FetchResult = namedtuple('FetchResult', ['not_modified', 'digest', 'etag', 'last_modified', 'content_type'])
+
+_session = None
+
+
+def get_session():
+    """
+    Сессия с пулом соединений, одна на процесс
+    """
+    global _session
+    if _session is None:
+        _session = Session()
+        adapter = HTTPAdapter(pool_connections=settings.IMPORT_FETCH_POOL_SIZE,
+                              pool_maxsize=settings.IMPORT_FETCH_POOL_SIZE)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+def fetch_price_list(url, target, etag='', last_modified=''):
+    """
+    Загружает прайс по ссылке в файл target, считая хеш содержимого.
+
+    При известных ETag/Last-Modified запрос делается условным: если сервер ответил 304,
+    тело не загружается и возвращается результат с not_modified=True.
+    Размер тела и общее время загрузки ограничены настройками IMPORT_FETCH_MAX_SIZE
+    и IMPORT_FETCH_DEADLINE.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    max_size = settings.IMPORT_FETCH_MAX_SIZE
+    deadline = time.monotonic() + settings.IMPORT_FETCH_DEADLINE
+    with get_session().get(url, headers=headers, stream=True, timeout=settings.IMPORT_FETCH_TIMEOUT) as response:
+        if response.status_code == 304:
+            return FetchResult(True, None, etag, last_modified, '')
+        if response.status_code != 200:
+            raise FetchError(f'Сервер вернул статус {response.status_code}')
+        if int(response.headers.get('Content-Length') or 0) > max_size:
+            raise FetchError(f'Размер прайса превышает {max_size} байт')
+
+        response.raw.decode_content = True
+        reader = DigestReader(response.raw)
+        while True:
+            chunk = reader.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            if reader.size > max_size:
+                raise FetchError(f'Размер прайса превышает {max_size} байт')
+            if time.monotonic() > deadline:
+                raise FetchError('Превышено время загрузки прайса')
+            target.write(chunk)
+
+        return FetchResult(False, reader, response.headers.get('ETag', ''), response.headers.get('Last-Modified', ''),
+                           response.headers.get('Content-Type', ''))
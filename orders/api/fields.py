@@ -0,0 +1,106 @@
+from rest_framework.fields import SerializerMethodField
+from rest_framework.serializers import BaseSerializer
+
+
+def parse_paths(value):
+    """
+    Разбирает список путей через запятую ('id,ordered_items.quantity') в дерево словарей
+    """
+    tree = {}
+    for path in value.split(','):
+        node = tree
+        for name in path.strip().split('.'):
+            if name:
+                node = node.setdefault(name, {})
+    return tree
+
+
+def is_nested(value):
+    return isinstance(value, (dict, list))
+
+
+class FieldSelection:
+    """
+    Выбор полей ответа по параметрам запроса fields и expand.
+
+    fields - перечень полей, через точку задаются поля вложенных объектов (ordered_items.quantity);
+    без fields отдаются все простые поля. Вложенные объекты и списки отдаются, только если
+    они перечислены в fields или в expand (expand=ordered_items.product), поэтому их можно
+    не загружать из БД. Без обоих параметров ответ не меняется, выбор не применяется (None)
+    """
+
+    def __init__(self, fields=None, expand=None):
+        self.fields = fields or None
+        self.expand = expand or {}
+
+    @classmethod
+    def from_request(cls, request):
+        if request is None:
+            return None
+        params = request.query_params if hasattr(request, 'query_params') else request.GET
+        if 'fields' not in params and 'expand' not in params:
+            return None
+        return cls(parse_paths(params.get('fields', '')), parse_paths(params.get('expand', '')))
+
+    def includes(self, name, nested=False):
+        if self.fields is not None:
+            return name in self.fields or nested and name in self.expand
+        return not nested or name in self.expand
+
+    def child(self, name):
+        return FieldSelection(self.fields.get(name) if self.fields else None, self.expand.get(name))
+
+
+def selected(selection, *path):
+    """
+    Входит ли в ответ вложенный объект по пути path: от него зависит, нужно ли загружать его из БД
+    """
+    for name in path:
+        if selection is None:
+            return True
+        if not selection.includes(name, nested=True):
+            return False
+        selection = selection.child(name)
+    return True
+
+
+def descend(selection, *path):
+    for name in path:
+        if selection is None:
+            return None
+        selection = selection.child(name)
+    return selection
+
+
+def select_fields(data, selection):
+    """
+    Оставляет в готовом представлении (словарь или список словарей) только выбранные поля
+    """
+    if selection is None:
+        return data
+    if isinstance(data, list):
+        return [select_fields(item, selection) for item in data]
+    return {name: select_fields(value, selection.child(name)) if is_nested(value) else value
+            for name, value in data.items() if selection.includes(name, is_nested(value))}
+
+
+class SparseFieldsMixin:
+    """
+    Применяет к сериализатору и его вложенным сериализаторам выбор полей из запроса в контексте
+    """
+
+    def get_fields(self):
+        fields = super().get_fields()
+        selection = self.field_selection()
+        if selection is None:
+            return fields
+        return {name: field for name, field in fields.items()
+                if selection.includes(name, isinstance(field, (BaseSerializer, SerializerMethodField)))}
+
+    def field_selection(self):
+        path, node = [], self
+        while node.parent is not None:
+            if node.field_name:
+                path.append(node.field_name)
+            node = node.parent
+        return descend(FieldSelection.from_request(node.context.get('request')), *reversed(path))
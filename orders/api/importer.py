@@ -0,0 +1,360 @@
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction, DEFAULT_DB_ALIAS
+from django.db.models import Q
+
+from api.catalog import rebuild_catalog
+from api.models import Category, Order, Product, ProductInfo, Parameter, ProductParameter, Shop
+from api.totals import shop_baskets, update_order_totals
+
+IMPORT_BATCH_SIZE = 1000
+
+PRODUCT_INFO_FIELDS = ['product_id', 'external_id', 'model', 'price', 'price_rrc', 'quantity', 'retired']
+
+
+def chunked(iterable, size):
+    """
+    Разбивает итерируемый объект на списки длиной не более size
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def autocommit_db():
+    """
+    Псевдоним БД для записей, фиксируемых независимо от транзакции импорта магазина
+    """
+    return settings.IMPORT_AUTOCOMMIT_DB or DEFAULT_DB_ALIAS
+
+
+class PriceListImporter:
+    """
+    Загрузка прайса поставщика пакетными запросами.
+
+    Категории, продукты и параметры сопоставляются с уже существующими несколькими запросами
+    на пачку товаров, а ProductInfo и ProductParameter записываются через bulk_create/bulk_update.
+    Позиции магазина и его витрина каталога записываются в одной транзакции. Общие справочники
+    (категории, продукты, параметры) пополняются короткими транзакциями через соединение autocommit_db в порядке
+    сортировки ключей и без ошибок на дублях, поэтому параллельные импорты разных магазинов
+    не блокируют друг друга и не создают повторяющихся записей. Импорты одного магазина выполняются
+    по очереди под блокировкой строки магазина. Сохраненные суммы корзин с предложениями магазина
+    пересчитываются в той же транзакции.
+    """
+
+    def __init__(self, shop, batch_size=IMPORT_BATCH_SIZE, progress=None):
+        self.shop = shop
+        self.batch_size = batch_size
+        self.progress = progress
+        self.rows_processed = 0
+        self.products = {}
+        self.parameters = {}
+        self.stats = {'inserted': 0, 'updated': 0, 'deleted': 0}
+
+    def run(self, data):
+        """
+        Импортирует документ вида {'shop': ..., 'categories': [...], 'goods': [...]}
+        и возвращает количество добавленных, обновленных и удаленных позиций
+        """
+        with transaction.atomic():
+            self.lock_shop()
+            baskets = shop_baskets(self.shop.id)
+            self.import_categories(data['categories'])
+            stored = list(ProductInfo.objects.filter(shop_id=self.shop.id).values_list('id', flat=True))
+            seen = set()
+            for goods in chunked(data['goods'], self.batch_size):
+                seen.update(self.import_goods(goods))
+                self.report_progress(len(goods))
+            stale = [info_id for info_id in stored if info_id not in seen]
+            for ids in chunked(stale, self.batch_size):
+                ProductInfo.objects.filter(id__in=ids).delete()
+            self.stats['deleted'] = len(stale)
+            rebuild_catalog(self.shop, self.batch_size)
+            if baskets:
+                update_order_totals(Order.objects.filter(id__in=baskets))
+        return self.stats
+
+    def lock_shop(self):
+        # импорты одного магазина выполняются по очереди: параллельный импорт сопоставлял бы позиции
+        # без незафиксированных строк соседа и падал на unique_product_info
+        Shop.objects.select_for_update().filter(id=self.shop.id).first()
+
+    def report_progress(self, rows):
+        self.rows_processed += rows
+        if self.progress:
+            self.progress(self.rows_processed)
+
+    def import_categories(self, categories):
+        """
+        Добавляет новые категории через autocommit_db, а переименовывает существующие в транзакции
+        импорта: если импорт не завершится, прежние названия сохранятся. Возвращает True,
+        если названия категорий изменились
+        """
+        db = autocommit_db()
+        names = {category['id']: category['name'] for category in categories}
+        existing = set(Category.objects.using(db).filter(id__in=names).values_list('id', flat=True))
+        Category.objects.using(db).bulk_create([Category(id=category_id, name=names[category_id])
+                                                for category_id in sorted(names.keys() - existing)],
+                                               ignore_conflicts=True)
+        renamed = [Category(id=category_id, name=names[category_id]) for category_id, name in
+                   Category.objects.filter(id__in=existing).order_by('id').values_list('id', 'name')
+                   if name != names[category_id]]
+        Category.objects.bulk_update(renamed, ['name'], batch_size=self.batch_size)
+        Category.shops.through.objects.bulk_create(
+            [Category.shops.through(category_id=category_id, shop_id=self.shop.id) for category_id in names],
+            ignore_conflicts=True)
+        return bool(renamed)
+
+    def resolve_products(self, goods):
+        # кэш продуктов живет в пределах пачки, чтобы память не росла вместе с размером прайса
+        keys = {(item['name'], item['category']) for item in goods}
+        self.products = {}
+        if keys:
+            db = autocommit_db()
+            self.products.update(self.find_products(db, keys))
+            missing = keys - self.products.keys()
+            if missing:
+                Product.objects.using(db).bulk_create([Product(name=name, category_id=category_id)
+                                                       for name, category_id in sorted(missing)],
+                                                      ignore_conflicts=True)
+                self.products.update(self.find_products(db, missing))
+
+    @staticmethod
+    def find_products(db, keys):
+        found = Product.objects.using(db).filter(name__in={name for name, _ in keys}).values_list('name',
+                                                                                                  'category_id', 'id')
+        return {(name, category_id): product_id for name, category_id, product_id in found
+                if (name, category_id) in keys}
+
+    def resolve_parameters(self, goods):
+        names = {name for item in goods for name in item['parameters']} - self.parameters.keys()
+        if names:
+            db = autocommit_db()
+            self.parameters.update(Parameter.objects.using(db).filter(name__in=names).values_list('name', 'id'))
+            missing = names - self.parameters.keys()
+            if missing:
+                Parameter.objects.using(db).bulk_create([Parameter(name=name) for name in sorted(missing)],
+                                                        ignore_conflicts=True)
+                self.parameters.update(Parameter.objects.using(db).filter(name__in=missing).values_list('name', 'id'))
+
+    def match_stored(self, goods):
+        """
+        Сопоставляет пачку с сохраненными позициями магазина, возвращает список позиций (None - новый товар)
+        в порядке товаров. Сначала позиция ищется по продукту: у магазина одна позиция на продукт
+        (unique_product_info), поэтому смена внешнего ИД или обмен названиями между ИД не создают вторую строку
+        того же продукта. Позиция без продукта из пачки ищется по внешнему ИД - так переименованный товар
+        сохраняет свою позицию
+        """
+        external_ids = [item['id'] for item in goods]
+        product_ids = [self.products[(item['name'], item['category'])] for item in goods]
+        by_external_id, by_product = {}, {}
+        for product_info in ProductInfo.objects.filter(Q(external_id__in=external_ids) | Q(product_id__in=product_ids),
+                                                       shop_id=self.shop.id):
+            by_product[product_info.product_id] = product_info
+            if product_info.external_id is not None:
+                by_external_id[product_info.external_id] = product_info
+
+        matched = [by_product.get(product_id) for product_id in product_ids]
+        claimed = {product_info.id for product_info in matched if product_info is not None}
+        for index, item in enumerate(goods):
+            product_info = by_external_id.get(item['id'])
+            if matched[index] is None and product_info is not None and product_info.id not in claimed:
+                matched[index] = product_info
+                claimed.add(product_info.id)
+        return matched
+
+    def release_external_ids(self, goods, matched):
+        """
+        Снимает внешние ИД пачки с позиций, которым они больше не принадлежат (смена ИД, обмен названиями),
+        чтобы запись пачки не нарушила unique_product_info_external_id
+        """
+        kept = [product_info.id for product_info, item in zip(matched, goods)
+                if product_info is not None and product_info.external_id == item['id']]
+        ProductInfo.objects.filter(shop_id=self.shop.id, external_id__in=[item['id'] for item in goods]).exclude(
+            id__in=kept).update(external_id=None)
+
+    def import_goods(self, goods):
+        """
+        Записывает пачку товаров, возвращает id записанных ProductInfo. Сопоставленные позиции
+        (см. match_stored) обновляются на месте
+        """
+        self.resolve_products(goods)
+        self.resolve_parameters(goods)
+        matched = self.match_stored(goods)
+        self.release_external_ids(goods, matched)
+
+        to_create, to_update, written = [], [], []
+        for item, stored in zip(goods, matched):
+            product_info = ProductInfo(product_id=self.products[(item['name'], item['category'])],
+                                       shop_id=self.shop.id,
+                                       external_id=item['id'],
+                                       model=item['model'],
+                                       price=item['price'],
+                                       price_rrc=item['price_rrc'],
+                                       quantity=item['quantity'])
+            if stored is None:
+                to_create.append(product_info)
+            else:
+                product_info.id = stored.id
+                to_update.append(product_info)
+            written.append((product_info, item))
+        ProductInfo.objects.bulk_create(to_create, batch_size=self.batch_size)
+        ProductInfo.objects.bulk_update(to_update, PRODUCT_INFO_FIELDS, batch_size=self.batch_size)
+        self.stats['inserted'] += len(to_create)
+        self.stats['updated'] += len(to_update)
+
+        ProductParameter.objects.filter(product_info_id__in=[product_info.id for product_info in to_update]).delete()
+        if to_create:
+            created = dict(ProductInfo.objects.filter(shop_id=self.shop.id, external_id__in=[
+                product_info.external_id for product_info in to_create]).values_list('external_id', 'id'))
+            for product_info in to_create:
+                product_info.id = created[product_info.external_id]
+        ProductParameter.objects.bulk_create([ProductParameter(product_info_id=product_info.id,
+                                                               parameter_id=self.parameters[name],
+                                                               value=value)
+                                              for product_info, item in written
+                                              for name, value in item['parameters'].items()],
+                                             batch_size=self.batch_size)
+        return [product_info.id for product_info, _ in written]
+
+
+class DiffPriceListImporter(PriceListImporter):
+    """
+    Инкрементальная загрузка прайса по внешнему ИД товара (goods[].id).
+
+    Сохраненные позиции магазина сравниваются с пришедшими: добавляются только новые,
+    обновляются только изменившиеся цена/количество/параметры, а пропавшие из прайса
+    снимаются с продажи (количество обнуляется, позиция отмечается retired, заказы на них сохраняются).
+    Объем записи пропорционален объему изменений, а не размеру каталога: в витрине
+    пересобираются только строки позиций из changed.
+    """
+
+    def __init__(self, shop, batch_size=IMPORT_BATCH_SIZE, progress=None):
+        super().__init__(shop, batch_size, progress)
+        self.stats = {'inserted': 0, 'updated': 0, 'unchanged': 0, 'retired': 0}
+        self.changed = set()
+
+    def run(self, data):
+        with transaction.atomic():
+            self.lock_shop()
+            baskets = shop_baskets(self.shop.id)
+            categories_renamed = self.import_categories(data['categories'])
+            stored = list(ProductInfo.objects.filter(shop_id=self.shop.id).values_list('id', flat=True))
+            seen = set()
+            for goods in chunked(data['goods'], self.batch_size):
+                seen.update(self.import_goods(goods))
+                self.report_progress(len(goods))
+            stale = [info_id for info_id in stored if info_id not in seen]
+            for ids in chunked(stale, self.batch_size):
+                retired = list(ProductInfo.objects.filter(id__in=ids, retired=False).values_list('id', flat=True))
+                ProductInfo.objects.filter(id__in=retired).update(quantity=0, retired=True)
+                self.stats['retired'] += len(retired)
+                self.changed.update(retired)
+            rebuild_catalog(self.shop, self.batch_size, self.changed, categories_renamed)
+            if baskets:
+                update_order_totals(Order.objects.filter(id__in=baskets))
+        return self.stats
+
+    def load_stored(self, goods):
+        """
+        Загружает сохраненные позиции пачки (см. match_stored) вместе с их параметрами
+        """
+        matched = self.match_stored(goods)
+        parameters = {}
+        for pk, info_id, parameter_id, value in ProductParameter.objects.filter(
+                product_info_id__in=[product_info.id for product_info in matched if product_info]).values_list(
+                'id', 'product_info_id', 'parameter_id', 'value'):
+            parameters.setdefault(info_id, {})[parameter_id] = (pk, value)
+        return matched, parameters
+
+    def import_goods(self, goods):
+        """
+        Записывает изменения пачки товаров, возвращает id сопоставленных и созданных ProductInfo.
+        Новые и изменившиеся позиции запоминаются в changed
+        """
+        self.resolve_products(goods)
+        self.resolve_parameters(goods)
+        matched, stored_parameters = self.load_stored(goods)
+        self.release_external_ids(goods, matched)
+
+        to_create, to_update, new_parameters = [], [], {}
+        parameters_to_create, parameters_to_update, parameters_to_delete = [], [], []
+        seen = []
+        for item, product_info in zip(goods, matched):
+            product_id = self.products[(item['name'], item['category'])]
+            incoming = ProductInfo(product_id=product_id,
+                                   shop_id=self.shop.id,
+                                   external_id=item['id'],
+                                   model=item['model'],
+                                   price=item['price'],
+                                   price_rrc=item['price_rrc'],
+                                   quantity=item['quantity'])
+            parameters = {self.parameters[name]: str(value) for name, value in item['parameters'].items()}
+            if product_info is None:
+                to_create.append(incoming)
+                new_parameters[item['id']] = parameters
+                continue
+
+            seen.append(product_info.id)
+            changed = any(getattr(product_info, field) != getattr(incoming, field) for field in PRODUCT_INFO_FIELDS)
+            if changed:
+                incoming.id = product_info.id
+                to_update.append(incoming)
+            stored = stored_parameters.get(product_info.id, {})
+            for parameter_id, value in parameters.items():
+                if parameter_id not in stored:
+                    parameters_to_create.append(ProductParameter(product_info_id=product_info.id,
+                                                                 parameter_id=parameter_id, value=value))
+                    changed = True
+                elif stored[parameter_id][1] != value:
+                    parameters_to_update.append(ProductParameter(id=stored[parameter_id][0], value=value))
+                    changed = True
+            for parameter_id, (pk, _) in stored.items():
+                if parameter_id not in parameters:
+                    parameters_to_delete.append(pk)
+                    changed = True
+            self.stats['updated' if changed else 'unchanged'] += 1
+            if changed:
+                self.changed.add(product_info.id)
+
+        ProductInfo.objects.bulk_create(to_create, batch_size=self.batch_size)
+        ProductInfo.objects.bulk_update(to_update, PRODUCT_INFO_FIELDS, batch_size=self.batch_size)
+        self.stats['inserted'] += len(to_create)
+
+        if to_create:
+            created = dict(ProductInfo.objects.filter(shop_id=self.shop.id, external_id__in=new_parameters)
+                           .values_list('external_id', 'id'))
+            seen.extend(created.values())
+            self.changed.update(created.values())
+            parameters_to_create.extend(ProductParameter(product_info_id=created[external_id],
+                                                         parameter_id=parameter_id, value=value)
+                                        for external_id, parameters in new_parameters.items()
+                                        for parameter_id, value in parameters.items())
+        ProductParameter.objects.filter(id__in=parameters_to_delete).delete()
+        ProductParameter.objects.bulk_update(parameters_to_update, ['value'], batch_size=self.batch_size)
+        ProductParameter.objects.bulk_create(parameters_to_create, batch_size=self.batch_size)
+        return seen
+
+
+IMPORTERS = {
+    'full': PriceListImporter,
+    'diff': DiffPriceListImporter,
+}
+
+
+def import_report(stats):
+    """
+    Формирует ответ API по результатам импорта
+    """
+    report = {'Добавлено объектов': stats['inserted'],
+              'Обновлено объектов': stats['updated']}
+    if 'deleted' in stats:
+        report['Удалено объектов'] = stats['deleted']
+    if 'retired' in stats:
+        report['Без изменений'] = stats['unchanged']
+        report['Снято с продажи'] = stats['retired']
+    return report
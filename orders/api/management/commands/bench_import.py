@@ -0,0 +1,79 @@
+import json
+import os
+import platform
+from datetime import datetime, timezone
+from tempfile import NamedTemporaryFile
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.benchmarks import generate_price_list, benchmark_import, cleanup_benchmark
+from api.importer import IMPORTERS
+from api.price_lists import PRICE_LIST_FORMATS
+
+
+class Command(BaseCommand):
+    help = 'Замеряет скорость импорта синтетических прайсов разного размера. ' \
+           'Пишет в текущую БД, запускать на отдельной базе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000],
+                            help='Количество товаров в прайсах, например 1000 10000 100000 1000000')
+        parser.add_argument('--parameters', type=int, default=4, help='Параметров у товара')
+        parser.add_argument('--categories', type=int, default=10, help='Количество категорий')
+        parser.add_argument('--mode', choices=list(IMPORTERS), default='full', help='Режим импорта')
+        parser.add_argument('--formats', nargs='+', choices=list(PRICE_LIST_FORMATS), default=['yaml'],
+                            help='Форматы прайсов')
+        parser.add_argument('--reimport', action='store_true',
+                            help='Дополнительно замерить повторный импорт того же прайса')
+        parser.add_argument('--no-memory', action='store_true',
+                            help='Не отслеживать пиковую память (tracemalloc замедляет импорт)')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Файл для результатов в формате JSON (по умолчанию stdout)')
+
+    def handle(self, *args, **options):
+        results = []
+        for size in options['sizes']:
+            for price_list_format in options['formats']:
+                results.extend(self.run_benchmark(size, price_list_format, options))
+
+        report = {
+            'benchmark': 'import',
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'results': results,
+        }
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(output)
+        else:
+            self.stdout.write(output)
+
+    def run_benchmark(self, size, price_list_format, options):
+        cleanup_benchmark()
+        with NamedTemporaryFile('wb', suffix=f'.{price_list_format}', delete=False) as stream:
+            generate_price_list(stream, size, options['parameters'], options['categories'], options['seed'],
+                                price_list_format)
+        try:
+            runs = [benchmark_import(stream.name, options['mode'], not options['no_memory'])]
+            if options['reimport']:
+                runs.append(benchmark_import(stream.name, options['mode'], not options['no_memory']))
+        finally:
+            os.remove(stream.name)
+            cleanup_benchmark()
+
+        results = []
+        for run, result in zip(('initial', 'reimport'), runs):
+            results.append({'goods': size, 'parameters': options['parameters'],
+                            'categories': options['categories'], 'run': run, **result})
+            message = f"{size} товаров, {price_list_format} ({run}): {result['seconds']} с " \
+                      f"(проверка {result['validate_seconds']} с), {result['queries']} запросов, " \
+                      f"{result['rows_per_second']} позиций/с"
+            if result['peak_memory_bytes'] is not None:
+                message += f", {result['peak_memory_bytes'] // 1024} КиБ памяти"
+            self.stderr.write(message)
+        return results
@@ -0,0 +1,67 @@
+import json
+import os
+import platform
+from datetime import datetime, timezone
+from tempfile import NamedTemporaryFile
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from api.benchmarks import generate_price_list, benchmark_import, benchmark_rendering, benchmark_json, \
+    cleanup_benchmark, create_orders
+
+
+class Command(BaseCommand):
+    help = 'Сравнивает скорость построения ответов каталога и заказов через сериализаторы и через values(), ' \
+           'а также рендеринг JSON стандартным модулем и ujson. Пишет в текущую БД, запускать на отдельной базе'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--goods', type=int, default=1000, help='Количество товаров в каталоге')
+        parser.add_argument('--parameters', type=int, default=4, help='Параметров у товара')
+        parser.add_argument('--orders', type=int, default=100, help='Количество заказов')
+        parser.add_argument('--items', type=int, default=10, help='Позиций в заказе')
+        parser.add_argument('--repeat', type=int, default=5, help='Количество повторов, берется лучшее время')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='Файл для результатов в формате JSON (по умолчанию stdout)')
+
+    def handle(self, *args, **options):
+        cleanup_benchmark()
+        with NamedTemporaryFile('wb', suffix='.yaml', delete=False) as stream:
+            generate_price_list(stream, options['goods'], options['parameters'], seed=options['seed'])
+        try:
+            benchmark_import(stream.name, trace_memory=False)
+            user = create_orders(options['orders'], options['items'], options['seed'])
+            results = benchmark_rendering(user, options['repeat'])
+            json_results = benchmark_json(options['repeat'])
+        finally:
+            os.remove(stream.name)
+            cleanup_benchmark()
+
+        for result in results:
+            self.stderr.write(f"{result['case']}: сериализаторы {result['serializer_seconds']} с, "
+                              f"values {result['fast_seconds']} с, ускорение {result['speedup']}x, "
+                              f"совпадение байтов: {result['identical']}")
+        self.stderr.write(f"JSON каталога: рендеринг stdlib {json_results['stdlib']['render_seconds']} с, "
+                          f"ujson {json_results['ujson']['render_seconds']} с, ускорение "
+                          f"{json_results['render_speedup']}x, размер {json_results['stdlib']['bytes']} -> "
+                          f"{json_results['ujson']['bytes']} байт")
+        report = {
+            'benchmark': 'render',
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'goods': options['goods'],
+            'parameters': options['parameters'],
+            'orders': options['orders'],
+            'items': options['items'],
+            'results': results,
+            'json': json_results,
+        }
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(output)
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,47 @@
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.importer import IMPORTERS
+from api.tasks import import_source
+
+
+class Command(BaseCommand):
+    help = 'Параллельно импортирует прайсы нескольких магазинов из файлов или по ссылкам'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sources', nargs='+', help='Пути к файлам или ссылки на прайсы')
+        parser.add_argument('-p', '--processes', type=int, default=4, help='Количество процессов')
+        parser.add_argument('--mode', choices=list(IMPORTERS), default='full', help='Режим импорта')
+        parser.add_argument('--json', action='store_true', help='Вывести отчет в формате JSON')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        # дочерние процессы не должны наследовать открытые соединения с БД
+        connections.close_all()
+        reports = []
+        with ProcessPoolExecutor(max_workers=options['processes'], mp_context=get_context('fork')) as pool:
+            futures = [pool.submit(import_source, source, options['mode']) for source in options['sources']]
+            for future in as_completed(futures):
+                report = future.result()
+                reports.append(report)
+                if options['json']:
+                    continue
+                if report['status']:
+                    self.stdout.write(f"{report['source']} ({report['shop']}): {report['seconds']} с, "
+                                      f"{report['result']}")
+                else:
+                    self.stderr.write(f"{report['source']}: {report['seconds']} с, ошибка: {report['error']}")
+
+        elapsed = round(time.monotonic() - started, 3)
+        failed = sum(not report['status'] for report in reports)
+        if options['json']:
+            self.stdout.write(json.dumps({'seconds': elapsed, 'failed': failed, 'shops': reports},
+                                         ensure_ascii=False))
+        else:
+            self.stdout.write(f'Импортировано прайсов: {len(reports) - failed}, с ошибками: {failed}, '
+                              f'всего {elapsed} с')
@@ -0,0 +1,34 @@
+from multiprocessing import get_context
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from api.tasks import work
+
+
+class Command(BaseCommand):
+    help = 'Запускает воркеры, выполняющие задачи импорта прайсов из очереди'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-p', '--processes', type=int, default=1, help='Количество процессов-воркеров')
+        parser.add_argument('--poll-interval', type=float, help='Интервал опроса очереди, секунд')
+        parser.add_argument('--once', action='store_true', help='Завершиться, когда очередь опустеет')
+
+    def handle(self, *args, **options):
+        kwargs = {'once': options['once'], 'poll_interval': options['poll_interval']}
+        if options['processes'] <= 1:
+            work(**kwargs)
+            return
+
+        # дочерние процессы не должны наследовать открытые соединения с БД
+        connections.close_all()
+        context = get_context('fork')
+        workers = [context.Process(target=work, kwargs=kwargs) for _ in range(options['processes'])]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
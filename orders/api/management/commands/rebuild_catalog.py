@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.catalog import rebuild_catalog
+from api.models import Shop
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает витрину каталога для указанных или всех магазинов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('shops', nargs='*', type=int, help='ИД магазинов, по умолчанию все')
+
+    def handle(self, *args, **options):
+        shops = Shop.objects.order_by('id')
+        if options['shops']:
+            shops = shops.filter(id__in=options['shops'])
+        for shop in shops:
+            with transaction.atomic():
+                rebuild_catalog(shop)
+            self.stdout.write(f'{shop.name}: {shop.catalog_offers.count()} предложений')
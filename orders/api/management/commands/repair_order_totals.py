@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from api.models import Order
+from api.totals import update_order_totals
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает сохраненные суммы и количество позиций заказов по их позициям'
+
+    def add_arguments(self, parser):
+        parser.add_argument('orders', nargs='*', type=int, help='ИД заказов, по умолчанию все')
+        parser.add_argument('--status', action='append', help='Только заказы с этим статусом, можно повторять')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Заказов в одной транзакции')
+
+    def handle(self, *args, **options):
+        orders = Order.objects.order_by('id')
+        if options['orders']:
+            orders = orders.filter(id__in=options['orders'])
+        if options['status']:
+            orders = orders.filter(status__in=options['status'])
+        # заказы пересчитываются пачками по ИД, чтобы не держать блокировку на всей таблице
+        updated, last_id = 0, 0
+        while True:
+            ids = list(orders.filter(id__gt=last_id).values_list('id', flat=True)[:options['batch_size']])
+            if not ids:
+                break
+            with transaction.atomic():
+                updated += update_order_totals(Order.objects.filter(id__in=ids))
+            last_id = ids[-1]
+        self.stdout.write(f'Пересчитано заказов: {updated}')
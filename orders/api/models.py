@@ -3,6 +3,7 @@ from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.db import models
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from django_rest_passwordreset.tokens import get_token_generator
 
@@ -27,6 +28,18 @@ USER_TYPE_CHOICES = (
 
 )
 
+IMPORT_MODE_CHOICES = (
+    ('full', 'Полная загрузка'),
+    ('diff', 'Загрузка изменений'),
+)
+
+IMPORT_STATUS_CHOICES = (
+    ('queued', 'В очереди'),
+    ('running', 'Выполняется'),
+    ('done', 'Завершен'),
+    ('failed', 'Ошибка'),
+)
+
 
 # Create your models here.
 
@@ -151,6 +164,14 @@ class Shop(models.Model):
     filename = models.FileField(upload_to='shops', verbose_name='Файл с товарами магазина', blank=True, null=True)
     owner = models.OneToOneField(User, verbose_name='Управляющий магазином', blank=True, null=True,
                                  on_delete=models.DO_NOTHING)
+    import_hash = models.CharField(verbose_name='Хеш последнего загруженного прайса', max_length=64, blank=True)
+    import_size = models.PositiveBigIntegerField(verbose_name='Размер последнего загруженного прайса', blank=True,
+                                                 null=True)
+    import_etag = models.CharField(verbose_name='ETag последнего загруженного прайса', max_length=255, blank=True)
+    import_last_modified = models.CharField(verbose_name='Last-Modified последнего загруженного прайса', max_length=64,
+                                            blank=True)
+    catalog_version = models.PositiveIntegerField(verbose_name='Версия каталога', default=0)
+    state = models.BooleanField(verbose_name='статус получения заказов', default=True)
 
     class Meta:
         verbose_name = 'Магазин'
@@ -169,6 +190,9 @@ class Category(models.Model):
         verbose_name = 'Категория'
         verbose_name_plural = "Список категорий"
         ordering = ('-name',)
+        indexes = [
+            models.Index(fields=['name', 'id'], name='category_name'),
+        ]
 
     def __str__(self):
         return self.name
@@ -183,6 +207,9 @@ class Product(models.Model):
         verbose_name = 'Продукт'
         verbose_name_plural = "Список продуктов"
         ordering = ('-name',)
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'category'], name='unique_product'),
+        ]
 
     def __str__(self):
         return self.name
@@ -193,16 +220,19 @@ class ProductInfo(models.Model):
                                 on_delete=models.CASCADE)
     shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='product_infos', blank=True,
                              on_delete=models.CASCADE)
+    external_id = models.PositiveIntegerField(verbose_name='Внешний ИД', blank=True, null=True)
     model = models.CharField(max_length=80, verbose_name='Модель', blank=True)
     quantity = models.PositiveIntegerField(verbose_name='Количество')
     price = models.PositiveIntegerField(verbose_name='Цена')
     price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')
+    retired = models.BooleanField(verbose_name='Снято с продажи', default=False)
 
     class Meta:
         verbose_name = 'Информация о продукте'
         verbose_name_plural = "Информационный список о продуктах"
         constraints = [
             models.UniqueConstraint(fields=['product', 'shop'], name='unique_product_info'),
+            models.UniqueConstraint(fields=['shop', 'external_id'], name='unique_product_info_external_id'),
         ]
 
 
@@ -213,6 +243,9 @@ class Parameter(models.Model):
         verbose_name = 'Имя параметра'
         verbose_name_plural = "Список имен параметров"
         ordering = ('-name',)
+        constraints = [
+            models.UniqueConstraint(fields=['name'], name='unique_parameter'),
+        ]
 
     def __str__(self):
         return self.name
@@ -234,17 +267,69 @@ class ProductParameter(models.Model):
         ]
 
 
+class CatalogOffer(models.Model):
+    """
+    Денормализованная витрина каталога: одна строка на предложение магазина с названиями продукта
+    и магазина, параметрами в JSON и текстом для поиска. Обновляется для магазина в конце каждого импорта
+    """
+    product_info = models.OneToOneField(ProductInfo, verbose_name='Информация о продукте', primary_key=True,
+                                        related_name='catalog_offer', on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='catalog_offers', on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='catalog_offers',
+                                 on_delete=models.CASCADE)
+    product = models.ForeignKey(Product, verbose_name='Продукт', related_name='catalog_offers',
+                                on_delete=models.CASCADE)
+    product_name = models.CharField(max_length=80, verbose_name='Название продукта')
+    shop_name = models.CharField(max_length=50, verbose_name='Название магазина')
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    price = models.PositiveIntegerField(verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая розничная цена')
+    parameters = models.JSONField(verbose_name='Параметры', default=list)
+    search_text = models.TextField(verbose_name='Текст для поиска', blank=True)
+
+    class Meta:
+        verbose_name = 'Предложение каталога'
+        verbose_name_plural = "Витрина каталога"
+        indexes = [
+            models.Index(fields=['category', '-product_name', 'product', 'product_info'],
+                         name='catalog_offer_category'),
+            models.Index(fields=['product', 'product_info'], name='catalog_offer_product'),
+        ]
+
+
+class FacetPosting(models.Model):
+    """
+    Инвертированный индекс параметров витрины: ИД предложений магазина с заданным значением параметра
+    """
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='facet_postings', on_delete=models.CASCADE)
+    parameter = models.CharField(max_length=40, verbose_name='Параметр')
+    value = models.CharField(max_length=100, verbose_name='Значение')
+    offers = models.JSONField(verbose_name='ИД предложений', default=list)
+
+    class Meta:
+        verbose_name = 'Значение фильтра'
+        verbose_name_plural = "Индекс фильтров каталога"
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'parameter', 'value'], name='unique_facet_posting'),
+        ]
+
+
 class Order(models.Model):
     user = models.ForeignKey(User, verbose_name='Пользователь',
                              related_name='orders', blank=True,
                              on_delete=models.CASCADE)
     dt = models.DateTimeField(auto_now_add=True)
     status = models.CharField(verbose_name='Статус', choices=STATUS_CHOICES, max_length=15)
+    total_sum = models.PositiveIntegerField(verbose_name='Сумма заказа', default=0)
+    item_count = models.PositiveIntegerField(verbose_name='Количество позиций', default=0)
 
     class Meta:
         verbose_name = 'Заказ'
         verbose_name_plural = "Список заказ"
         ordering = ('-dt',)
+        indexes = [
+            models.Index(fields=['user', '-dt', '-id'], name='order_user_dt'),
+        ]
 
     def __str__(self):
         return f'Заказ # {self.pk}'
@@ -283,3 +368,46 @@ class Contact(models.Model):
 
     def __str__(self):
         return f'{self.user.name} - {self.value}'
+
+
+class ImportJob(models.Model):
+    """
+    Задача фонового импорта прайса поставщика
+    """
+    user = models.ForeignKey(User, verbose_name='Пользователь', related_name='import_jobs',
+                             on_delete=models.CASCADE)
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='import_jobs', blank=True, null=True,
+                             on_delete=models.SET_NULL)
+    url = models.URLField(verbose_name='Ссылка на прайс', blank=True)
+    file = models.FileField(upload_to='imports', verbose_name='Файл прайса', blank=True, null=True)
+    mode = models.CharField(verbose_name='Режим импорта', choices=IMPORT_MODE_CHOICES, max_length=10, default='full')
+    format = models.CharField(verbose_name='Формат прайса', max_length=10, blank=True)
+    dry_run = models.BooleanField(verbose_name='Только проверка прайса', default=False)
+    status = models.CharField(verbose_name='Статус', choices=IMPORT_STATUS_CHOICES, max_length=10, default='queued')
+    phase = models.CharField(verbose_name='Этап', max_length=20, blank=True)
+    rows_processed = models.PositiveIntegerField(verbose_name='Обработано позиций', default=0)
+    attempts = models.PositiveIntegerField(verbose_name='Количество запусков', default=0)
+    result = models.JSONField(verbose_name='Результат', blank=True, null=True)
+    error = models.TextField(verbose_name='Ошибка', blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        verbose_name = 'Задача импорта'
+        verbose_name_plural = "Список задач импорта"
+        ordering = ('created_at',)
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='import_job_queue'),
+        ]
+
+    def __str__(self):
+        return f'Импорт # {self.pk}'
+
+    @property
+    def rows_per_second(self):
+        if not self.started_at:
+            return 0
+        elapsed = ((self.finished_at or timezone.now()) - self.started_at).total_seconds()
+        return round(self.rows_processed / elapsed, 1) if elapsed > 0 else 0
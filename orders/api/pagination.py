@@ -0,0 +1,27 @@
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+
+
+class KeysetPagination(CursorPagination):
+    """
+    Постраничная выдача по курсору: следующая страница выбирается условием по ключу сортировки,
+    а не смещением, поэтому время ответа не растет с номером страницы.
+    Размер страницы задается параметром page_size, по умолчанию API_PAGE_SIZE, но не больше API_MAX_PAGE_SIZE
+    """
+    page_size_query_param = 'page_size'
+
+    def __init__(self):
+        self.page_size = settings.API_PAGE_SIZE
+        self.max_page_size = settings.API_MAX_PAGE_SIZE
+
+
+class CatalogPagination(KeysetPagination):
+    ordering = ('name', 'id')
+
+
+class OrderPagination(KeysetPagination):
+    ordering = ('-dt', '-id')
+
+
+class ContactPagination(KeysetPagination):
+    ordering = ('id',)
@@ -0,0 +1,297 @@
+import csv
+import hashlib
+import io
+from pathlib import Path
+
+import ujson
+import yaml
+from yaml.events import StreamStartEvent, DocumentStartEvent, MappingStartEvent, MappingEndEvent, \
+    SequenceStartEvent, SequenceEndEvent, ScalarEvent, AliasEvent
+from yaml.nodes import MappingNode, SequenceNode, ScalarNode
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+COPY_CHUNK_SIZE = 64 * 1024
+
+
+class PriceListReader:
+    """
+    Потоковое чтение прайса в формате yaml.
+
+    Документ разбирается по событиям парсера (через libyaml, если он доступен), поэтому
+    в памяти одновременно находится только заголовок прайса и один товар из goods.
+    Принимает любой объект с методом read: открытый файл, тело HTTP-ответа и т.п.
+    """
+
+    def __init__(self, stream):
+        self.loader = SafeLoader(stream)
+
+    def read(self):
+        """
+        Возвращает словарь {'shop': ..., 'categories': [...], 'goods': <генератор товаров>}
+        """
+        loader = self.loader
+        for event_class in (StreamStartEvent, DocumentStartEvent, MappingStartEvent):
+            self.expect(event_class)
+
+        data = {}
+        while not loader.check_event(MappingEndEvent):
+            key = loader.construct_document(self.compose())
+            if key == 'goods' and {'shop', 'categories'} <= data.keys():
+                data['goods'] = self.read_goods()
+                return data
+            data[key] = loader.construct_document(self.compose())
+        self.close()
+        data.setdefault('goods', [])
+        return data
+
+    def read_goods(self):
+        loader = self.loader
+        if loader.check_event(SequenceStartEvent):
+            loader.get_event()
+            while not loader.check_event(SequenceEndEvent):
+                yield loader.construct_document(self.compose())
+            loader.get_event()
+        else:
+            yield from loader.construct_document(self.compose()) or []
+        while not loader.check_event(MappingEndEvent):
+            loader.construct_document(self.compose())
+        self.close()
+
+    def close(self):
+        self.loader.get_event()
+        self.loader.dispose()
+
+    def expect(self, event_class):
+        event = self.loader.get_event()
+        if not isinstance(event, event_class):
+            raise yaml.YAMLError(f'Ожидался {event_class.__name__}, получен {event}')
+        return event
+
+    def compose(self):
+        """
+        Собирает узел документа из событий парсера
+        """
+        loader = self.loader
+        event = loader.get_event()
+        if isinstance(event, ScalarEvent):
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = loader.resolve(ScalarNode, event.value, event.implicit)
+            return ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+        if isinstance(event, SequenceStartEvent):
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = loader.resolve(SequenceNode, None, event.implicit)
+            node = SequenceNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+            while not loader.check_event(SequenceEndEvent):
+                node.value.append(self.compose())
+            node.end_mark = loader.get_event().end_mark
+            return node
+        if isinstance(event, MappingStartEvent):
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = loader.resolve(MappingNode, None, event.implicit)
+            node = MappingNode(tag, [], event.start_mark, None, flow_style=event.flow_style)
+            while not loader.check_event(MappingEndEvent):
+                node.value.append((self.compose(), self.compose()))
+            node.end_mark = loader.get_event().end_mark
+            return node
+        if isinstance(event, AliasEvent):
+            raise yaml.YAMLError('Ссылки (alias) в прайсе не поддерживаются')
+        raise yaml.YAMLError(f'Неожиданное событие {event}')
+
+
+class PriceListFormatError(ValueError):
+    """
+    Неизвестный или неподдерживаемый формат прайса
+    """
+
+
+class PriceListRowError(PriceListFormatError):
+    """
+    Товар, который не удалось разобрать. Читатели возвращают его вместо товара,
+    чтобы проверка прайса отметила строку и продолжила с остальными
+    """
+
+
+# Ошибки разбора файла прайса целиком, в том числе посреди списка товаров
+READ_ERRORS = (ValueError, yaml.YAMLError, csv.Error) + ((msgpack.UnpackException,) if msgpack else ())
+
+
+PRICE_LIST_FORMATS = {}
+FORMAT_EXTENSIONS = {}
+FORMAT_CONTENT_TYPES = {}
+
+DEFAULT_FORMAT = 'yaml'
+
+
+def register_format(name, extensions=(), content_types=()):
+    """
+    Регистрирует функцию чтения прайса в формате name. Функция принимает бинарный поток
+    и возвращает словарь {'shop': ..., 'categories': [...], 'goods': <итератор товаров>}
+    """
+    def decorator(reader):
+        PRICE_LIST_FORMATS[name] = reader
+        FORMAT_EXTENSIONS.update(dict.fromkeys(extensions, name))
+        FORMAT_CONTENT_TYPES.update(dict.fromkeys(content_types, name))
+        return reader
+    return decorator
+
+
+def detect_format(filename='', content_type=''):
+    """
+    Определяет формат прайса по типу содержимого или расширению файла
+    """
+    content_type = (content_type or '').split(';')[0].strip().lower()
+    if content_type in FORMAT_CONTENT_TYPES:
+        return FORMAT_CONTENT_TYPES[content_type]
+    return FORMAT_EXTENSIONS.get(Path(filename or '').suffix.lower(), DEFAULT_FORMAT)
+
+
+def read_price_list(stream, price_list_format=DEFAULT_FORMAT):
+    """
+    Читает прайс из потока, товары возвращаются генератором
+    """
+    reader = PRICE_LIST_FORMATS.get(price_list_format)
+    if reader is None:
+        raise PriceListFormatError(f'Неизвестный формат прайса: {price_list_format}')
+    return reader(stream)
+
+
+@register_format('yaml', extensions=('.yaml', '.yml'),
+                 content_types=('application/yaml', 'application/x-yaml', 'text/yaml', 'text/x-yaml'))
+def read_yaml(stream):
+    return PriceListReader(stream).read()
+
+
+@register_format('jsonl', extensions=('.jsonl', '.ndjson'),
+                 content_types=('application/jsonl', 'application/x-ndjson', 'application/x-jsonlines'))
+def read_json_lines(stream):
+    """
+    JSON Lines: первая строка - заголовок {"shop": ..., "categories": [...]}, далее по товару в строке
+    """
+    lines = ((number, line) for number, line in enumerate(stream, 1) if line.strip())
+    _, line = next(lines, (1, b'{}'))
+    header = check_header(ujson.loads(line))
+    return {'shop': header.get('shop'), 'categories': header.get('categories', []),
+            'goods': (json_line(number, line) for number, line in lines)}
+
+
+def json_line(number, line):
+    try:
+        return ujson.loads(line)
+    except ValueError as exc:
+        return PriceListRowError(f'Строка {number}: некорректный JSON ({exc})')
+
+
+def check_header(header):
+    if not isinstance(header, dict):
+        raise PriceListFormatError('Прайс должен начинаться с заголовка {"shop": ..., "categories": [...]}')
+    return header
+
+
+@register_format('msgpack', extensions=('.msgpack', '.mpk'),
+                 content_types=('application/msgpack', 'application/x-msgpack', 'application/vnd.msgpack'))
+def read_msgpack(stream):
+    """
+    msgpack: последовательность объектов, первый - заголовок {"shop": ..., "categories": [...]}, далее товары
+    """
+    if msgpack is None:
+        raise PriceListFormatError('Для чтения прайсов msgpack установите пакет msgpack')
+    unpacker = msgpack.Unpacker(stream, raw=False)
+    header = check_header(next(unpacker, {}))
+    return {'shop': header.get('shop'), 'categories': header.get('categories', []), 'goods': unpacker}
+
+
+CSV_COLUMNS = ('shop', 'category_id', 'category', 'id', 'model', 'name', 'price', 'price_rrc', 'quantity')
+CSV_INTEGER_COLUMNS = ('id', 'price', 'price_rrc', 'quantity')
+
+
+@register_format('csv', extensions=('.csv',), content_types=('text/csv', 'application/csv'))
+def read_csv(stream):
+    """
+    CSV в кодировке utf-8: строка на товар с колонками CSV_COLUMNS, остальные колонки - параметры
+    товара (пустое значение - параметра нет). Магазин и категории собираются первым проходом
+    по файлу, поэтому поток должен поддерживать seek. Значения, которые не удалось привести
+    к целому, и пропущенные колонки передаются как есть: их отмечает проверка прайса
+    """
+    categories = {}
+    shop = None
+    text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    reader = csv.DictReader(text)
+    for row in reader:
+        shop = shop or row.get('shop')
+        categories[csv_integer(row.get('category_id'))] = row.get('category')
+    header = reader.fieldnames
+    # отсоединяем обертку, чтобы при ее удалении не закрылся исходный поток
+    text.detach()
+    if not header:
+        raise PriceListFormatError('Прайс CSV должен начинаться со строки заголовка')
+
+    def goods():
+        stream.seek(0)
+        text = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+        reader = csv.DictReader(text)
+        parameters = [column for column in reader.fieldnames if column not in CSV_COLUMNS]
+        for row in reader:
+            item = {column: csv_integer(row[column]) for column in CSV_INTEGER_COLUMNS if column in row}
+            item.update({column: row[column] for column in ('model', 'name') if column in row},
+                        parameters={name: row[name] for name in parameters if row[name]})
+            if 'category_id' in row:
+                item['category'] = csv_integer(row['category_id'])
+            yield item
+        text.detach()
+
+    stream.seek(0)
+    return {'shop': shop, 'categories': [{'id': category_id, 'name': name}
+                                         for category_id, name in categories.items()], 'goods': goods()}
+
+
+def csv_integer(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+class DigestReader:
+    """
+    Обертка над потоком, считающая sha256 и размер данных по мере их чтения
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def digest_stream(stream, target=None, chunk_size=COPY_CHUNK_SIZE):
+    """
+    Дочитывает поток кусками, при необходимости копируя их в target,
+    и возвращает DigestReader с хешем и размером прочитанного
+    """
+    reader = DigestReader(stream)
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            return reader
+        if target is not None:
+            target.write(chunk)
@@ -0,0 +1,54 @@
+import ujson
+from django.conf import settings
+from django.http import HttpResponse
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+# Типы, которых нет в JSON (даты, Decimal, UUID, ленивые строки), кодируются так же, как в DRF
+encode_default = JSONEncoder().default
+
+
+def dumps(data):
+    """
+    Сериализует данные в JSON через ujson: компактно, кириллица и '/' без экранирования
+    """
+    return ujson.dumps(data, ensure_ascii=False, escape_forward_slashes=False, default=encode_default)
+
+
+class UJSONRenderer(JSONRenderer):
+    """
+    Рендерер JSON на ujson. Запросы с отступом (Accept: application/json; indent=...)
+    обрабатываются стандартным рендерером
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        return dumps(data).encode()
+
+
+class UJSONParser(JSONParser):
+    renderer_class = UJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get('encoding', settings.DEFAULT_CHARSET)
+        try:
+            return ujson.loads(stream.read().decode(encoding))
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
+
+
+class JsonResponse(HttpResponse):
+    """
+    Замена django.http.JsonResponse, сериализующая данные через ujson
+    """
+
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError('In order to allow non-dict objects to be serialized set the safe parameter to False.')
+        kwargs.setdefault('content_type', 'application/json')
+        super().__init__(content=dumps(data), **kwargs)
@@ -0,0 +1,78 @@
+from collections import defaultdict
+
+from django.db.models import Prefetch
+
+from rest_framework.fields import DateTimeField
+
+from api.fields import selected, select_fields
+from api.models import OrderItem, ProductParameter
+
+# Поля заказа для values(), из которых строится представление в формате OrderSerializer
+ORDER_FIELDS = ('id', 'dt', 'user_id', 'status', 'total_sum', 'item_count')
+
+datetime_field = DateTimeField()
+
+
+def with_order_details(queryset, selection=None):
+    """
+    Предзагрузка для сериализации заказов через OrderSerializer (просмотр одного заказа): позиции,
+    их предложения с магазином и параметры загружаются несколькими запросами на все позиции и только
+    если входят в выбор полей. Списки заказов строятся по values() в order_representations
+    """
+    if not selected(selection, 'ordered_items'):
+        return queryset
+    items = OrderItem.objects.order_by('id')
+    if selected(selection, 'ordered_items', 'product'):
+        items = items.select_related('product_info__shop' if selected(selection, 'ordered_items', 'product', 'shop')
+                                     else 'product_info')
+        if selected(selection, 'ordered_items', 'product', 'product_parameters'):
+            items = items.prefetch_related(Prefetch('product_info__product_parameters',
+                                                    ProductParameter.objects.select_related('parameter')
+                                                    .order_by('id')))
+    return queryset.prefetch_related(Prefetch('ordered_items', items))
+
+
+def product_parameters(product_info_ids):
+    """
+    Параметры предложений одним запросом: ИД предложения -> список в формате ProductParameterSerializer
+    """
+    parameters = defaultdict(list)
+    for info_id, name, value in ProductParameter.objects.filter(product_info_id__in=product_info_ids).order_by(
+            'id').values_list('product_info_id', 'parameter__name', 'value'):
+        parameters[info_id].append({'parameter': {'name': name}, 'value': value})
+    return parameters
+
+
+def order_representations(orders, selection=None):
+    """
+    Заказы (словари с полями ORDER_FIELDS) в формате OrderSerializer без создания экземпляров моделей
+    и сериализаторов: позиции всех заказов и их параметры загружаются двумя запросами. Позиции,
+    предложения и параметры, не вошедшие в выбор полей, из БД не загружаются
+    """
+    items = defaultdict(list)
+    if selected(selection, 'ordered_items'):
+        with_product = selected(selection, 'ordered_items', 'product')
+        fields = ['order_id', 'product_info_id', 'quantity']
+        if with_product:
+            fields += ['product_info__price', 'product_info__price_rrc', 'product_info__shop__name',
+                       'product_info__quantity']
+        rows = list(OrderItem.objects.filter(order_id__in=[order['id'] for order in orders]).order_by('id')
+                    .values_list(*fields))
+        parameters = defaultdict(list)
+        if selected(selection, 'ordered_items', 'product', 'product_parameters'):
+            parameters = product_parameters({row[1] for row in rows})
+        for order_id, info_id, quantity, *product in rows:
+            item = {'product_id': info_id, 'quantity': quantity}
+            if with_product:
+                price, price_rrc, shop_name, stock = product
+                item['product'] = {'price': price, 'price_rrc': price_rrc, 'shop': {'name': shop_name},
+                                   'quantity': stock, 'product_parameters': parameters[info_id]}
+            items[order_id].append(item)
+    return select_fields([{'id': order['id'],
+                           'dt': datetime_field.to_representation(order['dt']),
+                           'user_id': order['user_id'],
+                           'status': order['status'],
+                           'ordered_items': items[order['id']],
+                           'total_sum': order['total_sum'],
+                           'item_count': order['item_count']}
+                          for order in orders], selection)
@@ -0,0 +1,67 @@
+from django.db import connections
+from django.db.models import BooleanField, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import StrIndex
+
+# Конфигурация полнотекстового поиска PostgreSQL
+SEARCH_CONFIG = 'russian'
+
+SEARCH_INDEXES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    f"CREATE INDEX IF NOT EXISTS catalog_offer_search_fts ON api_catalogoffer "
+    f"USING gin (to_tsvector('{SEARCH_CONFIG}', search_text))",
+    'CREATE INDEX IF NOT EXISTS catalog_offer_search_trgm ON api_catalogoffer USING gin (search_text gin_trgm_ops)',
+]
+
+
+def search_text(product_name, model, values):
+    """
+    Текст предложения для поискового индекса: название продукта, модель и значения параметров
+    """
+    return ' '.join([product_name, model, *values]).lower()
+
+
+def create_search_indexes(using, **kwargs):
+    """
+    Создает индексы поиска PostgreSQL (tsvector и триграммы) после миграций.
+    Индексы зависят от расширения pg_trgm, поэтому не описываются в Meta модели
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        for sql in SEARCH_INDEXES:
+            cursor.execute(sql)
+
+
+def search_offers(queryset, query):
+    """
+    Отбирает предложения витрины по запросу и упорядочивает по релевантности.
+
+    В PostgreSQL совпадением считается полнотекстовое совпадение с морфологией или сходство
+    триграмм запроса с частью текста (оператор %>, порог pg_trgm.word_similarity_threshold), а ранг -
+    сумма ts_rank и word_similarity; оба условия используют GIN-индексы. Сходство с частью текста
+    находит слова внутри моделей вида apple/case, которые парсер полнотекстового поиска не делит
+    на слова. На других БД каждое слово запроса ищется подстрокой, а ранг тем выше, чем ближе
+    к началу текста найдены слова: первым в нем идет название продукта
+    """
+    query = query.strip().lower()
+    words = query.split()
+    if not words:
+        return queryset.none()
+    if connections[queryset.db].vendor == 'postgresql':
+        vector = f"to_tsvector('{SEARCH_CONFIG}', search_text)"
+        tsquery = f"websearch_to_tsquery('{SEARCH_CONFIG}', %s)"
+        return queryset.filter(
+            RawSQL(f'{vector} @@ {tsquery} OR search_text %%> %s', (query, query), output_field=BooleanField())
+        ).annotate(
+            rank=RawSQL(f'ts_rank({vector}, {tsquery}) + word_similarity(%s, search_text)', (query, query),
+                        output_field=FloatField())
+        ).order_by('-rank', 'product_id', 'product_info_id')
+
+    condition = Q()
+    rank = Value(0.0, output_field=FloatField())
+    for word in words:
+        condition &= Q(search_text__contains=word)
+        rank = rank - StrIndex('search_text', Value(word))
+    return queryset.filter(condition).annotate(rank=rank).order_by('-rank', 'product_id', 'product_info_id')
@@ -1,8 +1,12 @@
 from django.contrib.auth.password_validation import validate_password
+from django.db import models
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from api.catalog import CATEGORY_OFFERS_ORDERING, catalog_categories, catalog_products, offer_rows
+from api.fields import FieldSelection, SparseFieldsMixin
+from api.shops import closed_shop_ids, open_offers
 from api.models import User, ProductInfo, Category, Product, Shop, ProductParameter, Parameter, Order, OrderItem, \
-    Contact
+    Contact, ImportJob
 import re
 
 
@@ -49,21 +53,30 @@ class UserSerializer(serializers.ModelSerializer):
             raise ValidationError({"Status": False, "Errors": 'Указаны не все параметры для регистрации пользователя'})
 
 
-class ShopSerializer(serializers.ModelSerializer):
+class ShopSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Shop
         fields = ['name']
 
 
-class ParameterSerializer(serializers.ModelSerializer):
+class ShopStateSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Shop
+        fields = ['id', 'name', 'state']
+        read_only_fields = ['id', 'name']
+        extra_kwargs = {'state': {'required': True}}
+
+
+class ParameterSerializer(SparseFieldsMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Parameter
         fields = ['name']
 
 
-class ProductParameterSerializer(serializers.ModelSerializer):
+class ProductParameterSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     parameter = ParameterSerializer(many=False)
 
     class Meta:
@@ -71,7 +84,7 @@ class ProductParameterSerializer(serializers.ModelSerializer):
         fields = ['parameter', 'value', ]
 
 
-class ProductInfoSerializer(serializers.ModelSerializer):
+class ProductInfoSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     shop = ShopSerializer(many=False)
     product_parameters = ProductParameterSerializer(many=True)
 
@@ -80,16 +93,28 @@ class ProductInfoSerializer(serializers.ModelSerializer):
         fields = ['price', 'price_rrc', 'shop', 'quantity', 'product_parameters', ]
 
 
-class ProductSerializer(serializers.ModelSerializer):
-    products_info = ProductInfoSerializer(many=True)
+class ProductSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    products_info = ProductInfoSerializer(many=True, source='product_infos')
 
     class Meta:
         model = Product
         fields = ['id', 'name', 'products_info']
 
 
-class ProductListSerializer(serializers.ModelSerializer):
-    products = ProductSerializer(many=True)
+class CategoryListSerializer(serializers.ListSerializer):
+    """
+    Список категорий через catalog_categories: предложения всех категорий загружаются одним
+    запросом к витрине, а не запросом на каждую категорию
+    """
+
+    def to_representation(self, data):
+        categories = data.all() if isinstance(data, models.Manager) else data
+        return catalog_categories([{'id': category.id, 'name': category.name} for category in categories],
+                                  FieldSelection.from_request(self.context.get('request')))
+
+
+class ProductListSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    products = serializers.SerializerMethodField()
 
     class Meta:
         model = Category
@@ -97,6 +122,10 @@ class ProductListSerializer(serializers.ModelSerializer):
         extra_kwargs = {
             'category': {'source': 'name', 'read_only': True}
         }
+        list_serializer_class = CategoryListSerializer
+
+    def get_products(self, category):
+        return catalog_products(offer_rows(open_offers(category.catalog_offers.order_by(*CATEGORY_OFFERS_ORDERING))))
 
 
 class ProductInfoSerializer2(serializers.ModelSerializer):
@@ -107,14 +136,16 @@ class ProductInfoSerializer2(serializers.ModelSerializer):
 
 
 class OrderItemSerializer(serializers.ModelSerializer):
-    product = ProductInfoSerializer2
+    product = serializers.PrimaryKeyRelatedField(source='product_info', queryset=ProductInfo.objects.all())
 
     class Meta:
         model = OrderItem
         fields = ['quantity', 'product', ]
 
     def validate(self, attrs):
-        if attrs['product'].quantity < attrs['quantity']:
+        if attrs['product_info'].shop_id in closed_shop_ids():
+            raise ValidationError("Магазин сейчас не принимает заказы")
+        elif attrs['product_info'].quantity < attrs['quantity']:
             raise ValidationError("Такого количества нет в наличии")
         elif attrs['quantity'] < 1:
             raise ValidationError("Нельзя заказать товар в количестве меньше 1")
@@ -126,21 +157,22 @@ class OrderItemSerializer(serializers.ModelSerializer):
         return order
 
 
-class ViewBasketSerializer(serializers.ModelSerializer):
-    product = ProductInfoSerializer(many=False)
+class ViewBasketSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    product_id = serializers.IntegerField(source='product_info_id', read_only=True)
+    product = ProductInfoSerializer(many=False, source='product_info')
 
     class Meta:
         model = OrderItem
         fields = ['product_id', 'quantity', 'product']
 
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(SparseFieldsMixin, serializers.ModelSerializer):
     ordered_items = ViewBasketSerializer(many=True, required=False)
-    total_sum = serializers.IntegerField(required=False)
 
     class Meta:
         model = Order
-        fields = ['id', 'dt', 'user_id', 'status', 'ordered_items', 'total_sum']
+        fields = ['id', 'dt', 'user_id', 'status', 'ordered_items', 'total_sum', 'item_count']
+        read_only_fields = ['status', 'total_sum', 'item_count']
 
 
 class ContactSerializer(serializers.ModelSerializer):
@@ -168,5 +200,14 @@ class ContactSerializer(serializers.ModelSerializer):
                 raise ValidationError({'Status': False, 'Errors': "Некорректный формат адреса"})
 
     def to_representation(self, instance):
-        rep = {"Status":True}
+        rep = {"Status": True}
         return rep
+
+
+class ImportJobSerializer(SparseFieldsMixin, serializers.ModelSerializer):
+    rows_per_second = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = ImportJob
+        fields = ['id', 'status', 'phase', 'mode', 'format', 'dry_run', 'shop', 'rows_processed', 'rows_per_second',
+                  'result', 'error', 'created_at', 'started_at', 'finished_at']
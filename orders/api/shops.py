@@ -0,0 +1,70 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from api.models import Shop
+
+# Ключ версии состояний магазинов в общем кеше: увеличивается при каждом переключении приема заказов
+SHOP_STATE_VERSION_KEY = 'shop_state_version'
+
+
+def state_cache():
+    return caches[settings.CATALOG_CACHE_ALIAS]
+
+
+class ClosedShops:
+    """
+    Множество ИД магазинов, не принимающих заказы, в памяти процесса. Открытыми считаются все
+    остальные магазины, а закрытых обычно немного, поэтому запросы каталога отсекают их
+    условием shop_id NOT IN (...) по уже имеющемуся столбцу, без соединения с магазинами.
+
+    Множество перечитывается из БД, если в кеше сменилась версия состояний (с общим кешем
+    переключение видно сразу) или если с загрузки прошло больше SHOP_STATE_TTL секунд -
+    это ограничивает задержку для процессов с локальным кешем
+    """
+
+    def __init__(self):
+        self.ids = frozenset()
+        self.version = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def get(self):
+        version = state_cache().get(SHOP_STATE_VERSION_KEY, 0)
+        with self.lock:
+            if self.loaded_at is None or self.version != version or \
+                    time.monotonic() - self.loaded_at > settings.SHOP_STATE_TTL:
+                self.ids = frozenset(Shop.objects.filter(state=False).order_by().values_list('id', flat=True))
+                self.version, self.loaded_at = version, time.monotonic()
+            return self.ids
+
+
+closed_shops = ClosedShops()
+
+
+def closed_shop_ids():
+    return closed_shops.get()
+
+
+def open_offers(queryset):
+    """
+    Исключает из запроса предложения (витрины или ProductInfo) магазинов, не принимающих заказы
+    """
+    closed = closed_shop_ids()
+    return queryset.exclude(shop_id__in=closed) if closed else queryset
+
+
+def set_shop_state(shop_id, state):
+    """
+    Переключает прием заказов магазином и увеличивает версию состояний в кеше
+    """
+    updated = Shop.objects.filter(id=shop_id).update(state=state)
+    cache = state_cache()
+    if not cache.add(SHOP_STATE_VERSION_KEY, 1, timeout=None):
+        try:
+            cache.incr(SHOP_STATE_VERSION_KEY)
+        except ValueError:
+            cache.set(SHOP_STATE_VERSION_KEY, 1, timeout=None)
+    return updated
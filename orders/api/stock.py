@@ -0,0 +1,112 @@
+from django.db import transaction
+from django.db.models import Case, F, PositiveIntegerField, Value, When
+
+from api.models import CatalogOffer, Order, OrderItem, ProductInfo
+from api.shops import closed_shop_ids
+from api.totals import update_order_total
+
+# Статусы, в которых товар заказа зарезервирован на складе магазина и которые покупатель может отменить
+RESERVED_STATUSES = ('new', 'confirmed', 'assembled')
+
+
+class CheckoutError(Exception):
+    """
+    Заказ нельзя оформить, products содержит ИД проблемных предложений
+    """
+
+    def __init__(self, message, products=()):
+        super().__init__(message)
+        self.products = sorted(products)
+
+
+def by_offer(lines):
+    """
+    Количество позиции заказа для строки ProductInfo или витрины: CASE id WHEN ... THEN ... END
+    """
+    return Case(*(When(pk=info_id, then=Value(quantity)) for info_id, quantity in lines.items()),
+                default=Value(0), output_field=PositiveIntegerField())
+
+
+def update_catalog_stock(lines, quantity):
+    """
+    Переносит изменение склада в витрину каталога. Версии каталогов магазинов не меняются:
+    остатки в кешированных ответах обновляются через CATALOG_STOCK_TTL секунд, а строки магазинов
+    не блокируются, поэтому оформления заказов одного магазина не выстраиваются в очередь
+    """
+    CatalogOffer.objects.filter(pk__in=lines).update(quantity=quantity)
+
+
+def reserve_stock(order_id):
+    """
+    Списывает со склада количество всех позиций заказа. Вызывается внутри транзакции.
+
+    Строки предложений сначала блокируются SELECT ... FOR UPDATE в порядке ИД, поэтому параллельные
+    оформления с пересекающимися товарами не взаимоблокируются. Списание выполняется одним
+    условным UPDATE (quantity >= заказанного), и если обновились не все строки, оформление
+    отменяется: на базах без FOR UPDATE товар все равно не уходит в минус. Витрина каталога
+    обновляется тем же выражением в той же транзакции
+    """
+    lines = dict(OrderItem.objects.filter(order_id=order_id).values_list('product_info_id', 'quantity'))
+    if not lines:
+        raise CheckoutError('Корзина пуста')
+    offers = {info_id: (shop_id, stock) for info_id, shop_id, stock in ProductInfo.objects.select_for_update().filter(
+        id__in=lines).order_by('id').values_list('id', 'shop_id', 'quantity')}
+    closed = closed_shop_ids()
+    unavailable = {info_id for info_id, (shop_id, _) in offers.items() if shop_id in closed}
+    if unavailable:
+        raise CheckoutError('Магазин сейчас не принимает заказы', unavailable)
+    shortage = {info_id for info_id, quantity in lines.items()
+                if info_id not in offers or offers[info_id][1] < quantity}
+    if shortage:
+        raise CheckoutError('Такого количества нет в наличии', shortage)
+
+    reserved = ProductInfo.objects.filter(id__in=lines, quantity__gte=by_offer(lines)).update(
+        quantity=F('quantity') - by_offer(lines))
+    if reserved < len(lines):
+        raise CheckoutError('Такого количества нет в наличии', lines)
+    update_catalog_stock(lines, F('quantity') - by_offer(lines))
+
+
+def release_stock(order_id):
+    """
+    Возвращает на склад количество всех позиций заказа. Вызывается внутри транзакции.
+
+    Строки предложений блокируются в том же порядке ИД, что и при списании, поэтому отмена
+    и параллельное оформление с пересекающимися товарами не взаимоблокируются. Снятым
+    с продажи при импорте предложениям товар не возвращается, они остаются с нулевым количеством
+    """
+    lines = dict(OrderItem.objects.filter(order_id=order_id).values_list('product_info_id', 'quantity'))
+    released = list(ProductInfo.objects.select_for_update().filter(id__in=lines, retired=False).order_by('id')
+                    .values_list('id', flat=True))
+    lines = {info_id: lines[info_id] for info_id in released}
+    if lines:
+        ProductInfo.objects.filter(id__in=lines).update(quantity=F('quantity') + by_offer(lines))
+        update_catalog_stock(lines, F('quantity') + by_offer(lines))
+
+
+def checkout_order(order_id, user_id):
+    """
+    Оформляет корзину пользователя: переводит ее в статус new, резервирует товар и фиксирует
+    сумму по текущим ценам в одной транзакции. Статус меняется условным UPDATE, поэтому
+    повторное или параллельное оформление той же корзины не спишет товар дважды.
+    Возвращает False, если корзины нет, при нехватке товара - CheckoutError
+    """
+    with transaction.atomic():
+        if not Order.objects.filter(id=order_id, user_id=user_id, status='basket').update(status='new'):
+            return False
+        reserve_stock(order_id)
+        update_order_total(order_id)
+    return True
+
+
+def cancel_order(order_id, user_id):
+    """
+    Отменяет заказ пользователя и возвращает товар на склад. Возвращает False,
+    если заказа нет или его уже нельзя отменить
+    """
+    with transaction.atomic():
+        if not Order.objects.filter(id=order_id, user_id=user_id, status__in=RESERVED_STATUSES).update(
+                status='canceled'):
+            return False
+        release_stock(order_id)
+    return True
@@ -0,0 +1,250 @@
+import logging
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from pathlib import Path
+from tempfile import TemporaryFile
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from api.fetch import fetch_price_list, FetchResult
+from api.importer import IMPORTERS, import_report, autocommit_db
+from api.models import ImportJob, Shop
+from api.price_lists import read_price_list, digest_stream, detect_format
+from api.validation import validate_stream, PriceListValidationError
+
+logger = logging.getLogger(__name__)
+
+NOT_MODIFIED_REPORT = {'Прайс не изменился': True}
+
+
+def update_job(job, **fields):
+    """
+    Сохраняет состояние задачи через отдельное соединение, чтобы оно было видно
+    до завершения транзакции импорта. Время обновления служит признаком того, что воркер жив
+    """
+    fields['updated_at'] = timezone.now()
+    for name, value in fields.items():
+        setattr(job, name, value)
+    ImportJob.objects.using(autocommit_db()).filter(id=job.id).update(**fields)
+
+
+@contextmanager
+def open_price_list(job, shop=None):
+    """
+    Открывает источник прайса задачи как локальный файл и считает хеш его содержимого.
+    Прайс по ссылке загружается во временный файл условным запросом с ETag/Last-Modified,
+    сохраненными для магазина при прошлом импорте с той же ссылки. Для задачи с dry_run
+    прайс загружается всегда: проверка не должна заканчиваться ответом «не изменился»
+    """
+    if job.url:
+        with TemporaryFile() as stream:
+            if shop and shop.url == job.url and not job.dry_run:
+                result = fetch_price_list(job.url, stream, shop.import_etag, shop.import_last_modified)
+            else:
+                result = fetch_price_list(job.url, stream)
+            stream.seek(0)
+            yield stream, result
+    else:
+        with job.file.open('rb') as stream:
+            digest = digest_stream(stream)
+            stream.seek(0)
+            yield stream, FetchResult(False, digest, '', '', '')
+
+
+class ShopUrlConflictError(Exception):
+    """
+    Адрес прайса уже принадлежит магазину другого пользователя
+    """
+
+
+def get_shop(job, name):
+    """
+    Магазин пользователя, создается при первом импорте. Адрес прайса уникален среди магазинов,
+    поэтому прайс, уже закрепленный за магазином другого пользователя, не импортируется
+    """
+    defaults = {'name': name}
+    if job.url:
+        defaults['url'] = job.url
+    else:
+        defaults.update(filename=job.file.name, url=job.file.url)
+    if Shop.objects.filter(url=defaults['url']).exclude(owner_id=job.user_id).exists():
+        raise ShopUrlConflictError(f'Прайс {defaults["url"]} уже импортируется магазином другого пользователя')
+    shop, _ = Shop.objects.update_or_create(owner_id=job.user_id, defaults=defaults)
+    return shop
+
+
+def check_price_list(stream, price_list_format):
+    """
+    Проверяет весь прайс до записи в БД и возвращает поток в начало
+    """
+    report = validate_stream(stream, price_list_format)
+    stream.seek(0)
+    return report
+
+
+def do_import(job):
+    """
+    Выполняет импорт прайса по задаче и сохраняет результат.
+    Если прайс не изменился с последнего импорта магазина, импорт пропускается.
+    Перед импортом прайс целиком проверяется, а для задачи с dry_run только проверяется
+    """
+    update_job(job, phase='fetch')
+    shop = Shop.objects.filter(owner_id=job.user_id).first()
+    with open_price_list(job, shop) as (stream, source):
+        validators = {'import_etag': source.etag, 'import_last_modified': source.last_modified}
+        if not job.dry_run and (source.not_modified or (shop and shop.import_hash == source.digest.hexdigest() and
+                                                        shop.import_size == source.digest.size)):
+            Shop.objects.filter(id=shop.id).update(**validators)
+            update_job(job, shop_id=shop.id)
+            return NOT_MODIFIED_REPORT
+
+        price_list_format = job.format or detect_format(urlparse(job.url).path or job.file.name, source.content_type)
+        update_job(job, phase='validate')
+        report = check_price_list(stream, price_list_format)
+        if job.dry_run:
+            return report
+        if not report['valid']:
+            raise PriceListValidationError(report)
+
+        data = read_price_list(stream, price_list_format)
+        shop = get_shop(job, data['shop'])
+        update_job(job, shop_id=shop.id, phase='import')
+        importer = IMPORTERS[job.mode](shop, progress=lambda rows: update_job(job, rows_processed=rows))
+        with transaction.atomic():
+            stats = importer.run(data)
+            Shop.objects.filter(id=shop.id).update(import_hash=source.digest.hexdigest(),
+                                                   import_size=source.digest.size, **validators)
+    return import_report(stats)
+
+
+@contextmanager
+def open_source(source):
+    """
+    Открывает прайс пакетной загрузки: ссылку или путь к файлу.
+    Возвращает поток, адрес прайса и его формат
+    """
+    if urlparse(source).scheme in ('http', 'https'):
+        with TemporaryFile() as stream:
+            result = fetch_price_list(source, stream)
+            stream.seek(0)
+            yield stream, source, detect_format(urlparse(source).path, result.content_type)
+    else:
+        path = Path(source).resolve()
+        with open(path, 'rb') as stream:
+            yield stream, path.as_uri(), detect_format(path.name)
+
+
+def import_source(source, mode='full'):
+    """
+    Импортирует один прайс пакетной загрузки в собственной транзакции. Магазин определяется
+    по адресу прайса (уникальному полю url), название магазина берется из прайса: названия
+    магазинов не уникальны, а параллельные импорты одного адреса не создадут второй магазин.
+    Возвращает отчет с временем выполнения
+    """
+    started = time.monotonic()
+    report = {'source': source}
+    try:
+        with open_source(source) as (stream, url, price_list_format):
+            validation = check_price_list(stream, price_list_format)
+            if not validation['valid']:
+                raise PriceListValidationError(validation)
+            data = read_price_list(stream, price_list_format)
+            shop, _ = Shop.objects.update_or_create(url=url, defaults={'name': data['shop']})
+            report['shop'] = shop.name
+            report['result'] = import_report(IMPORTERS[mode](shop).run(data))
+        report['status'] = True
+    except PriceListValidationError as exc:
+        report.update(status=False, error=str(exc), validation=exc.report)
+    except Exception as exc:
+        logger.exception('Ошибка импорта %s', source)
+        report.update(status=False, error=str(exc))
+    report['seconds'] = round(time.monotonic() - started, 3)
+    return report
+
+
+def requeue_stale_jobs():
+    """
+    Возвращает в очередь задачи, которые перестали обновляться, потому что их воркер упал.
+    Задачи, исчерпавшие IMPORT_JOB_MAX_ATTEMPTS запусков, завершаются с ошибкой
+    """
+    now = timezone.now()
+    stale = ImportJob.objects.filter(status='running',
+                                     updated_at__lt=now - timedelta(seconds=settings.IMPORT_JOB_TIMEOUT))
+    for job in stale.filter(attempts__gte=settings.IMPORT_JOB_MAX_ATTEMPTS):
+        update_job(job, status='failed', error='Задача не завершена воркером', finished_at=now)
+        remove_upload(job)
+    return stale.update(status='queued', phase='', rows_processed=0, updated_at=now)
+
+
+def claim_job():
+    """
+    Забирает из очереди самую старую задачу. Захват выполняется условным UPDATE,
+    поэтому несколько воркеров не получат одну и ту же задачу
+    """
+    requeue_stale_jobs()
+    for job_id in ImportJob.objects.filter(status='queued').values_list('id', flat=True)[:10]:
+        now = timezone.now()
+        claimed = ImportJob.objects.filter(id=job_id, status='queued').update(
+            status='running', started_at=now, updated_at=now, attempts=F('attempts') + 1)
+        if claimed:
+            return ImportJob.objects.get(id=job_id)
+    return None
+
+
+def remove_upload(job):
+    """
+    Удаляет загруженный файл задачи из imports/. Прайс, импортированный в магазин,
+    сохраняется в файл магазина (shops/) вместо прежнего
+    """
+    if not job.file:
+        return
+    if job.status == 'done' and job.shop_id and not job.dry_run and job.result != NOT_MODIFIED_REPORT:
+        shop = Shop.objects.get(id=job.shop_id)
+        previous = shop.filename.name
+        with job.file.open('rb') as stream:
+            shop.filename.save(Path(job.file.name).name, File(stream), save=False)
+        Shop.objects.filter(id=shop.id).update(filename=shop.filename.name, url=shop.filename.url)
+        if previous and previous != job.file.name:
+            shop.filename.storage.delete(previous)
+    job.file.delete(save=False)
+    ImportJob.objects.filter(id=job.id).update(file=None)
+
+
+def run_job(job):
+    try:
+        result = do_import(job)
+    except PriceListValidationError as exc:
+        update_job(job, status='failed', error=str(exc), result=exc.report, finished_at=timezone.now())
+    except ShopUrlConflictError as exc:
+        update_job(job, status='failed', error=str(exc), finished_at=timezone.now())
+    except Exception as exc:
+        logger.exception('Ошибка импорта %s', job)
+        update_job(job, status='failed', error=str(exc), finished_at=timezone.now())
+    else:
+        update_job(job, status='done', phase='finish', result=result, finished_at=timezone.now())
+    try:
+        remove_upload(job)
+    except Exception:
+        logger.exception('Не удалось удалить файл задачи %s', job)
+
+
+def work(once=False, poll_interval=None):
+    """
+    Цикл воркера: выполняет задачи из очереди, пока она не опустеет (once)
+    или бесконечно, опрашивая очередь с интервалом poll_interval
+    """
+    poll_interval = poll_interval or settings.IMPORT_WORKER_POLL_INTERVAL
+    while True:
+        job = claim_job()
+        if job:
+            run_job(job)
+        elif once:
+            return
+        else:
+            time.sleep(poll_interval)
@@ -1,3 +1,1191 @@
-from django.test import TestCase
+import csv
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import timedelta
+from io import BytesIO, StringIO
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connections
+from django.db.models import Prefetch
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
+import yaml
+
+from api.benchmarks import legacy_orders, fast_orders, legacy_products, fast_products
+from api.catalog import rebuild_catalog
+from api.facets import facet_index
+from api.fetch import fetch_price_list, FetchError
+from api.importer import PriceListImporter, DiffPriceListImporter
+from api.models import CatalogOffer, Category, Contact, FacetPosting, ImportJob, Order, OrderItem, Product, \
+    ProductInfo, ProductParameter, Shop, User
+from api.price_lists import CSV_COLUMNS, msgpack, read_price_list
+from api.serializers import OrderItemSerializer, ProductListSerializer, ProductSerializer
+from api.shops import closed_shops
+from api.stock import CheckoutError, checkout_order
+from api.tasks import NOT_MODIFIED_REPORT, claim_job, import_source, open_price_list, work
+from api.totals import update_order_total, update_order_totals
+from api.validation import validate_price_list, validate_stream
+
+PRICE_LIST = Path(settings.BASE_DIR).parent / 'data' / 'shop1.yaml'
+
+
+class PriceListHandler(BaseHTTPRequestHandler):
+    """
+    Заглушка сервера поставщика: отдает shop1.yaml с ETag и отвечает 304 на условный запрос
+    """
+    etag = '"shop1-v1"'
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = PRICE_LIST.read_bytes()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', self.etag)
+        self.send_header('Last-Modified', 'Mon, 01 Jan 2024 00:00:00 GMT')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchPriceListTest(SimpleTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), PriceListHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.url = f'http://127.0.0.1:{cls.server.server_port}/shop1.yaml'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def test_fetch_and_conditional_request(self):
+        target = BytesIO()
+        result = fetch_price_list(self.url, target)
+        self.assertFalse(result.not_modified)
+        self.assertEqual(target.getvalue(), PRICE_LIST.read_bytes())
+        self.assertEqual(result.digest.size, PRICE_LIST.stat().st_size)
+        self.assertEqual(result.etag, PriceListHandler.etag)
+
+        target = BytesIO()
+        result = fetch_price_list(self.url, target, result.etag, result.last_modified)
+        self.assertTrue(result.not_modified)
+        self.assertEqual(target.getvalue(), b'')
+
+    def test_dry_run_not_conditional(self):
+        shop = Shop(url=self.url, import_etag=PriceListHandler.etag)
+        with open_price_list(ImportJob(url=self.url), shop) as (stream, result):
+            self.assertTrue(result.not_modified)
+        with open_price_list(ImportJob(url=self.url, dry_run=True), shop) as (stream, result):
+            self.assertFalse(result.not_modified)
+            self.assertEqual(stream.read(), PRICE_LIST.read_bytes())
+
+    @override_settings(IMPORT_FETCH_MAX_SIZE=100)
+    def test_size_limit(self):
+        with self.assertRaises(FetchError):
+            fetch_price_list(self.url, BytesIO())
+
+
+class PriceListReaderTest(SimpleTestCase):
+    """
+    Потоковое чтение прайса yaml
+    """
+
+    def test_yaml_matches_safe_load(self):
+        expected = yaml.safe_load(PRICE_LIST.read_bytes())
+        with PRICE_LIST.open('rb') as stream:
+            data = read_price_list(stream, 'yaml')
+            self.assertEqual((data['shop'], data['categories']), (expected['shop'], expected['categories']))
+            self.assertNotIsInstance(data['goods'], list)
+            self.assertEqual(list(data['goods']), expected['goods'])
+
+    def test_yaml_goods_streamed(self):
+        # товары разбираются по одному: ошибка в конце файла не мешает прочитать первые товары
+        stream = BytesIO(PRICE_LIST.read_bytes() + b'  - id: [1\n')
+        goods = read_price_list(stream, 'yaml')['goods']
+        self.assertEqual(next(goods)['id'], 4216292)
+        with self.assertRaises(yaml.YAMLError):
+            list(goods)
+
+
+class PriceListValidationTest(SimpleTestCase):
+    """
+    Проверка прайса собирает ошибки всех товаров в отчет, в том числе ошибки разбора файла
+    """
+
+    def setUp(self):
+        self.data = yaml.safe_load(PRICE_LIST.read_bytes())
+
+    def errors(self, report):
+        return [(error.get('index'), error.get('field')) for error in report['errors']]
+
+    def test_item_errors(self):
+        self.data['goods'][0].update(price=200000)
+        self.data['goods'][1].update(category=999, quantity=-1)
+        self.data['goods'][2].update(id=self.data['goods'][0]['id'])
+        del self.data['goods'][3]['model']
+        report = validate_price_list(self.data)
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['goods'], len(self.data['goods']))
+        self.assertEqual(self.errors(report), [(0, 'price'), (1, 'quantity'), (1, 'category'), (2, 'id'), (3, None)])
+
+    def test_error_limit(self):
+        for item in self.data['goods']:
+            item['price'] = 'дорого'
+        report = validate_price_list(self.data, max_errors=2)
+        self.assertEqual((len(report['errors']), report['errors_count']), (2, len(self.data['goods'])))
+
+    def test_malformed_csv(self):
+        body = encode_price_list(self.data, 'csv').decode().splitlines()
+        body[2] = body[2].replace(str(self.data['goods'][1]['price']), 'сто')
+        report = validate_stream(BytesIO('\n'.join(body).encode()), 'csv')
+        self.assertEqual(self.errors(report), [(1, 'price')])
+        self.assertEqual(report['goods'], len(self.data['goods']))
+
+        for body in (b'', b'\n\n'):
+            report = validate_stream(BytesIO(body), 'csv')
+            self.assertEqual((report['valid'], report['errors_count']), (False, 1))
+            self.assertIn('заголовка', report['errors'][0]['error'])
+
+    def test_malformed_json_lines(self):
+        body = encode_price_list(self.data, 'jsonl').splitlines()
+        body[2] = body[2][:-1]
+        report = validate_stream(BytesIO(b'\n'.join(body)), 'jsonl')
+        self.assertEqual(self.errors(report), [(1, None)])
+        self.assertTrue(report['errors'][0]['error'].startswith('Строка 3'))
+        self.assertEqual(report['goods'], len(self.data['goods']))
+
+        report = validate_stream(BytesIO(b'[]\n' + b'\n'.join(body[1:])), 'jsonl')
+        self.assertFalse(report['valid'])
+
+    def test_malformed_yaml(self):
+        report = validate_stream(BytesIO(PRICE_LIST.read_bytes() + b'  - id: [1\n'), 'yaml')
+        self.assertEqual((report['goods'], report['errors_count']), (len(self.data['goods']), 1))
+        self.assertTrue(report['errors'][0]['error'].startswith('Не удалось прочитать прайс'))
+
+
+def encode_price_list(data, price_list_format):
+    """
+    Записывает прайс {'shop', 'categories', 'goods'} в формате csv, jsonl или msgpack
+    """
+    header = {'shop': data['shop'], 'categories': data['categories']}
+    if price_list_format == 'jsonl':
+        return b''.join(json.dumps(line, ensure_ascii=False).encode() + b'\n' for line in [header, *data['goods']])
+    if price_list_format == 'msgpack':
+        return b''.join(msgpack.packb(line) for line in [header, *data['goods']])
+    categories = {category['id']: category['name'] for category in data['categories']}
+    parameters = list(dict.fromkeys(name for item in data['goods'] for name in item['parameters']))
+    text = StringIO()
+    writer = csv.DictWriter(text, CSV_COLUMNS + tuple(parameters))
+    writer.writeheader()
+    for item in data['goods']:
+        writer.writerow({'shop': data['shop'], 'category_id': item['category'],
+                         'category': categories[item['category']], 'id': item['id'], 'model': item['model'],
+                         'name': item['name'], 'price': item['price'], 'price_rrc': item['price_rrc'],
+                         'quantity': item['quantity'], **item['parameters']})
+    return text.getvalue().encode()
+
+
+class CatalogStateMixin:
+    """
+    Перед каждым тестом очищает кеш каталога и состояние каталога в памяти процесса: закрытые
+    магазины загружаются заново (этот запрос не попадает в проверки количества запросов),
+    индекс фильтров пустой. Классы тестов задают большой SHOP_STATE_TTL, чтобы закрытые
+    магазины не перечитывались посреди теста по времени
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        cache.clear()
+        closed_shops.loaded_at = None
+        closed_shops.get()
+        facet_index.shops = {}
+
+
+@override_settings(IMPORT_AUTOCOMMIT_DB=None, SHOP_STATE_TTL=3600)
+class ApiTestCase(CatalogStateMixin, TestCase):
+    """
+    Базовый класс тестов с импортом. Общие справочники пишутся через соединение теста:
+    отдельное соединение autocommit зафиксировало бы их вне транзакции теста, и записи
+    оставались бы в базе между тестами
+    """
+
+
+@override_settings(IMPORT_AUTOCOMMIT_DB=None, SHOP_STATE_TTL=3600)
+class ApiTransactionTestCase(CatalogStateMixin, TransactionTestCase):
+    """
+    Базовый класс тестов с настоящими транзакциями, например с параллельными соединениями.
+    Второе соединение autocommit не входит в базы теста, поэтому импорт пишет через основное
+    """
+
+
+def make_price_list(shop, goods, categories=3, parameters=3):
+    return {
+        'shop': shop,
+        'categories': [{'id': index + 1, 'name': f'Категория {index}'} for index in range(categories)],
+        'goods': [{'id': index, 'category': index % categories + 1, 'model': f'model/{index}',
+                   'name': f'Товар {index}', 'price': 100 + index, 'price_rrc': 200 + index, 'quantity': 5,
+                   'parameters': {f'Параметр {parameter}': index for parameter in range(parameters)}}
+                  for index in range(goods)],
+    }
+
+
+def import_shop(name, goods, **kwargs):
+    user = User.objects.create_user(f'{name}@example.com', 'password', username=name, type='shop')
+    shop = Shop.objects.create(name=name, url=f'https://{name}.example.com/', owner=user)
+    PriceListImporter(shop).run(make_price_list(name, goods, **kwargs))
+    return shop
+
+
+class PriceListImportTest(ApiTestCase):
+    """
+    Позиции магазина сопоставляются по внешнему ИД товара в обоих режимах импорта
+    """
+
+    def test_rename_keeps_offer(self):
+        for importer in (PriceListImporter, DiffPriceListImporter):
+            with self.subTest(importer=importer.__name__):
+                shop = import_shop(importer.__name__.lower(), 3)
+                offer_id = shop.product_infos.get(external_id=1).id
+                data = make_price_list(shop.name, 3)
+                data['goods'][1]['name'] = 'Товар 1 (красный)'
+                importer(shop).run(data)
+                offer = shop.product_infos.get(external_id=1)
+                self.assertEqual((offer.id, offer.product.name), (offer_id, 'Товар 1 (красный)'))
+                self.assertEqual(shop.product_infos.count(), 3)
+                self.assertEqual(offer.product_parameters.count(), 3)
+
+    def test_external_id_change_keeps_offer(self):
+        for importer in (PriceListImporter, DiffPriceListImporter):
+            with self.subTest(importer=importer.__name__):
+                shop = import_shop(importer.__name__.lower(), 3)
+                offer_id = shop.product_infos.get(external_id=1).id
+                data = make_price_list(shop.name, 3)
+                data['goods'][1]['id'] = 10
+                importer(shop).run(data)
+                offer = shop.product_infos.get(external_id=10)
+                self.assertEqual((offer.id, offer.product.name), (offer_id, 'Товар 1'))
+                self.assertEqual(shop.product_infos.count(), 3)
+                self.assertEqual(offer.product_parameters.count(), 3)
+
+    def test_name_swap(self):
+        for importer in (PriceListImporter, DiffPriceListImporter):
+            for batch_size in (1, 100):
+                with self.subTest(importer=importer.__name__, batch_size=batch_size):
+                    shop = import_shop(f'{importer.__name__.lower()}-{batch_size}', 3, categories=1)
+                    offers = dict(shop.product_infos.values_list('product__name', 'id'))
+                    data = make_price_list(shop.name, 3, categories=1)
+                    data['goods'][0]['name'], data['goods'][1]['name'] = 'Товар 1', 'Товар 0'
+                    importer(shop, batch_size=batch_size).run(data)
+                    stored = {offer.external_id: (offer.id, offer.product.name) for offer in shop.product_infos.all()}
+                    self.assertEqual(stored, {0: (offers['Товар 1'], 'Товар 1'), 1: (offers['Товар 0'], 'Товар 0'),
+                                              2: (offers['Товар 2'], 'Товар 2')})
+
+    def test_duplicate_product_rejected(self):
+        data = make_price_list('shop', 3)
+        data['goods'][2].update(name='Товар 0', category=data['goods'][0]['category'])
+        report = validate_price_list(data)
+        self.assertFalse(report['valid'])
+        self.assertEqual([(error['field'], error['id']) for error in report['errors']], [('name', 2)])
+
+
+class PriceListFormatTest(ApiTestCase):
+    """
+    Прайс в любом из форматов загружается в те же позиции, что и исходный yaml
+    """
+
+    def offers(self, shop):
+        return sorted((offer.external_id, offer.product.name, offer.product.category.name, offer.model, offer.price,
+                       offer.price_rrc, offer.quantity,
+                       sorted((parameter.parameter.name, parameter.value)
+                              for parameter in offer.product_parameters.all()))
+                      for offer in shop.product_infos.select_related('product__category')
+                      .prefetch_related('product_parameters__parameter'))
+
+    def test_round_trip(self):
+        data = yaml.safe_load(PRICE_LIST.read_bytes())
+        report = import_source(str(PRICE_LIST))
+        self.assertTrue(report['status'], report)
+        shop = Shop.objects.get(url=PRICE_LIST.resolve().as_uri())
+        expected = self.offers(shop)
+        self.assertEqual(len(expected), len(data['goods']))
+
+        formats = ['csv', 'jsonl'] + ['msgpack'] * (msgpack is not None)
+        with TemporaryDirectory() as directory:
+            for price_list_format in formats:
+                with self.subTest(price_list_format=price_list_format):
+                    path = Path(directory) / f'shop1.{price_list_format}'
+                    path.write_bytes(encode_price_list(data, price_list_format))
+                    report = import_source(str(path))
+                    self.assertTrue(report['status'], report)
+                    self.assertEqual(self.offers(Shop.objects.get(url=path.resolve().as_uri())), expected)
+
+    def test_shop_matched_by_source(self):
+        # магазин с тем же названием, но другим адресом, импорт не затрагивает
+        Shop.objects.create(name='Связной', url='https://other.example.com/')
+        data = yaml.safe_load(PRICE_LIST.read_bytes())
+        with TemporaryDirectory() as directory:
+            path = Path(directory) / 'shop1.yaml'
+            # повторный импорт того же прайса обновляет название созданного первым импортом магазина
+            for name in ('Новый магазин', 'Связной'):
+                data['shop'] = name
+                path.write_text(yaml.safe_dump(data, allow_unicode=True), encoding='utf-8')
+                report = import_source(str(path))
+                self.assertTrue(report['status'], report)
+        self.assertEqual(Shop.objects.count(), 2)
+        self.assertEqual(Shop.objects.filter(name='Связной').exclude(url='https://other.example.com/')
+                         .get().product_infos.count(), len(data['goods']))
+
+
+class ImportJobTest(ApiTestCase):
+    """
+    Очередь задач импорта: загрузка прайса, выполнение воркером и отчет о ходе импорта
+    """
+
+    def setUp(self):
+        super().setUp()
+        media = TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media_root = Path(media.name)
+        media_settings = self.settings(MEDIA_ROOT=media.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.user = User.objects.create_user('shop@example.com', 'password', username='shop', type='shop')
+        self.client.force_authenticate(self.user)
+
+    def upload(self, body, name='shop1.yaml', **data):
+        response = self.client.post('/api/v1/upload/',
+                                    {'filename': name, 'file': SimpleUploadedFile(name, body), **data})
+        self.assertEqual(response.status_code, 202)
+        return response.json()['Задача']
+
+    def test_upload_and_work(self):
+        job_id = self.upload(PRICE_LIST.read_bytes())
+        self.assertEqual(self.client.get(f'/api/v1/upload/{job_id}/').json()['status'], 'queued')
+        work(once=True)
+
+        job = self.client.get(f'/api/v1/upload/{job_id}/').json()
+        goods = len(yaml.safe_load(PRICE_LIST.read_bytes())['goods'])
+        self.assertEqual((job['status'], job['phase'], job['rows_processed']), ('done', 'finish', goods))
+        self.assertEqual(job['result']['Добавлено объектов'], goods)
+        shop = Shop.objects.get(owner=self.user)
+        self.assertEqual(shop.product_infos.count(), goods)
+        # загруженный файл удален, прайс сохранен у магазина
+        self.assertFalse(any((self.media_root / 'imports').iterdir()))
+        self.assertEqual(shop.filename.name, 'shops/shop1.yaml')
+        self.assertEqual(shop.filename.read(), PRICE_LIST.read_bytes())
+
+    def test_unchanged_upload_skipped(self):
+        self.upload(PRICE_LIST.read_bytes())
+        work(once=True)
+        shop = Shop.objects.get(owner=self.user)
+        shop.product_infos.update(quantity=0)
+
+        job_id = self.upload(PRICE_LIST.read_bytes())
+        work(once=True)
+        job = self.client.get(f'/api/v1/upload/{job_id}/').json()
+        self.assertEqual((job['status'], job['result'], job['shop']), ('done', NOT_MODIFIED_REPORT, shop.id))
+        # прайс не разбирался и не записывался
+        self.assertFalse(shop.product_infos.exclude(quantity=0).exists())
+
+        job_id = self.upload(PRICE_LIST.read_bytes() + b'\n')
+        work(once=True)
+        self.assertNotEqual(self.client.get(f'/api/v1/upload/{job_id}/').json()['result'], NOT_MODIFIED_REPORT)
+        self.assertTrue(shop.product_infos.exclude(quantity=0).exists())
+
+    def test_shop_url_conflict(self):
+        other = User.objects.create_user('other@example.com', 'password', username='other', type='shop')
+        Shop.objects.create(name='other', url=f'{settings.MEDIA_URL}imports/shop1.yaml', owner=other)
+        job_id = self.upload(PRICE_LIST.read_bytes())
+        work(once=True)
+        job = self.client.get(f'/api/v1/upload/{job_id}/').json()
+        self.assertEqual(job['status'], 'failed')
+        self.assertIn('другого пользователя', job['error'])
+        self.assertFalse(Shop.objects.filter(owner=self.user).exists())
+
+    def test_stale_job_reclaimed(self):
+        old = timezone.now() - timedelta(seconds=settings.IMPORT_JOB_TIMEOUT + 1)
+        stale = ImportJob.objects.create(user=self.user, url='https://example.com/shop.yaml', status='running',
+                                         attempts=1, updated_at=old)
+        exhausted = ImportJob.objects.create(user=self.user, url='https://example.com/shop.yaml',
+                                             status='running', attempts=settings.IMPORT_JOB_MAX_ATTEMPTS,
+                                             updated_at=old)
+        alive = ImportJob.objects.create(user=self.user, url='https://example.com/shop.yaml', status='running',
+                                         attempts=1, updated_at=timezone.now())
+
+        job = claim_job()
+        self.assertEqual((job.id, job.status, job.attempts), (stale.id, 'running', 2))
+        self.assertEqual(ImportJob.objects.get(id=exhausted.id).status, 'failed')
+        self.assertEqual(ImportJob.objects.get(id=alive.id).status, 'running')
+        self.assertIsNone(claim_job())
+
+
+class CatalogQueriesTest(ApiTestCase):
+    """
+    Количество запросов каталога не должно зависеть от его размера
+    """
+
+    def test_products_query_budget(self):
+        import_shop('small', 2, categories=1)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/products/')
+        self.assertEqual(len(response.json()['results']), 1)
+
+        import_shop('large', 50, categories=5, parameters=5)
+        with self.assertNumQueries(3):
+            response = self.client.get('/api/v1/products/')
+        self.assertEqual(sum(len(category['products']) for category in response.json()['results']),
+                         Product.objects.count())
+
+    def test_products_cursor_pagination(self):
+        import_shop('shop', 20, categories=7)
+        names, url = [], '/api/v1/products/?page_size=3'
+        while url:
+            with self.assertNumQueries(3):
+                page = self.client.get(url).json()
+            names += [category['category'] for category in page['results']]
+            url = page['next']
+        self.assertEqual(names, sorted(f'Категория {index}' for index in range(7)))
+
+    def test_category_retrieve(self):
+        import_shop('shop', 10)
+        category = Category.objects.get(name='Категория 1')
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/v1/products/{category.id}/')
+        expected = [entry for entry in self.client.get('/api/v1/products/').json()['results']
+                    if entry['category'] == category.name]
+        self.assertEqual([response.json()], expected)
+
+    def test_serializer_query_budget(self):
+        import_shop('shop', 10, categories=5)
+        # категории и предложения всех категорий одним запросом
+        with self.assertNumQueries(2):
+            data = ProductListSerializer(Category.objects.order_by('name'), many=True).data
+        self.assertEqual(data, self.client.get('/api/v1/products/').json()['results'])
+
+    def test_product_query_budget(self):
+        shop = import_shop('shop', 10)
+        import_shop('other', 10)
+        product = shop.product_infos.first().product
+        with self.assertNumQueries(2):
+            response = self.client.get(f'/api/v1/product/{product.id}/')
+        offers = response.json()[0]['products_info']
+        self.assertEqual(len(offers), 2)
+        self.assertEqual(len(offers[0]['product_parameters']), 3)
+        self.assertEqual(self.client.get(f'/api/v1/product/{product.id}/{product.id}/').status_code, 404)
+
+
+class CatalogReadModelTest(ApiTestCase):
+    """
+    Витрина каталога отдает то же, что и сериализаторы по нормализованным таблицам
+    """
+
+    def assertMatchesSerializers(self):
+        # Продукты, у которых не осталось предложений, в витрину не попадают. Витрина отдает предложения
+        # и параметры в порядке ИД, у сериализаторов порядок задается явно
+        offered = Product.objects.filter(product_infos__retired=False).distinct().prefetch_related(
+            Prefetch('product_infos', ProductInfo.objects.filter(retired=False).order_by('id').prefetch_related(
+                Prefetch('product_parameters', ProductParameter.objects.order_by('id')))))
+        for category in self.client.get('/api/v1/products/').json()['results']:
+            products = offered.filter(category__name=category['category'])
+            self.assertEqual(category['products'], ProductSerializer(products, many=True).data)
+        for product in offered:
+            self.assertEqual(self.client.get(f'/api/v1/product/{product.id}/').json(),
+                             ProductSerializer([product], many=True).data)
+
+    def test_rebuilt_on_import(self):
+        shop = import_shop('shop', 12)
+        import_shop('other', 6, parameters=1)
+        self.assertMatchesSerializers()
+
+        data = make_price_list('shop', 8)
+        data['goods'][0].update(price=1, parameters={'Цвет': 'золотистый'})
+        DiffPriceListImporter(shop).run(data)
+        self.assertMatchesSerializers()
+        PriceListImporter(shop).run(make_price_list('shop', 4))
+        self.assertMatchesSerializers()
+        self.assertEqual(Category.objects.get(name='Категория 0').catalog_offers.filter(shop=shop).count(), 2)
+
+    def snapshot(self, shop):
+        offers = list(CatalogOffer.objects.filter(shop=shop).order_by('product_info_id').values())
+        postings = list(FacetPosting.objects.filter(shop=shop).order_by('parameter', 'value')
+                        .values_list('parameter', 'value', 'offers'))
+        return offers, postings
+
+    def customer_view(self):
+        export = [{key: value for key, value in json.loads(line).items() if key != 'id'}
+                  for line in self.client.get('/api/v1/export/').getvalue().splitlines()]
+        return (self.client.get('/api/v1/products/').json()['results'],
+                self.client.get('/api/v1/search/?search=товар').json(),
+                self.client.get('/api/v1/facets/?facet=Параметр 0:3').json(),
+                self.client.get('/api/v1/facets/').json()['facets'],
+                sorted(export, key=lambda row: row['product_id']))
+
+    def test_same_catalog_after_full_and_diff_import(self):
+        shop = import_shop('shop', 12)
+        data = make_price_list('shop', 12)
+        del data['goods'][3]
+        data['goods'][0]['price'] = 1
+
+        PriceListImporter(shop).run(data)
+        full = self.customer_view()
+        PriceListImporter(shop).run(make_price_list('shop', 12))
+        DiffPriceListImporter(shop).run(data)
+        # снятое с продажи предложение не видно покупателю, как и удаленное полным импортом
+        self.assertEqual(self.customer_view(), full)
+        self.assertEqual(shop.product_infos.filter(retired=True).count(), 1)
+        self.assertEqual(CatalogOffer.objects.filter(shop=shop).count(), 11)
+        self.assertMatchesSerializers()
+
+    def test_diff_import_incremental(self):
+        shop = import_shop('shop', 12)
+        data = make_price_list('shop', 12)
+        version = Shop.objects.get(id=shop.id).catalog_version
+        DiffPriceListImporter(shop).run(data)
+        self.assertEqual(Shop.objects.get(id=shop.id).catalog_version, version)
+
+        data['goods'][0].update(price=1, parameters={'Цвет': 'золотистый'})
+        data['goods'][1].update(name='Товар 1 (красный)')
+        del data['goods'][2]
+        data['goods'].append({**data['goods'][-1], 'id': 100, 'name': 'Товар 100', 'parameters': {'Цвет': 'черный'}})
+        stored = self.snapshot(shop)[0]
+        DiffPriceListImporter(shop).run(data)
+        self.assertEqual(Shop.objects.get(id=shop.id).catalog_version, version + 1)
+        offers, postings = self.snapshot(shop)
+        # изменились только строки двух измененных предложений, снятое с продажи удалено, добавилось новое
+        self.assertEqual(len(offers), 12)
+        self.assertEqual(sum(offer in stored for offer in offers), 9)
+
+        rebuild_catalog(shop)
+        self.assertEqual(self.snapshot(shop), (offers, postings))
+        self.assertMatchesSerializers()
+
+
+class CatalogCacheTest(ApiTestCase):
+
+    def test_cache_and_etag(self):
+        shop = import_shop('shop', 6)
+        url = '/api/v1/products/?page_size=2'
+        response = self.client.get(url)
+        etag = response['ETag']
+        # из кеша ответ отдается за один запрос версии каталога
+        with self.assertNumQueries(1):
+            cached = self.client.get(url)
+        self.assertEqual(cached.json(), response.json())
+        self.assertNotEqual(self.client.get('/api/v1/products/?page_size=3')['ETag'], etag)
+
+        with self.assertNumQueries(1):
+            not_modified = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified.content, b'')
+
+        data = make_price_list('shop', 6)
+        data['goods'][0]['price'] = 1
+        PriceListImporter(shop).run(data)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        prices = [offer['price'] for category in response.json()['results'] for product in category['products']
+                  for offer in product['products_info']]
+        self.assertIn(1, prices)
+
+    def test_category_rename(self):
+        shop = import_shop('shop', 6)
+        url = '/api/v1/products/'
+        etag = self.client.get(url)['ETag']
+        # инкрементальный импорт, в котором изменилось только название категории
+        data = make_price_list('shop', 6)
+        data['categories'][0]['name'] = 'Новая категория'
+        DiffPriceListImporter(shop).run(data)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Новая категория', [category['category'] for category in response.json()['results']])
+
+
+@skipUnlessDBFeature('has_select_for_update')
+@override_settings(IMPORT_AUTOCOMMIT_DB='autocommit')
+class CategoryRenameRollbackTest(ApiTransactionTestCase):
+    """
+    Новые категории пишутся через соединение autocommit, а переименования откатываются вместе с импортом.
+    SQLite не допускает второго пишущего соединения, поэтому тест выполняется только на PostgreSQL
+    """
+    databases = {'default', 'autocommit'}
+
+    def test_failed_import(self):
+        shop = import_shop('shop', 3)
+        data = make_price_list('shop', 3, categories=4)
+        data['categories'][0]['name'] = 'Новая категория'
+        with mock.patch.object(DiffPriceListImporter, 'import_goods', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                DiffPriceListImporter(shop).run(data)
+        self.assertEqual(sorted(Category.objects.values_list('name', flat=True)),
+                         [f'Категория {index}' for index in range(4)])
+
+
+class ProductSearchTest(ApiTestCase):
+
+    def test_search(self):
+        shop = import_shop('shop', 0)
+        data = make_price_list('shop', 0)
+        data['goods'] = [
+            {'id': 1, 'category': 1, 'model': 'apple/iphone/xs-max', 'name': 'Смартфон Apple iPhone XS Max 512GB',
+             'price': 110000, 'price_rrc': 116990, 'quantity': 14, 'parameters': {'Цвет': 'золотистый'}},
+            {'id': 2, 'category': 1, 'model': 'samsung/galaxy', 'name': 'Смартфон Samsung Galaxy',
+             'price': 60000, 'price_rrc': 65000, 'quantity': 3, 'parameters': {'Цвет': 'черный'}},
+            {'id': 3, 'category': 2, 'model': 'apple/case', 'name': 'Чехол для смартфона',
+             'price': 1000, 'price_rrc': 1500, 'quantity': 30, 'parameters': {'Цвет': 'золотистый'}},
+        ]
+        PriceListImporter(shop).run(data)
+
+        names = [product['name'] for product in self.client.get('/api/v1/search/?search=Apple').json()]
+        self.assertEqual(names, ['Смартфон Apple iPhone XS Max 512GB', 'Чехол для смартфона'])
+        names = [product['name'] for product in self.client.get('/api/v1/search/?search=золотистый').json()]
+        self.assertEqual(len(names), 2)
+        names = [product['name'] for product in self.client.get('/api/v1/search/?search=смартфон черный').json()]
+        self.assertEqual(names, ['Смартфон Samsung Galaxy'])
+        self.assertEqual(self.client.get('/api/v1/search/?search=').json(), [])
+        self.assertEqual(len(self.client.get('/api/v1/search/?search=смартфон&page_size=1').json()), 1)
+        self.assertEqual(self.client.get(f'/api/v1/search/{shop.product_infos.first().id}/').status_code, 404)
+
+
+class ProductFacetTest(ApiTestCase):
+
+    def facets(self, *facets, **params):
+        return self.client.get('/api/v1/facets/', {'facet': list(facets), **params}).json()
+
+    def test_facets(self):
+        shop = import_shop('shop', 0)
+        data = make_price_list('shop', 9, parameters=2)
+        for item in data['goods']:
+            item['parameters'] = {'Цвет': ['черный', 'белый', 'золотистый'][item['id'] % 3],
+                                  'Встроенная память (Гб)': 256 if item['id'] < 5 else 512}
+        PriceListImporter(shop).run(data)
+        import_shop('other', 4, parameters=1)
+
+        response = self.facets()
+        self.assertEqual(response['count'], 13)
+        self.assertEqual(response['facets']['Цвет'], {'черный': 3, 'белый': 3, 'золотистый': 3})
+
+        response = self.facets('Цвет:золотистый', 'Встроенная память (Гб):512')
+        self.assertEqual(response['count'], 2)
+        self.assertEqual([product['name'] for product in response['results']], ['Товар 5', 'Товар 8'])
+        self.assertEqual(response['facets']['Цвет'], {'золотистый': 2})
+
+        response = self.facets('Цвет:золотистый', 'Цвет:белый', 'Встроенная память (Гб):256')
+        self.assertEqual(response['count'], 3)
+        response = self.facets('Цвет:золотистый', 'Параметр 0:1', facets_mode='or')
+        self.assertEqual(response['count'], 4)
+
+        data['goods'][8]['parameters']['Цвет'] = 'черный'
+        PriceListImporter(shop).run(data)
+        self.assertEqual(self.facets('Цвет:золотистый')['count'], 2)
+        self.assertEqual(self.client.get(f'/api/v1/facets/{shop.product_infos.first().id}/').status_code, 404)
+
+
+class FastRenderingTest(ApiTestCase):
+    """
+    Быстрый путь по values() дает те же байты JSON, что и сериализаторы
+    """
+
+    def test_identical_json(self):
+        shop = import_shop('shop', 8)
+        import_shop('other', 5, parameters=1)
+        user = User.objects.create_user('buyer@example.com', 'password', username='buyer', type='buyer')
+        offers = list(shop.product_infos.order_by('id'))
+        for status, items in (('basket', offers[:3]), ('new', offers[2:6]), ('confirmed', [])):
+            order = Order.objects.create(user=user, status=status)
+            OrderItem.objects.bulk_create(OrderItem(order=order, product_info=offer, quantity=index + 1)
+                                          for index, offer in enumerate(items))
+        update_order_totals(Order.objects.filter(user=user))
+
+        renderer = JSONRenderer()
+        self.assertEqual(renderer.render(fast_products()), renderer.render(legacy_products()))
+        self.assertEqual(renderer.render(fast_orders(user)), renderer.render(legacy_orders(user)))
+
+        client = APIClient()
+        client.force_authenticate(user)
+        basket = client.get('/api/v1/basket/').json()[0]
+        self.assertEqual([item['product_id'] for item in basket['ordered_items']], [offer.id for offer in offers[:3]])
+        self.assertEqual(basket['total_sum'], sum(offer.price * (index + 1) for index, offer in enumerate(offers[:3])))
+        orders = client.get('/api/v1/orders/').json()['results']
+        self.assertEqual([order['status'] for order in orders], ['confirmed', 'new'])
+
+
+class UJSONRendererTest(ApiTestCase):
+
+    def test_unescaped_json(self):
+        response = APIClient().post('/api/v1/upload/', {'url': 'https://example.com/shop.yaml'}, format='json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertIn('Только для авторизованных пользователей'.encode(), response.content)
+
+        import_shop('Связной', 2)
+        response = APIClient().get('/api/v1/products/')
+        self.assertIn('"shop":{"name":"Связной"}'.encode(), response.content)
+        response = APIClient().get('/api/v1/products/', HTTP_ACCEPT='application/json; indent=2')
+        self.assertIn(b'\n  ', response.content)
+
+    def test_parser(self):
+        client = APIClient()
+        response = client.post('/api/v1/login/', '{"email": "нет@example.com", "password": "x"}',
+                               content_type='application/json')
+        self.assertEqual(response.json(), {'Status': False, 'Errors': 'Не удалось войти.'})
+        response = client.post('/api/v1/login/', '{"email": ', content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class SparseFieldsTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        shop = import_shop('shop', 4)
+        self.user = User.objects.create_user('buyer@example.com', 'password', username='buyer', type='buyer')
+        order = Order.objects.create(user=self.user, status='new')
+        OrderItem.objects.bulk_create(OrderItem(order=order, product_info=offer, quantity=2)
+                                      for offer in shop.product_infos.all())
+        update_order_total(order.id)
+        self.client.force_authenticate(self.user)
+
+    def test_orders(self):
+        with self.assertNumQueries(1):
+            orders = self.client.get('/api/v1/orders/?fields=id,status').json()['results']
+        self.assertEqual(list(orders[0]), ['id', 'status'])
+
+        # позиции без предложений и параметров: один запрос на позиции без JOIN с предложениями
+        with self.assertNumQueries(2):
+            orders = self.client.get('/api/v1/orders/?fields=id,ordered_items.quantity').json()['results']
+        self.assertEqual(orders[0]['ordered_items'][0], {'quantity': 2})
+
+        orders = self.client.get('/api/v1/orders/?expand=ordered_items.product').json()['results']
+        self.assertEqual(set(orders[0]), {'id', 'dt', 'user_id', 'status', 'total_sum', 'item_count', 'ordered_items'})
+        self.assertEqual(set(orders[0]['ordered_items'][0]['product']), {'price', 'price_rrc', 'quantity'})
+        self.assertEqual(orders[0]['total_sum'], 2 * sum(ProductInfo.objects.values_list('price', flat=True)))
+
+        full = self.client.get('/api/v1/orders/').json()['results']
+        self.assertEqual(len(full[0]['ordered_items'][0]['product']['product_parameters']), 3)
+
+    def test_order_retrieve(self):
+        order_id = Order.objects.get(user=self.user).id
+        # заказ, позиции с предложениями и магазином, параметры - без запросов на каждую позицию
+        with self.assertNumQueries(3):
+            order = self.client.get(f'/api/v1/orders/{order_id}/').json()
+        self.assertEqual(order, self.client.get('/api/v1/orders/').json()['results'][0])
+        with self.assertNumQueries(2):
+            order = self.client.get(f'/api/v1/orders/{order_id}/?fields=id,ordered_items.quantity').json()
+        self.assertEqual(order, {'id': order_id, 'ordered_items': [{'quantity': 2}] * 4})
+
+    def test_catalog(self):
+        with self.assertNumQueries(2):
+            categories = self.client.get('/api/v1/products/?fields=category').json()['results']
+        self.assertEqual(categories[0], {'category': 'Категория 0'})
+
+        categories = self.client.get('/api/v1/products/?fields=products.name,products.products_info.price'
+                                     ).json()['results']
+        self.assertEqual(categories[0]['products'][0]['products_info'][0], {'price': 103})
+        product_id = Product.objects.get(name='Товар 3').id
+        products = self.client.get(f'/api/v1/product/{product_id}/?expand=products_info.shop').json()
+        self.assertEqual(products[0]['products_info'][0]['shop'], {'name': 'shop'})
+        self.assertNotIn('product_parameters', products[0]['products_info'][0])
+
+    def test_serializer(self):
+        products = Product.objects.filter(product_infos__isnull=False).distinct()
+        request = Request(APIRequestFactory().get('/', {'fields': 'name,products_info.shop'}))
+        data = ProductSerializer(products, many=True, context={'request': request}).data
+        self.assertEqual(dict(data[0]), {'name': data[0]['name'], 'products_info': [{'shop': {'name': 'shop'}}]})
+
+
+class CatalogExportTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shop = import_shop('shop', 7)
+        import_shop('other', 3)
+
+    def test_ndjson(self):
+        with self.settings(EXPORT_CHUNK_SIZE=2, EXPORT_BUFFER_SIZE=100):
+            response = self.client.get('/api/v1/export/', {'shop': self.shop.id})
+            self.assertTrue(response.streaming)
+            chunks = list(response.streaming_content)
+        self.assertGreater(len(chunks), 1)
+        rows = [json.loads(line) for line in b''.join(chunks).decode().splitlines()]
+        self.assertEqual([row['id'] for row in rows],
+                         list(self.shop.product_infos.order_by('id').values_list('id', flat=True)))
+        self.assertEqual(rows[0]['parameters'], {'Параметр 0': '0', 'Параметр 1': '0', 'Параметр 2': '0'})
+        self.assertEqual(rows[0]['shop'], 'shop')
+
+    def test_csv_gzip(self):
+        category = Category.objects.get(name='Категория 1')
+        response = self.client.get('/api/v1/export/', {'export_format': 'csv', 'category': category.id,
+                                                       'compress': 'gzip'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        rows = list(csv.DictReader(StringIO(gzip.decompress(b''.join(response.streaming_content)).decode())))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual({row['category_id'] for row in rows}, {str(category.id)})
+        self.assertEqual(json.loads(rows[0]['parameters'])['Параметр 2'], '1')
+
+    def test_invalid_params(self):
+        self.assertEqual(self.client.get('/api/v1/export/', {'export_format': 'xml'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/export/', {'shop': 'x'}).status_code, 400)
+
+
+class ShopStateTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shop = import_shop('shop', 4)
+        self.other = import_shop('other', 3)
+        self.client.force_authenticate(self.shop.owner)
+
+    def test_toggle(self):
+        self.assertEqual(self.client.get('/api/v1/partner/state/').json(),
+                         {'Status': True, 'id': self.shop.id, 'name': 'shop', 'state': True})
+        self.assertFalse(self.client.post('/api/v1/partner/state/', {}, format='json').json()['Status'])
+        self.assertTrue(self.client.post('/api/v1/partner/state/', {'state': 'false'}, format='json').json()['Status'])
+        self.assertFalse(Shop.objects.get(id=self.shop.id).state)
+        self.assertEqual(closed_shops.get(), {self.shop.id})
+
+        self.client.force_authenticate(User.objects.create_user('buyer@example.com', 'password', username='buyer'))
+        self.assertEqual(self.client.get('/api/v1/partner/state/').status_code, 403)
+
+    def test_closed_shop_filtered(self):
+        url = '/api/v1/products/?fields=products.products_info.shop'
+        shops = {offer['shop']['name'] for category in self.client.get(url).json()['results']
+                 for product in category['products'] for offer in product['products_info']}
+        self.assertEqual(shops, {'shop', 'other'})
+
+        self.client.post('/api/v1/partner/state/', {'state': False}, format='json')
+        with self.assertNumQueries(1):
+            closed_shops.get()
+        shops = {offer['shop']['name'] for category in self.client.get(url).json()['results']
+                 for product in category['products'] for offer in product['products_info']}
+        self.assertEqual(shops, {'other'})
+        category = self.client.get(f'/api/v1/products/{self.shop.product_infos.first().product.category_id}/'
+                                   '?fields=products.products_info.shop').json()
+        self.assertEqual({offer['shop']['name'] for product in category['products']
+                          for offer in product['products_info']}, {'other'})
+        self.assertEqual(ProductListSerializer(Category.objects.order_by('name'), many=True).data,
+                         self.client.get('/api/v1/products/').json()['results'])
+        self.assertEqual(self.client.get('/api/v1/facets/').json()['count'], 3)
+        self.assertEqual(len(self.client.get('/api/v1/export/').getvalue().splitlines()), 3)
+
+        offer = self.shop.product_infos.first()
+        serializer = OrderItemSerializer(data={'product': offer.id, 'quantity': 1})
+        self.assertFalse(serializer.is_valid())
+        self.assertEqual(serializer.errors['non_field_errors'], ['Магазин сейчас не принимает заказы'])
+
+    def test_state_ttl(self):
+        closed_shops.get()
+        Shop.objects.filter(id=self.other.id).update(state=False)
+        with self.assertNumQueries(0):
+            self.assertEqual(closed_shops.get(), set())
+        with self.settings(SHOP_STATE_TTL=0):
+            self.assertEqual(closed_shops.get(), {self.other.id})
+
+
+class OrderTotalsTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shop = import_shop('shop', 4)
+        self.user = User.objects.create_user('buyer@example.com', 'password', username='buyer', type='buyer')
+        self.client.force_authenticate(self.user)
+
+    def test_basket_totals(self):
+        offers = list(self.shop.product_infos.order_by('id'))
+        response = self.client.post('/api/v1/basket/', [{'product': offer.id, 'quantity': 1} for offer in offers[:2]],
+                                    format='json')
+        self.assertTrue(response.json()['Status'])
+        basket = Order.objects.get(user=self.user, status='basket')
+        self.assertEqual((basket.total_sum, basket.item_count), (offers[0].price + offers[1].price, 2))
+
+        # повтор товара откатывает добавление, но сумма остается согласованной с позициями
+        self.client.post('/api/v1/basket/', [{'product': offers[2].id, 'quantity': 1},
+                                             {'product': offers[0].id, 'quantity': 1}], format='json')
+        basket.refresh_from_db()
+        self.assertEqual(basket.total_sum, sum(item.quantity * item.product_info.price
+                                               for item in basket.ordered_items.all()))
+        self.assertEqual(basket.item_count, basket.ordered_items.count())
+
+        # новая цена после импорта попадает в сумму корзины
+        data = make_price_list('shop', 4)
+        data['goods'][0]['price'] += 1000
+        PriceListImporter(self.shop).run(data)
+        total_sum = basket.total_sum
+        basket.refresh_from_db()
+        self.assertEqual(basket.total_sum, total_sum + 1000)
+
+        with self.assertNumQueries(1):
+            self.client.get('/api/v1/orders/?fields=id,total_sum,item_count')
+
+    def test_repair_command(self):
+        order = Order.objects.create(user=self.user, status='new')
+        OrderItem.objects.bulk_create(OrderItem(order=order, product_info=offer, quantity=3)
+                                      for offer in self.shop.product_infos.all())
+        Order.objects.create(user=self.user, status='new', total_sum=100, item_count=1)
+        out = StringIO()
+        call_command('repair_order_totals', '--batch-size', '1', stdout=out)
+        self.assertIn('Пересчитано заказов: 2', out.getvalue())
+        self.assertEqual(list(Order.objects.order_by('id').values_list('total_sum', 'item_count')),
+                         [(3 * sum(self.shop.product_infos.values_list('price', flat=True)), 4), (0, 0)])
+
+
+class BasketTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shop = import_shop('shop', 30)
+        self.offers = list(self.shop.product_infos.order_by('id'))
+        self.user = User.objects.create_user('buyer@example.com', 'password', username='buyer', type='buyer')
+        self.client.force_authenticate(self.user)
+
+    def add(self, lines):
+        return self.client.post('/api/v1/basket/', lines, format='json').json()
+
+    def test_batch_add(self):
+        self.add([{'product': self.offers[0].id, 'quantity': 1}])
+        # корзина, предложения, позиции корзины, вставка, пересчет суммы и SAVEPOINT/RELEASE транзакции
+        with self.assertNumQueries(7):
+            response = self.add([{'product': offer.id, 'quantity': 2} for offer in self.offers[1:]])
+        self.assertEqual(response['Добавлено объектов'], 29)
+        self.assertTrue(all(line['Status'] for line in response['Позиции']))
+        basket = Order.objects.get(user=self.user, status='basket')
+        self.assertEqual((basket.item_count, basket.total_sum),
+                         (30, sum(offer.price for offer in self.offers) * 2 - self.offers[0].price))
+
+    def test_batch_add_errors(self):
+        self.add([{'product': self.offers[0].id, 'quantity': 1}])
+        response = self.add([{'product': self.offers[1].id, 'quantity': 1},
+                             {'product': self.offers[0].id, 'quantity': 1},
+                             {'product': self.offers[2].id, 'quantity': 6},
+                             {'product': self.offers[3].id, 'quantity': 0},
+                             {'product': 10 ** 6, 'quantity': 1},
+                             {'product': self.offers[1].id, 'quantity': 1},
+                             'x'])
+        self.assertFalse(response['Status'])
+        self.assertEqual([line.get('Errors') for line in response['Позиции']],
+                         [None, 'Товар уже находится в корзине', 'Такого количества нет в наличии',
+                          'Нельзя заказать товар в количестве меньше 1', 'Предложение не найдено',
+                          'Товар уже находится в корзине', 'Некорректный формат данных'])
+        self.assertEqual(OrderItem.objects.filter(order__user=self.user).count(), 1)
+
+    def test_update_and_delete(self):
+        self.add([{'product': offer.id, 'quantity': 1} for offer in self.offers])
+        lines = [{'product': offer.id, 'quantity': 3} for offer in self.offers[:20]]
+        # корзина, предложения, один UPDATE с CASE, пересчет суммы и SAVEPOINT/RELEASE транзакции
+        with self.assertNumQueries(6):
+            response = self.client.put('/api/v1/basket/', lines, format='json').json()
+        self.assertEqual(response['Обновлено объектов'], 20)
+        self.assertEqual(sorted(OrderItem.objects.values_list('quantity', flat=True)), [1] * 10 + [3] * 20)
+
+        response = self.client.put('/api/v1/basket/', [{'product': self.offers[0].id, 'quantity': 1},
+                                                       {'product': self.offers[1].id, 'quantity': 6}],
+                                   format='json').json()
+        self.assertEqual([line['Status'] for line in response['Позиции']], [True, False])
+        self.assertEqual(response['Возникла ошибка!'], {'non_field_errors': ['Такого количества нет в наличии']})
+        self.assertEqual(OrderItem.objects.get(product_info=self.offers[0]).quantity, 3)
+
+        items = ','.join(str(offer.id) for offer in self.offers[:25])
+        response = self.client.delete('/api/v1/basket/', {'items': f'{items},x'}, format='json').json()
+        self.assertEqual(response, {'Status': True, 'Удалено объектов': 25})
+        basket = Order.objects.get(user=self.user, status='basket')
+        self.assertEqual((basket.item_count, basket.total_sum), (5, sum(offer.price for offer in self.offers[25:])))
+        response = self.client.delete('/api/v1/basket/', {'items': items}, format='json').json()
+        self.assertEqual(response['Errors'], 'Укажите корректные товары для удаления')
+
+
+class StockReservationTest(ApiTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.shop = import_shop('shop', 3)
+        self.offers = list(self.shop.product_infos.order_by('id'))
+        self.user = User.objects.create_user('buyer@example.com', 'password', username='buyer', type='buyer')
+        Contact.objects.create(user=self.user, type='phone', value='+70000000000')
+        self.client.force_authenticate(self.user)
+
+    def basket(self, *quantities):
+        self.client.post('/api/v1/basket/', [{'product': offer.id, 'quantity': quantity}
+                                             for offer, quantity in zip(self.offers, quantities)], format='json')
+        return Order.objects.get(user=self.user, status='basket')
+
+    def stock(self):
+        offers = ProductInfo.objects.filter(shop=self.shop).order_by('id')
+        # витрина каталога следует за складом, снятых с продажи предложений в ней нет
+        self.assertEqual(list(CatalogOffer.objects.filter(shop=self.shop).order_by('pk')
+                              .values_list('quantity', flat=True)),
+                         list(offers.filter(retired=False).values_list('quantity', flat=True)))
+        return list(offers.values_list('quantity', flat=True))
+
+    def test_checkout_and_cancel(self):
+        order = self.basket(2, 5)
+        versions = list(Shop.objects.order_by('id').values_list('catalog_version', flat=True))
+        with mock.patch('api.cache.stock_period', return_value=0):
+            etag = self.client.get('/api/v1/products/')['ETag']
+            response = self.client.post('/api/v1/orders/', {'id': str(order.id)}, format='json').json()
+            self.assertEqual((response['Status'], response['phone']), (True, '+70000000000'))
+            self.assertEqual(self.stock(), [3, 0, 5])
+            # оформление не сбрасывает кеш каталога: остатки обновятся в следующем интервале
+            self.assertEqual(self.client.get('/api/v1/products/')['ETag'], etag)
+        self.assertEqual(list(Shop.objects.order_by('id').values_list('catalog_version', flat=True)), versions)
+        with mock.patch('api.cache.stock_period', return_value=1):
+            response = self.client.get('/api/v1/products/')
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(sorted(offer['quantity'] for category in response.json()['results']
+                                for product in category['products'] for offer in product['products_info']), [0, 3, 5])
+        # в следующем интервале без изменений остатков ETag прежний, и клиент получает 304
+        with mock.patch('api.cache.stock_period', return_value=2):
+            self.assertEqual(self.client.get('/api/v1/products/', HTTP_IF_NONE_MATCH=response['ETag']).status_code,
+                             304)
+        # повторное оформление того же заказа товар не списывает
+        self.assertFalse(self.client.post('/api/v1/orders/', {'id': str(order.id)}, format='json').json()['Status'])
+        self.assertEqual(self.stock(), [3, 0, 5])
+
+        self.assertTrue(self.client.post(f'/api/v1/orders/{order.id}/cancel/').json()['Status'])
+        self.assertEqual(self.stock(), [5, 5, 5])
+        self.assertFalse(self.client.post(f'/api/v1/orders/{order.id}/cancel/').json()['Status'])
+        self.assertEqual(self.stock(), [5, 5, 5])
+
+    def test_status_changes_only_by_checkout_and_cancel(self):
+        order = self.basket(2, 5)
+        self.client.post('/api/v1/orders/', {'id': str(order.id)}, format='json')
+        self.assertEqual(self.stock(), [3, 0, 5])
+
+        # заказ нельзя вернуть в корзину, отменить в обход возврата товара или удалить
+        for status in ('basket', 'canceled'):
+            response = self.client.patch(f'/api/v1/orders/{order.id}/', {'status': status}, format='json')
+            self.assertEqual(response.status_code, 405)
+        self.assertEqual(self.client.delete(f'/api/v1/orders/{order.id}/').status_code, 405)
+        self.assertEqual(Order.objects.get(id=order.id).status, 'new')
+        self.assertFalse(self.client.post('/api/v1/orders/', {'id': str(order.id)}, format='json').json()['Status'])
+        self.assertEqual(self.stock(), [3, 0, 5])
+
+        self.assertTrue(self.client.post(f'/api/v1/orders/{order.id}/cancel/').json()['Status'])
+        self.assertEqual(self.stock(), [5, 5, 5])
+
+    def test_cancel_skips_retired_offers(self):
+        order = self.basket(2, 5)
+        self.client.post('/api/v1/orders/', {'id': str(order.id)}, format='json')
+        # второй товар пропал из прайса и снят с продажи, первый распродан до нуля
+        data = make_price_list('shop', 3)
+        del data['goods'][1]
+        data['goods'][0]['quantity'] = 0
+        DiffPriceListImporter(self.shop).run(data)
+        self.assertEqual(self.stock(), [0, 0, 5])
+
+        self.assertTrue(self.client.post(f'/api/v1/orders/{order.id}/cancel/').json()['Status'])
+        self.assertEqual(self.stock(), [2, 0, 5])
+
+    def test_checkout_shortage(self):
+        order = self.basket(2, 5)
+        ProductInfo.objects.filter(id=self.offers[1].id).update(quantity=4)
+        CatalogOffer.objects.filter(pk=self.offers[1].id).update(quantity=4)
+        response = self.client.post('/api/v1/orders/', {'id': str(order.id)}, format='json').json()
+        self.assertEqual(response, {'Status': False, 'Errors': 'Такого количества нет в наличии',
+                                    'Позиции': [self.offers[1].id]})
+        self.assertEqual(self.stock(), [5, 4, 5])
+        self.assertEqual(Order.objects.get(id=order.id).status, 'basket')
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class StockReservationStressTest(ApiTransactionTestCase):
+    """
+    Параллельные оформления корзин с одними и теми же товарами не продают больше, чем есть на складе
+    """
+    buyers = 24
+    stock = 10
+
+    def setUp(self):
+        super().setUp()
+        shop = import_shop('shop', 2)
+        self.offers = list(shop.product_infos.order_by('id'))
+        ProductInfo.objects.filter(shop=shop).update(quantity=self.stock)
+        CatalogOffer.objects.filter(shop=shop).update(quantity=self.stock)
+        self.orders = []
+        for index in range(self.buyers):
+            user = User.objects.create_user(f'buyer{index}@example.com', 'password', username=f'buyer{index}')
+            order = Order.objects.create(user=user, status='basket')
+            # половина покупателей кладет товары в обратном порядке, чтобы проверить порядок блокировок
+            offers = self.offers if index % 2 else self.offers[::-1]
+            OrderItem.objects.bulk_create(OrderItem(order=order, product_info=offer, quantity=1) for offer in offers)
+            self.orders.append((order.id, user.id))
+
+    def test_no_overselling(self):
+        barrier = threading.Barrier(self.buyers)
+        results = []
+
+        def buy(order_id, user_id):
+            try:
+                barrier.wait()
+                results.append(checkout_order(order_id, user_id))
+            except CheckoutError:
+                results.append(False)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=buy, args=order) for order in self.orders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count(True), self.stock)
+        self.assertEqual(list(ProductInfo.objects.order_by('id').values_list('quantity', flat=True)), [0, 0])
+        self.assertEqual(list(CatalogOffer.objects.order_by('pk').values_list('quantity', flat=True)), [0, 0])
+        self.assertEqual(Order.objects.filter(status='new').count(), self.stock)
+
+
+@skipUnlessDBFeature('has_select_for_update')
+class ConcurrentShopImportTest(ApiTransactionTestCase):
+    """
+    Параллельные импорты одного магазина выполняются по очереди и не падают на ограничениях уникальности
+    """
+    imports = 4
+
+    def test_same_shop(self):
+        # категории и продукты уже есть, а прайсы не перечисляют категорий: импорты не ждут друг друга
+        # на вставке общих строк и сразу пишут позиции магазина, упорядочить их может только блокировка
+        import_shop('other', 30)
+        shop = Shop.objects.create(name='shop', url='https://shop.example.com/')
+        data = make_price_list('shop', 30)
+        data['categories'] = []
+        barrier = threading.Barrier(self.imports)
+        errors = []
+
+        def run(importer):
+            try:
+                barrier.wait()
+                importer(shop).run(data)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=run, args=(importer,))
+                   for importer in [PriceListImporter, DiffPriceListImporter] * (self.imports // 2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(shop.product_infos.count(), 30)
+        self.assertEqual(CatalogOffer.objects.filter(shop=shop).count(), 30)
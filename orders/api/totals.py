@@ -0,0 +1,27 @@
+from django.db.models import Count, F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from api.models import Order, OrderItem
+
+
+def update_order_totals(orders):
+    """
+    Пересчитывает сохраненные сумму и количество позиций заказов из queryset одним UPDATE
+    с коррелированными подзапросами по позициям. Возвращает количество обновленных заказов
+    """
+    items = OrderItem.objects.filter(order_id=OuterRef('pk')).order_by().values('order_id')
+    total_sum = items.annotate(total=Sum(F('quantity') * F('product_info__price'))).values('total')
+    item_count = items.annotate(count=Count('id')).values('count')
+    return orders.update(total_sum=Coalesce(Subquery(total_sum), 0), item_count=Coalesce(Subquery(item_count), 0))
+
+
+def update_order_total(order_id):
+    return update_order_totals(Order.objects.filter(id=order_id))
+
+
+def shop_baskets(shop_id):
+    """
+    ИД корзин с предложениями магазина: их суммы нужно пересчитать после импорта его прайса
+    """
+    return set(OrderItem.objects.filter(order__status='basket', product_info__shop_id=shop_id).values_list(
+        'order_id', flat=True))
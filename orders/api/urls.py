@@ -2,17 +2,23 @@ from django.urls import path
 from rest_framework.routers import DefaultRouter
 
 from api.views import PartnerUpdate, UserRegistration, LoginAccount, ProductsViewSet, ProductInfoViewSet, \
-    BasketViewSet, OrderViewSet, ContactViewSet, ConfirmAccount
+    ProductSearchViewSet, ProductFacetViewSet, BasketViewSet, OrderViewSet, ContactViewSet, ConfirmAccount, \
+    PartnerImportStatus, PartnerState, CatalogExport
 
 r = DefaultRouter()
 r.register('registration', UserRegistration)
 r.register('products', ProductsViewSet)
 r.register(r'product/(?P<id>\w+)', ProductInfoViewSet)
+r.register('search', ProductSearchViewSet)
+r.register('facets', ProductFacetViewSet)
 r.register('basket', BasketViewSet)
 r.register('orders', OrderViewSet)
 r.register('contacts', ContactViewSet)
 
 urlpatterns = r.urls
+urlpatterns += [path('export/', CatalogExport.as_view())]
 urlpatterns += [path('upload/', PartnerUpdate.as_view())]
+urlpatterns += [path('upload/<int:job_id>/', PartnerImportStatus.as_view())]
+urlpatterns += [path('partner/state/', PartnerState.as_view())]
 urlpatterns += [path('login/', LoginAccount.as_view())]
 urlpatterns += [path('register/confirm', ConfirmAccount.as_view())]
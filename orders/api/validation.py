@@ -0,0 +1,169 @@
+import hashlib
+
+from api.models import Category, Product, ProductInfo, Parameter, ProductParameter
+from api.price_lists import PriceListRowError, READ_ERRORS, read_price_list
+
+MAX_ERRORS = 100
+
+GOODS_KEYS = ('id', 'category', 'model', 'name', 'price', 'price_rrc', 'quantity', 'parameters')
+INTEGER_KEYS = ('id', 'category', 'price', 'price_rrc', 'quantity')
+
+
+class PriceListValidationError(Exception):
+    """
+    Прайс не прошел проверку, report содержит отчет об ошибках
+    """
+
+    def __init__(self, report):
+        super().__init__(f'Ошибок в прайсе: {report["errors_count"]}')
+        self.report = report
+
+
+def max_length(model, field):
+    return model._meta.get_field(field).max_length
+
+
+class PriceListValidator:
+    """
+    Проверка прайса за один проход без обращения к БД: обязательные ключи, целые цена и количество,
+    price <= price_rrc, категории товаров из списка categories, уникальность ИД товаров и
+    пар название/категория (это один продукт) и длины строк по ограничениям полей моделей.
+    В отчет попадают первые max_errors ошибок, при этом считаются все. Для проверки уникальности
+    хранятся целые ИД товаров и 8-байтовые хеши пар, а не сами названия, поэтому память на товар
+    не зависит от длины строк
+    """
+
+    def __init__(self, max_errors=MAX_ERRORS):
+        self.max_errors = max_errors
+        self.errors = []
+        self.errors_count = 0
+        self.goods_count = 0
+        self.seen_ids = set()
+        self.seen_products = {}
+        self.limits = {
+            'category': max_length(Category, 'name'),
+            'name': max_length(Product, 'name'),
+            'model': max_length(ProductInfo, 'model'),
+            'parameter': max_length(Parameter, 'name'),
+            'value': max_length(ProductParameter, 'value'),
+        }
+
+    def error(self, message, field=None, index=None, goods_id=None):
+        self.errors_count += 1
+        if len(self.errors) < self.max_errors:
+            error = {'error': message}
+            if field is not None:
+                error['field'] = field
+            if index is not None:
+                error.update(index=index, id=goods_id)
+            self.errors.append(error)
+
+    def validate(self, data):
+        """
+        Проверяет прайс {'shop': ..., 'categories': [...], 'goods': [...]} и возвращает отчет
+        """
+        if not isinstance(data.get('shop'), str) or not data['shop']:
+            self.error('Не указано название магазина', 'shop')
+        category_ids = self.validate_categories(data.get('categories'))
+        for item in data.get('goods') or ():
+            self.validate_item(self.goods_count, item, category_ids)
+            self.goods_count += 1
+        return self.report()
+
+    def report(self):
+        return {'valid': not self.errors_count, 'goods': self.goods_count, 'errors_count': self.errors_count,
+                'errors': self.errors}
+
+    def validate_categories(self, categories):
+        category_ids = set()
+        if not isinstance(categories, list):
+            self.error('Список категорий должен быть списком', 'categories')
+            return category_ids
+        for category in categories:
+            if not isinstance(category, dict) or not is_integer(category.get('id')):
+                self.error(f'Некорректная категория {category!r}', 'categories')
+                continue
+            if category['id'] in category_ids:
+                self.error(f'Повторяющийся ИД категории {category["id"]}', 'categories')
+            category_ids.add(category['id'])
+            name = category.get('name')
+            if not isinstance(name, str) or not name or len(name) > self.limits['category']:
+                self.error(f'Некорректное название категории {category["id"]}', 'categories')
+        return category_ids
+
+    def validate_item(self, index, item, category_ids):
+        if isinstance(item, PriceListRowError):
+            self.error(str(item), index=index)
+            return
+        if not isinstance(item, dict):
+            self.error('Товар должен быть словарем', index=index)
+            return
+        goods_id = item.get('id')
+        missing = [key for key in GOODS_KEYS if key not in item]
+        if missing:
+            self.error(f'Не указаны обязательные поля: {", ".join(missing)}', index=index, goods_id=goods_id)
+        for key in INTEGER_KEYS:
+            if key in item and not (is_integer(item[key]) and item[key] >= 0):
+                self.error('Должно быть неотрицательным целым числом', key, index, goods_id)
+
+        if is_integer(goods_id):
+            if goods_id in self.seen_ids:
+                self.error('Повторяющийся ИД товара', 'id', index, goods_id)
+            self.seen_ids.add(goods_id)
+        if is_integer(item.get('category')) and item['category'] not in category_ids:
+            self.error('Категория отсутствует в списке categories', 'category', index, goods_id)
+        if is_integer(item.get('price')) and is_integer(item.get('price_rrc')) and item['price'] > item['price_rrc']:
+            self.error('Цена больше рекомендуемой розничной цены', 'price', index, goods_id)
+        for key in ('name', 'model'):
+            value = item.get(key)
+            if key in item and (not isinstance(value, str) or len(value) > self.limits[key] or
+                                key == 'name' and not value):
+                self.error(f'Должно быть строкой длиной до {self.limits[key]} символов', key, index, goods_id)
+        if isinstance(item.get('name'), str) and is_integer(item.get('category')):
+            product = product_digest(item['name'], item['category'])
+            if product in self.seen_products:
+                self.error(f'Товар с таким названием и категорией уже указан (ИД {self.seen_products[product]})',
+                           'name', index, goods_id)
+            else:
+                self.seen_products[product] = goods_id
+
+        parameters = item.get('parameters')
+        if 'parameters' in item and not isinstance(parameters, dict):
+            self.error('Параметры должны быть словарем', 'parameters', index, goods_id)
+        elif parameters:
+            for name, value in parameters.items():
+                if not isinstance(name, str) or len(name) > self.limits['parameter']:
+                    self.error(f'Некорректное имя параметра {name!r}', 'parameters', index, goods_id)
+                if value is None or len(str(value)) > self.limits['value']:
+                    self.error(f'Некорректное значение параметра {name!r}', 'parameters', index, goods_id)
+
+
+def is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def product_digest(name, category):
+    """
+    Хеш пары название/категория фиксированного размера
+    """
+    return int.from_bytes(hashlib.blake2b(f'{category}:{name}'.encode(), digest_size=8).digest(), 'big')
+
+
+def validate_price_list(data, max_errors=MAX_ERRORS):
+    """
+    Проверяет прайс и возвращает отчет {'valid', 'goods', 'errors_count', 'errors'}
+    """
+    return PriceListValidator(max_errors).validate(data)
+
+
+def validate_stream(stream, price_list_format, max_errors=MAX_ERRORS):
+    """
+    Читает прайс из потока и проверяет его. Если файл не удалось разобрать до конца,
+    ошибка разбора попадает в отчет вместе с найденными до нее
+    """
+    validator = PriceListValidator(max_errors)
+    try:
+        return validator.validate(read_price_list(stream, price_list_format))
+    except READ_ERRORS as exc:
+        validator.error(f'Не удалось прочитать прайс: {exc}')
+        return validator.report()
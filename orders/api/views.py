@@ -1,26 +1,40 @@
-import yaml
-from yaml import load as load_yaml, Loader
+import heapq
 
 from django.contrib.auth import authenticate
+from django.core.exceptions import ValidationError as DjangoValidationError
 from django.db import IntegrityError
-from django.db.models import Q, Sum, F
+from django.db.models import Q
 from django.core.validators import URLValidator
-from django.http import JsonResponse
-
-from requests import get
+from django.http import StreamingHttpResponse
 
 from rest_framework.authtoken.models import Token
 from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
+from rest_framework.settings import api_settings
+from rest_framework.response import Response
 from rest_framework.views import APIView
-from rest_framework.viewsets import ModelViewSet
+from rest_framework.viewsets import GenericViewSet, ModelViewSet
 from rest_framework.exceptions import ValidationError
 
+from api.basket import add_items, delete_items, update_items
+from api.cache import CatalogCacheMixin
+from api.catalog import catalog_categories, product_representations
+from api.fields import FieldSelection
 from api.filters import ShopFilter
-from api.models import Shop, Category, ProductInfo, Product, Parameter, ProductParameter, User, Order, OrderItem, \
-    Contact, ConfirmEmailToken
+from api.pagination import CatalogPagination, OrderPagination, ContactPagination
+from api.export import EXPORT_FORMATS, export_catalog
+from api.facets import facet_index, parse_facets
+from api.renderers import JsonResponse
+from api.representations import ORDER_FIELDS, order_representations, with_order_details
+from api.search import search_offers
+from api.shops import open_offers, set_shop_state
+from api.stock import CheckoutError, cancel_order, checkout_order
+from api.importer import IMPORTERS
+from api.price_lists import PRICE_LIST_FORMATS, detect_format
+from api.models import Category, Product, CatalogOffer, User, Order, Contact, ConfirmEmailToken, \
+    ImportJob, Shop
 from api.serializers import UserSerializer, ProductListSerializer, ProductSerializer, OrderSerializer, \
-    OrderItemSerializer, ContactSerializer
+    OrderItemSerializer, ContactSerializer, ImportJobSerializer, ShopStateSerializer
 from api.signals import new_user_registered, new_order
 
 
@@ -50,22 +64,118 @@ class LoginAccount(APIView):
         return JsonResponse({'Status': False, 'Errors': 'Не указан email и/или пароль'})
 
 
-class ProductsViewSet(ModelViewSet):
+class ProductsViewSet(CatalogCacheMixin, ModelViewSet):
     queryset = Category.objects.all()
     serializer_class = ProductListSerializer
     http_method_names = ['get', ]
     filterset_class = ShopFilter
+    pagination_class = CatalogPagination
+
+    def catalog_data(self, request, *args, **kwargs):
+        categories = self.paginate_queryset(self.filter_queryset(self.get_queryset()).values('id', 'name'))
+        return self.get_paginated_response(catalog_categories(categories, FieldSelection.from_request(request))).data
+
+    def retrieve(self, request, *args, **kwargs):
+        category = self.get_object()
+        return Response(catalog_categories([{'id': category.id, 'name': category.name}],
+                                           FieldSelection.from_request(request))[0])
 
 
-class ProductInfoViewSet(ModelViewSet):
+class ProductInfoViewSet(CatalogCacheMixin, GenericViewSet):
+    """
+    Предложения продукта из витрины каталога, только список
+    """
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
     http_method_names = ['get', ]
 
     def get_queryset(self):
-        queryset = Product.objects.filter(id=self.kwargs.get('id'))
+        queryset = open_offers(CatalogOffer.objects.filter(product_id=self.kwargs.get('id'))).order_by(
+            'product_info_id')
         return queryset
 
+    def catalog_data(self, request, *args, **kwargs):
+        return product_representations(self.get_queryset(), FieldSelection.from_request(request))
+
+
+class ProductSearchViewSet(CatalogCacheMixin, GenericViewSet):
+    """
+    Поиск по названию продукта, модели и значениям параметров: продукты в порядке
+    релевантности лучшего предложения, не больше page_size предложений. Только список
+    """
+    queryset = CatalogOffer.objects.all()
+    serializer_class = ProductSerializer
+    http_method_names = ['get', ]
+
+    def get_queryset(self):
+        queryset = search_offers(open_offers(CatalogOffer.objects.all()),
+                                 self.request.query_params.get(api_settings.SEARCH_PARAM, ''))
+        return queryset
+
+    def catalog_data(self, request, *args, **kwargs):
+        limit = CatalogPagination().get_page_size(request)
+        return product_representations(self.get_queryset()[:limit], FieldSelection.from_request(request))
+
+
+class ProductFacetViewSet(GenericViewSet):
+    """
+    Фильтрация предложений по значениям параметров: ?facet=Цвет:золотистый&facet=Цвет:черный.
+    Значения одного параметра объединяются по ИЛИ, разные параметры - по И или по ИЛИ при facets_mode=or.
+    Возвращает количество найденных предложений, количество предложений по каждому значению
+    параметров среди найденных и первые page_size предложений. Только список
+    """
+    queryset = CatalogOffer.objects.all()
+    serializer_class = ProductSerializer
+    http_method_names = ['get', ]
+
+    def list(self, request, *args, **kwargs):
+        facets = parse_facets(request.query_params.getlist('facet'))
+        mode = request.query_params.get('facets_mode', 'and')
+        if mode not in ('and', 'or'):
+            return JsonResponse({'Status': False, 'Errors': 'facets_mode должен быть and или or'}, status=400)
+
+        facet_index.refresh()
+        result = facet_index.search(facets, mode)
+        limit = CatalogPagination().get_page_size(request)
+        offers = open_offers(CatalogOffer.objects.order_by('product_info_id'))
+        if result is None:
+            count = offers.count()
+            offers = offers[:limit]
+        else:
+            count = len(result)
+            offers = offers.filter(product_info_id__in=heapq.nsmallest(limit, result))
+        return Response({'count': count, 'facets': facet_index.counts(result),
+                         'results': product_representations(offers, FieldSelection.from_request(request))})
+
+
+class CatalogExport(APIView):
+    """
+    Потоковая выгрузка всего каталога: ?export_format=ndjson|csv, фильтры shop и category (ИД),
+    compress=gzip для сжатия на лету. Память не зависит от размера каталога
+    """
+    def get(self, request, *args, **kwargs):
+
+        export_format = request.query_params.get('export_format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            return JsonResponse({'Status': False,
+                                 'Errors': f'Формат выгрузки должен быть одним из: {", ".join(EXPORT_FORMATS)}'},
+                                status=400)
+        filters = {}
+        for name in ('shop', 'category'):
+            value = request.query_params.get(name)
+            if value is not None:
+                if not value.isdigit():
+                    return JsonResponse({'Status': False, 'Errors': f'{name} должен быть ИД'}, status=400)
+                filters[f'{name}_id'] = int(value)
+        compress = request.query_params.get('compress') == 'gzip'
+
+        content_type = 'application/gzip' if compress else EXPORT_FORMATS[export_format]
+        response = StreamingHttpResponse(export_catalog(export_format, compress=compress, **filters),
+                                         content_type=content_type)
+        filename = f'catalog.{export_format}' + ('.gz' if compress else '')
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        return response
+
 
 class PartnerUpdate(APIView):
     """
@@ -81,76 +191,91 @@ class PartnerUpdate(APIView):
 
         url = request.data.get('url')
         filename = request.data.get('filename')
+        mode = request.data.get('mode', 'full')
+        if mode not in IMPORTERS:
+            return JsonResponse({'Status': False,
+                                 'Errors': f'Режим импорта должен быть одним из: {", ".join(IMPORTERS)}'})
+        dry_run = str(request.data.get('dry_run', '')).lower() in ('1', 'true', 'yes')
+        price_list_format = request.data.get('format', '')
+        if price_list_format and price_list_format not in PRICE_LIST_FORMATS:
+            return JsonResponse({'Status': False,
+                                 'Errors': f'Формат прайса должен быть одним из: {", ".join(PRICE_LIST_FORMATS)}'})
+
         if url:
             validate_url = URLValidator()
             try:
                 validate_url(url)
-            except ValidationError as e:
+            except DjangoValidationError as e:
                 return JsonResponse({'Status': False, 'Error': str(e)})
             else:
-                stream = get(url).content
-
-                data = load_yaml(stream, Loader=Loader)
-
-                shop, _ = Shop.objects.get_or_create(name=data['shop'], owner_id=request.user.id)
-                for category in data['categories']:
-                    category_object, _ = Category.objects.get_or_create(id=category['id'], name=category['name'])
-                    category_object.shops.add(shop.id)
-                    category_object.save()
-                ProductInfo.objects.filter(shop_id=shop.id).delete()
-                for item in data['goods']:
-                    product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
-
-                    product_info = ProductInfo.objects.create(product_id=product.id,
-                                                              model=item['model'],
-                                                              price=item['price'],
-                                                              price_rrc=item['price_rrc'],
-                                                              quantity=item['quantity'],
-                                                              shop_id=shop.id)
-                    for name, value in item['parameters'].items():
-                        parameter_object, _ = Parameter.objects.get_or_create(name=name)
-                        ProductParameter.objects.create(product_info_id=product_info.id,
-                                                        parameter_id=parameter_object.id,
-                                                        value=value)
-
-                return JsonResponse({'Status': True})
+                job = ImportJob.objects.create(user_id=request.user.id, url=url, mode=mode, format=price_list_format,
+                                               dry_run=dry_run)
 
         elif filename:
             _, file = request.FILES.popitem()
-            shop = Shop()
-            shop.filename = file[0]
-            shop.url = shop.filename.url
-            shop.save()
-            with open(f'media/{shop.filename}', 'r') as stream:
-                try:
-                    shop_data = yaml.safe_load(stream)
-                    Shop.objects.filter(filename=shop.filename).update(name=shop_data['shop'], owner_id=request.user.id)
-                    for category in shop_data['categories']:
-                        category_object, _ = Category.objects.get_or_create(id=category['id'], name=category['name'])
-                        category_object.shops.add(shop.pk)
-                        category_object.save()
-                    ProductInfo.objects.filter(shop_id=shop.pk).delete()
-                    for item in shop_data['goods']:
-                        product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
-                        product_info = ProductInfo.objects.create(product_id=product.id,
-                                                                  model=item['model'],
-                                                                  price=item['price'],
-                                                                  price_rrc=item['price_rrc'],
-                                                                  quantity=item['quantity'],
-                                                                  shop_id=shop.pk)
-                        for name, value in item['parameters'].items():
-                            parameter_object, _ = Parameter.objects.get_or_create(name=name)
-                            ProductParameter.objects.create(product_info_id=product_info.id,
-                                                            parameter_id=parameter_object.id,
-                                                            value=value)
-                except yaml.YAMLError as exc:
-                    return JsonResponse({'Status': False, 'Error': str(exc)})
-
-            return JsonResponse({'Status': True})
+            job = ImportJob.objects.create(user_id=request.user.id, file=file[0], mode=mode, dry_run=dry_run,
+                                           format=price_list_format or detect_format(file[0].name,
+                                                                                     file[0].content_type))
 
         else:
             return JsonResponse({'Status': False, 'Errors': 'Укажите url с файлом каталога магазина или прикрепите '
-                                                            'yaml файл.'})
+                                                            'файл прайса.'})
+
+        return JsonResponse({'Status': True, 'Задача': job.id}, status=202)
+
+
+class PartnerImportStatus(APIView):
+    """
+    Класс для получения состояния задачи импорта прайса
+    """
+    def get(self, request, job_id, *args, **kwargs):
+
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Только для авторизованных пользователей'}, status=403)
+
+        job = ImportJob.objects.filter(id=job_id, user_id=request.user.id).first()
+        if job is None:
+            return JsonResponse({'Status': False, 'Errors': 'Задача не найдена'}, status=404)
+
+        return JsonResponse({'Status': True, **ImportJobSerializer(job, context={'request': request}).data})
+
+
+class PartnerState(APIView):
+    """
+    Класс для получения и переключения статуса приема заказов магазином
+    """
+    def get(self, request, *args, **kwargs):
+
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Только для авторизованных пользователей'}, status=403)
+
+        if request.user.type != 'shop':
+            return JsonResponse({'Status': False, 'Error': 'Только для магазинов'}, status=403)
+
+        shop = Shop.objects.filter(owner_id=request.user.id).first()
+        if shop is None:
+            return JsonResponse({'Status': False, 'Errors': 'Магазин не найден'}, status=404)
+
+        return JsonResponse({'Status': True, **ShopStateSerializer(shop).data})
+
+    def post(self, request, *args, **kwargs):
+
+        if not request.user.is_authenticated:
+            return JsonResponse({'Status': False, 'Error': 'Только для авторизованных пользователей'}, status=403)
+
+        if request.user.type != 'shop':
+            return JsonResponse({'Status': False, 'Error': 'Только для магазинов'}, status=403)
+
+        shop = Shop.objects.filter(owner_id=request.user.id).first()
+        if shop is None:
+            return JsonResponse({'Status': False, 'Errors': 'Магазин не найден'}, status=404)
+
+        serializer = ShopStateSerializer(shop, data=request.data)
+        if not serializer.is_valid():
+            return JsonResponse({'Status': False, 'Errors': serializer.errors})
+
+        set_shop_state(shop.id, serializer.validated_data['state'])
+        return JsonResponse({'Status': True})
 
 
 class BasketViewSet(ModelViewSet):
@@ -160,121 +285,116 @@ class BasketViewSet(ModelViewSet):
     serializer_action_classes = {'list': OrderSerializer, 'create': OrderItemSerializer}
 
     def get_queryset(self):
-        queryset = Order.objects.filter(user_id=self.request.user.id, status='basket').\
-            prefetch_related('ordered_items').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product__price'))).distinct()
+        queryset = Order.objects.filter(user_id=self.request.user.id, status='basket')
+        if self.action == 'retrieve':
+            queryset = with_order_details(queryset, FieldSelection.from_request(self.request))
         return queryset
 
     def get_serializer_class(self):
         return self.serializer_action_classes.get(self.action)
 
+    def list(self, request, *args, **kwargs):
+        selection = FieldSelection.from_request(request)
+        return Response(order_representations(list(self.get_queryset().values(*ORDER_FIELDS)), selection))
+
     def create(self, request, *args, **kwargs):
         if self.request.data:
-            try:
-                objects_created = 0
-                order, _ = Order.objects.get_or_create(user_id=self.request.user.id, status='basket')
-                for product in self.request.data:
-                    serializer = OrderItemSerializer(data=product)
-                    if serializer.is_valid():
-                        try:
-                            serializer.save(order_id=order.id)
-                            objects_created += 1
-                        except IntegrityError:
-                            return JsonResponse({'Status': False, 'Возникла ошибка!': "Товар уже находится в корзине"})
-                    else:
-                        return JsonResponse({'Status': False, 'Возникла ошибка!': serializer.errors})
-                return JsonResponse({'Status': True, 'Добавлено объектов': objects_created})
-            except TypeError:
+            if not isinstance(self.request.data, list):
                 return JsonResponse({'Status': False, 'Возникла ошибка!': "Некорректный формат данных"})
+            try:
+                objects_created, results = add_items(self.request.user.id, self.request.data)
+            except IntegrityError:
+                return JsonResponse({'Status': False, 'Возникла ошибка!': "Товар уже находится в корзине"})
+            if objects_created is None:
+                return JsonResponse({'Status': False, 'Возникла ошибка!': "Позиции не прошли проверку",
+                                     'Позиции': results})
+            return JsonResponse({'Status': True, 'Добавлено объектов': objects_created, 'Позиции': results})
         return JsonResponse({'Status': False, 'Возникла ошибка!': "Указаны не все аргументы"})
 
     @action(methods=['delete'], detail=False)
     def delete(self, request, *args, **kwargs):
-        products_to_delete = str(self.request.data['items']).split(',')
-        if products_to_delete:
-            basket, _ = Order.objects.get_or_create(user_id=self.request.user.id, status='basket')
-            query = Q()
-            objects_deleted = False
-            for order_item_id in products_to_delete:
-                if order_item_id.isdigit():
-                    query = query | Q(order_id=basket.id, product_id=order_item_id)
-                    objects_deleted = True
-            if objects_deleted:
-                deleted_count = OrderItem.objects.filter(query).delete()[0]
-                if deleted_count != 0:
-                    return JsonResponse({'Status': True, 'Удалено объектов': deleted_count})
-                else:
-                    return JsonResponse({'Status': False, 'Errors': 'Укажите корректные товары для удаления'})
+        products_to_delete = str(self.request.data.get('items', '')).split(',')
+        ids = {int(product_id) for product_id in products_to_delete if product_id.isdigit()}
+        if ids:
+            deleted_count = delete_items(self.request.user.id, ids)
+            if deleted_count != 0:
+                return JsonResponse({'Status': True, 'Удалено объектов': deleted_count})
+            else:
+                return JsonResponse({'Status': False, 'Errors': 'Укажите корректные товары для удаления'})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
     @action(methods=['put'], detail=False)
     def put(self, request, *args, **kwargs):
         if self.request.data:
-            try:
-                objects_updated = 0
-                basket, _ = Order.objects.get_or_create(user_id=self.request.user.id, status='basket')
-
-                for product in self.request.data:
-                    product.update(order_id=basket.id)
-                    serializer = OrderItemSerializer(data=product)
-                    if serializer.is_valid():
-                        if type(product['product']) == int and type(product['quantity']) == int:
-                            objects_updated += OrderItem.objects.filter(order_id=basket.id,
-                                                                        product_id=product['product']).update(
-                                                                        quantity=product['quantity'])
-                    else:
-                        return JsonResponse({'Status': False, 'Возникла ошибка!': serializer.errors})
-                return JsonResponse({"Status": True, "Обновлено объектов": objects_updated})
-            except ValueError:
+            if not isinstance(self.request.data, list):
                 return JsonResponse({'Status': False, 'Возникла ошибка!': "Некорректный формат данных"})
+            objects_updated, results = update_items(self.request.user.id, self.request.data)
+            if objects_updated is None:
+                # ошибка первой неверной строки в прежнем формате ошибок сериализатора, по строкам - в 'Позиции'
+                error = next(line['Errors'] for line in results if not line['Status'])
+                return JsonResponse({'Status': False, 'Возникла ошибка!': {'non_field_errors': [error]},
+                                     'Позиции': results})
+            return JsonResponse({"Status": True, "Обновлено объектов": objects_updated, 'Позиции': results})
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
 
 class OrderViewSet(ModelViewSet):
+    """
+    Заказы пользователя. Статус меняется только оформлением (POST) и отменой (cancel), которые
+    резервируют и возвращают товар, поэтому изменение и удаление заказа недоступны
+    """
     queryset = Order.objects.all()
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = OrderPagination
+    http_method_names = ['get', 'post', ]
 
     def get_queryset(self):
-        queryset = Order.objects.filter(user_id=self.request.user.id).exclude(status='basket').prefetch_related(
-            'ordered_items').annotate(
-            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product__price'))).distinct()
+        queryset = Order.objects.filter(user_id=self.request.user.id).exclude(status='basket')
+        if self.action == 'retrieve':
+            queryset = with_order_details(queryset, FieldSelection.from_request(self.request))
         return queryset
 
+    def list(self, request, *args, **kwargs):
+        selection = FieldSelection.from_request(request)
+        orders = self.paginate_queryset(self.get_queryset().values(*ORDER_FIELDS))
+        return self.get_paginated_response(order_representations(orders, selection))
+
     def create(self, request, *args, **kwargs):
         if {'id'}.issubset(self.request.data):
-            if self.request.data['id'].isdigit():
+            if str(self.request.data['id']).isdigit():
+                phone = Contact.objects.filter(user_id=self.request.user.id, type='phone').first()
+                if not phone:
+                    return JsonResponse({'Status': False, 'Errors': 'Укажите контактный номер для связи'})
                 try:
-                    is_updated = Order.objects.filter(id=self.request.data['id']).update(status='new')
-                except IntegrityError:
-                    return JsonResponse({'Status': False, 'Errors': 'Неправильно указаны аргументы'})
-                else:
-                    if is_updated:
-                        user_info = User.objects.filter(id=self.request.user.id).first()
-                        phone = Contact.objects.filter(user_id=self.request.user.id, type='phone').first()
-                        total_sum = Order.objects.filter(id=self.request.data['id']).prefetch_related(
-                            'ordered_items').annotate(
-                            total_sum=Sum(F('ordered_items__quantity') * F('ordered_items__product__price'))
-                        ).distinct()[0].total_sum
-                        if phone:
-                            new_order.send(sender=self.__class__, user_id=self.request.user.id,
-                                           order_id=self.request.data['id'],
-                                           )
-                            return JsonResponse({'Status': True,
-                                                 "last_name": user_info.last_name,
-                                                 "first_name": user_info.first_name,
-                                                 "email": user_info.email,
-                                                 "phone": phone})
-                        else:
-                            return JsonResponse({'Status': False, 'Errors': 'Укажите контактный номер для связи'})
+                    is_updated = checkout_order(int(self.request.data['id']), self.request.user.id)
+                except CheckoutError as e:
+                    return JsonResponse({'Status': False, 'Errors': str(e), 'Позиции': e.products})
+                if is_updated:
+                    user_info = User.objects.filter(id=self.request.user.id).first()
+                    new_order.send(sender=self.__class__, user_id=self.request.user.id,
+                                   order_id=self.request.data['id'],
+                                   )
+                    return JsonResponse({'Status': True,
+                                         "last_name": user_info.last_name,
+                                         "first_name": user_info.first_name,
+                                         "email": user_info.email,
+                                         "phone": phone.value})
 
         return JsonResponse({'Status': False, 'Errors': 'Не указаны все необходимые аргументы'})
 
+    @action(methods=['post'], detail=True)
+    def cancel(self, request, pk=None, *args, **kwargs):
+        if pk.isdigit() and cancel_order(int(pk), self.request.user.id):
+            return JsonResponse({'Status': True})
+        return JsonResponse({'Status': False, 'Errors': 'Заказ не найден или его уже нельзя отменить'})
+
 
 class ContactViewSet(ModelViewSet):
     queryset = Contact.objects.all()
     serializer_class = ContactSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = ContactPagination
 
     def get_queryset(self):
         queryset = Contact.objects.filter(user_id=self.request.user.id)
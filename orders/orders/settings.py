@@ -89,6 +89,26 @@ DATABASES = {
     }
 }
 
+# Отдельное соединение в режиме автокоммита для записей, которые должны фиксироваться
+# независимо от транзакции импорта магазина: прогресс задач и общие справочники
+# категорий, продуктов и параметров (None - писать через основное соединение)
+DATABASES['autocommit'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+IMPORT_AUTOCOMMIT_DB = 'autocommit'
+
+IMPORT_WORKER_POLL_INTERVAL = 2
+
+# Задача в статусе running без обновлений дольше IMPORT_JOB_TIMEOUT секунд считается брошенной
+# упавшим воркером и возвращается в очередь, но не более IMPORT_JOB_MAX_ATTEMPTS запусков
+IMPORT_JOB_TIMEOUT = 30 * 60
+IMPORT_JOB_MAX_ATTEMPTS = 3
+
+# Загрузка прайсов по ссылке: размер пула соединений, таймауты (подключение, чтение),
+# общее время загрузки в секундах и максимальный размер прайса в байтах
+IMPORT_FETCH_POOL_SIZE = 10
+IMPORT_FETCH_TIMEOUT = (5, 60)
+IMPORT_FETCH_DEADLINE = 600
+IMPORT_FETCH_MAX_SIZE = 512 * 1024 * 1024
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -121,10 +141,45 @@ REST_FRAMEWORK = {
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
         'rest_framework.filters.SearchFilter',
-    ]
+    ],
+
+    'DEFAULT_RENDERER_CLASSES': [
+        'api.renderers.UJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+
+    'DEFAULT_PARSER_CLASSES': [
+        'api.renderers.UJSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
+
+}
+
+# Размер страницы списков по умолчанию и максимальный, который клиент может запросить параметром page_size
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
 }
 
+# Кеш ответов каталога: псевдоним кеша и время жизни записи в секундах. Записи устаревают
+# сразу после импорта за счет версии каталога в ключе, время жизни только освобождает место
+CATALOG_CACHE_ALIAS = 'default'
+CATALOG_CACHE_TIMEOUT = 60 * 60
+# Максимальная задержка в секундах, с которой остатки после оформления и отмены заказов видны в кешированных ответах
+CATALOG_STOCK_TTL = 30
+
+# Максимальная задержка в секундах, с которой процесс замечает переключение приема заказов магазином
+SHOP_STATE_TTL = 5
+
+# Потоковая выгрузка каталога: строк витрины за одно чтение курсора и размер отправляемого куска в байтах
+EXPORT_CHUNK_SIZE = 2000
+EXPORT_BUFFER_SIZE = 64 * 1024
+
 # Internationalization
 # https://docs.djangoproject.com/en/4.1/topics/i18n/
 